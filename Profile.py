@@ -16,9 +16,12 @@
 # YOU DO NOT NEED TO READ OR UNDERSTAND THE JSON SERIALIZATION ASPECTS OF THIS CODE RIGHT NOW, 
 # though can you certainly take a look at it if you are curious.
 #
-import json, time, os
+import json, time, os, shutil, threading
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
 from pathlib import Path
 from ds_messenger import DirectMessage
+from ds_jsonstream import JsonStream, reverse_items
 
 """
 DsuFileError is a custom exception handler that you should catch in your own code. It
@@ -42,6 +45,71 @@ class DsuProfileError(Exception):
     pass
 
 
+"""
+A dsu file can be stored as plain json or compressed with gzip or lzma. Compressed files are recognized by the
+magic bytes at the start of the file, so load_profile never needs to be told which format a file uses.
+
+"""
+
+COMPRESSION_FORMATS = ('plain', 'gzip', 'lzma')
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_LZMA_MAGIC = b'\xfd7zXZ\x00'
+
+
+def detect_compression(path) -> str:
+    """Returns 'gzip', 'lzma' or 'plain' depending on the magic header of the file at path."""
+    with open(path, 'rb') as f:
+        header = f.read(len(_LZMA_MAGIC))
+    if header.startswith(_GZIP_MAGIC):
+        return 'gzip'
+    if header.startswith(_LZMA_MAGIC):
+        return 'lzma'
+    return 'plain'
+
+
+def open_dsu(path, mode: str = 'r', compression: str = None, level: int = None):
+    """
+    Opens a dsu file as a text stream, compressing or decompressing on the fly. When reading, the compression is
+    detected from the file itself. When writing, compression is one of COMPRESSION_FORMATS and level is the gzip
+    compresslevel (1-9) or lzma preset (0-9).
+    """
+    if 'r' in mode:
+        compression = detect_compression(path)
+    compression = compression or 'plain'
+
+    # the compression modules are only imported when a compressed file is actually used
+    if compression == 'gzip':
+        import gzip
+        return gzip.open(path, mode + 't', compresslevel=6 if level is None else level, encoding='utf-8')
+    elif compression == 'lzma':
+        import lzma
+        return lzma.open(path, mode + 't', preset=level, encoding='utf-8')
+    elif compression == 'plain':
+        return open(path, mode, encoding='utf-8')
+    raise ValueError(f"Unknown dsu compression format: {compression}")
+
+
+"""
+Message listeners are called as listener(profile, message) every time add_msg adds a message to any Profile.
+They let caches built from a profile's messages (such as the GUI's rendered conversations) drop only the
+entries a new message affects, even though the GUI creates a new Profile each time it reloads the dsu file.
+Listeners may be called from the outbox sender's thread.
+
+"""
+
+_message_listeners = []
+
+
+def add_message_listener(listener) -> None:
+    _message_listeners.append(listener)
+
+
+def remove_message_listener(listener) -> None:
+    if listener in _message_listeners:
+        _message_listeners.remove(listener)
+
+
 class Post(dict):
     """ 
 
@@ -77,6 +145,13 @@ class Post(dict):
     def get_time(self):
         return self._timestamp
 
+    def set_id(self, post_id: int):
+        self._id = post_id
+        dict.__setitem__(self, 'id', post_id)
+
+    def get_id(self):
+        return self.get('id')
+
     """
 
     The property method is used to support get and set capability for entry and time values.
@@ -86,6 +161,7 @@ class Post(dict):
     """
     entry = property(get_entry, set_entry)
     timestamp = property(get_time, set_time)
+    id = property(get_id, set_id)
 
 
 class Profile:
@@ -107,28 +183,271 @@ class Profile:
         self.password = password  # REQUIRED
         self.bio = ''  # OPTIONAL
         self._posts = []  # OPTIONAL
+        self._next_post_id = 1  # the id given to the next post added, ids are never reused
 
         self._messages = []
 
         self._users = []  # This list used to store the usernames of users that you have messages with
 
+        self._outbox = []  # Messages waiting to be delivered to the server, see ds_outbox.py
+
+        # How the dsu file was stored when it was loaded, save_profile keeps using the same format
+        # unless told otherwise. These are not written to the dsu file.
+        self._compression = 'plain'
+        self._compresslevel = None
+
+        # The manifest of archive segments holding older messages, see archive_messages
+        self._archive = []
+        self._archive_dir = None  # where the segment files are, set when the profile is loaded or saved
+        self._segments = {}  # segment file name -> list of messages, for segments that have been read
+
+        # True when only the recent messages were loaded (see load_profile_recent), such a profile can't be saved
+        self._partial = False
+
+        # The post index: id -> post for every live post, and a sorted list of (timestamp, id) for paging.
+        # Deleted posts stay in _posts and _post_order as tombstones until _compact_posts removes them.
+        self._post_index = {}
+        self._post_order = []
+        self._post_tombstones = 0
+
+        # The chat index: username -> (timestamps, messages), both sorted by time, for get_chat_page. It is
+        # built on first use and covers the first _chat_indexed messages of the _chat_source list.
+        self._chat_index = {}
+        self._chat_source = None
+        self._chat_indexed = 0
+        # get_chat_page builds the index while reading, so copy takes this lock to see a whole index
+        self._chat_lock = threading.Lock()
+
+    # Attributes that only exist while the program is running and are left out of the dsu file
+    _runtime_attrs = ('_compression', '_compresslevel', '_archive_dir', '_segments', '_partial',
+                      '_post_index', '_post_order', '_post_tombstones', '_chat_index', '_chat_source',
+                      '_chat_indexed', '_chat_lock')
+
+    # The order of the keys in the dsu file. Everything load_profile_recent needs comes before the (long) lists
+    # of posts and messages, so it can stop reading the file as soon as it gets to them, and the messages always
+    # come last, so it can read the latest ones from the end of the file.
+    _key_order = ('dsuserver', 'username', 'password', 'bio', '_next_post_id', '_users', '_outbox', '_archive')
+    _last_keys = ('_posts', '_messages')
+
+    # How many of the latest messages with each contact load_profile_recent loads
+    recent_limit = 20
+
     #  TODO: Write a function that goes through all the messages and returns a list of all the posts to/from a specific
     #   user. You should be able to enter a username into the function as a parameter and get a list of all their
     #   sent/received messages.
     
-    def get_chat_messages(self,username: str)->list:
+    def get_chat_messages(self,username: str, start: float = None, end: float = None)->list:
         """
         accepts a username and returns a list of all the messages in the chat with that user
+
+        start and end optionally limit the result to messages with start <= timestamp < end. Messages that
+        have been moved to the archive (see archive_messages) are only included when start or end is given
+        and the range reaches into the archived time range, so queries without a range, or for recent
+        messages only, never touch the archive.
         """
 
         chat_messages=[]
-        
+
+        if start is not None or end is not None:
+            for segment in self._archive:
+                if (start is None or segment['end'] >= start) and (end is None or segment['start'] < end) \
+                        and username in segment['contacts']:
+                    chat_messages.extend(self._read_segment(segment['file']))
+
         for message in self._messages:
             if(message['from']==username or message['recipient']==username):
                 chat_messages.append(message)
-                
+
+        if start is not None or end is not None:
+            chat_messages = [message for message in chat_messages
+                             if (message['from'] == username or message['recipient'] == username)
+                             and (start is None or message['timestamp'] >= start)
+                             and (end is None or message['timestamp'] < end)]
+            chat_messages.sort(key=lambda message: message['timestamp'])
+
         return chat_messages
-        
+
+    """
+
+    archive_messages moves every message older than the before timestamp out of the dsu file at path and
+    into archive segments, one per calendar month (UTC). Segments are gzip compressed json files stored in a
+    '<profile name>.archive' folder next to the dsu file, and are never modified once written; archiving
+    the same month again creates another segment. The manifest describing the segments is kept in the
+    dsu file itself. The profile is saved to path when done. Returns the number of messages archived.
+
+    Raises DsuFileError
+
+    """
+
+    def archive_messages(self, path: str, before: float) -> int:
+        p = Path(path)
+        old = [message for message in self._messages if message['timestamp'] < before]
+        if not old:
+            return 0
+
+        buckets = {}
+        for message in old:
+            buckets.setdefault(time.strftime('%Y-%m', time.gmtime(message['timestamp'])), []).append(message)
+
+        archive_dir = p.parent / (p.stem + '.archive')
+        try:
+            archive_dir.mkdir(exist_ok=True)
+            existing = {segment['file'] for segment in self._archive}
+            for bucket, messages in sorted(buckets.items()):
+                number = 0
+                while f"{bucket}.{number}.seg" in existing or (archive_dir / f"{bucket}.{number}.seg").exists():
+                    number += 1
+                name = f"{bucket}.{number}.seg"
+
+                messages.sort(key=lambda message: message['timestamp'])
+                f = open_dsu(archive_dir / name, 'w', 'gzip')
+                json.dump(messages, f)
+                f.close()
+
+                contacts = {message['from'] for message in messages} | {message['recipient'] for message in messages}
+                contacts.discard(self.username)
+                self._archive.append({'file': name, 'start': messages[0]['timestamp'],
+                                      'end': messages[-1]['timestamp'], 'count': len(messages),
+                                      'contacts': sorted(user for user in contacts if user is not None)})
+                self._segments[name] = messages
+        except Exception as ex:
+            raise DsuFileError("An error occurred while writing the message archive.", ex)
+
+        self._archive_dir = archive_dir
+        self._messages = [message for message in self._messages if message['timestamp'] >= before]
+        self.save_profile(path)
+        return len(old)
+
+    """
+
+    get_archived_messages returns every archived message with start <= timestamp < end, reading only the
+    segments that overlap that time range.
+
+    """
+
+    def get_archived_messages(self, start: float = 0, end: float = None) -> list:
+        messages = []
+        for segment in self._archive:
+            if segment['end'] >= start and (end is None or segment['start'] < end):
+                messages.extend(message for message in self._read_segment(segment['file'])
+                                if message['timestamp'] >= start and (end is None or message['timestamp'] < end))
+        messages.sort(key=lambda message: message['timestamp'])
+        return messages
+
+    """
+
+    get_chat_page returns one page of the chat with username, for showing a long conversation a piece at a
+    time: the latest limit messages with before > timestamp (or all messages if before is None), oldest first.
+    With after given instead, it returns the earliest limit messages with timestamp >= after. Messages sharing
+    the timestamp at the edge of a page are always returned together, so a page can hold a few more than
+    limit. Archived messages are read when the page reaches back past the messages in the dsu file.
+
+    Pages are served from an index of each contact's messages that is built the first time and then kept up
+    to date as messages are added, so paging through a conversation doesn't search the whole messages list.
+
+    """
+
+    def get_chat_page(self, username: str, before: float = None, after: float = None, limit: int = 100) -> list:
+        timestamps, messages = self._chat_messages(username)
+
+        if after is not None:
+            lo = bisect_left(timestamps, after)
+            hi = min(len(timestamps), lo + limit)
+            while hi < len(timestamps) and timestamps[hi] == timestamps[hi - 1]:
+                hi += 1
+            return messages[lo:hi]
+
+        hi = len(timestamps) if before is None else bisect_left(timestamps, before)
+        lo = max(0, hi - limit)
+        while lo > 0 and timestamps[lo - 1] == timestamps[lo]:
+            lo -= 1
+        page = messages[lo:hi]
+
+        if lo == 0 and len(page) < limit and self._archive:
+            cutoff = page[0]['timestamp'] if page else before
+            older = []
+            for segment in sorted(self._archive, key=lambda segment: segment['end'], reverse=True):
+                if (cutoff is None or segment['start'] < cutoff) and username in segment['contacts']:
+                    older.extend(message for message in self._read_segment(segment['file'])
+                                 if (message['from'] == username or message['recipient'] == username)
+                                 and (cutoff is None or message['timestamp'] < cutoff))
+                    if len(older) >= limit - len(page):
+                        break
+            older.sort(key=lambda message: message['timestamp'])
+            start = max(0, len(older) - (limit - len(page)))
+            while start > 0 and older[start - 1]['timestamp'] == older[start]['timestamp']:
+                start -= 1
+            page = older[start:] + page
+        return page
+
+    def _chat_messages(self, username: str) -> tuple:
+        with self._chat_lock:
+            return self._update_chat_index(username)
+
+    def _update_chat_index(self, username: str) -> tuple:
+        # brings the chat index up to date with the messages list and returns the entry for username
+        if self._chat_source is not self._messages or self._chat_indexed > len(self._messages):
+            # the list was replaced (merge_messages, archive_messages, loading) so start over
+            self._chat_index = {}
+            self._chat_source = self._messages
+            self._chat_indexed = 0
+
+        index = self._chat_index
+        for message in self._messages[self._chat_indexed:]:
+            for user in {message['from'], message['recipient']}:
+                timestamps, messages = index.setdefault(user, ([], []))
+                timestamp = message['timestamp']
+                if not timestamps or timestamps[-1] <= timestamp:
+                    timestamps.append(timestamp)
+                    messages.append(message)
+                else:
+                    position = bisect_right(timestamps, timestamp)
+                    timestamps.insert(position, timestamp)
+                    messages.insert(position, message)
+        self._chat_indexed = len(self._messages)
+        return index.get(username, ([], []))
+
+    """
+
+    message_columns returns a ds_analytics.MessageColumns snapshot of the messages, for statistics such as
+    activity histograms, top contacts and response times. It needs numpy, and raises ImportError without it.
+
+    """
+
+    def message_columns(self, include_archive: bool = False):
+        from ds_analytics import MessageColumns
+
+        return MessageColumns.from_profile(self, include_archive)
+
+    def _copy_archive(self, archive_dir) -> None:
+        # makes sure every archive segment is in archive_dir, for saving the profile somewhere else
+        if not self._archive:
+            return
+        archive_dir = Path(archive_dir)
+        archive_dir.mkdir(exist_ok=True)
+        for segment in self._archive:
+            target = archive_dir / segment['file']
+            if target.exists():
+                continue
+            if self._archive_dir is None:
+                raise DsuFileError("The profile has archived messages but was not loaded from a file.")
+            shutil.copy2(Path(self._archive_dir) / segment['file'], target)
+
+    def _read_segment(self, name: str) -> list:
+        # segments never change, so each one only has to be read once
+        if name not in self._segments:
+            if self._archive_dir is None:
+                raise DsuFileError("The profile has archived messages but was not loaded from a file.")
+            try:
+                f = open_dsu(Path(self._archive_dir) / name, 'r')
+                self._segments[name] = [DirectMessage(message=message["message"], timestamp=message["timestamp"],
+                                                      recipient=message["recipient"], frm=message["from"])
+                                        for message in json.load(f)]
+                f.close()
+            except Exception as ex:
+                raise DsuFileError("An error occurred while reading the message archive.", ex)
+        return self._segments[name]
+
     """
 
     add_post accepts a Post object as parameter and appends it to the posts list. Posts are stored in a 
@@ -136,10 +455,108 @@ class Profile:
     Profile in a different order, it is possible for the list to not be sorted by the Post.timestamp property. 
     So take caution as to how you implement your add_post code.
 
+    Every post added gets a stable id (Post.id) that can be used with get_post and del_post_by_id, and
+    that does not change when other posts are deleted. Returns the id.
+
     """
 
-    def add_post(self, post: Post) -> None:
+    def add_post(self, post: Post) -> int:
+        self._assign_post_id(post)
         self._posts.append(post)
+        insort(self._post_order, (post.get_time(), post['id']))
+        return post['id']
+
+    """
+
+    add_posts adds several Post objects at once, which is much faster than calling add_post for each of
+    them. Returns the list of their ids.
+
+    """
+
+    def add_posts(self, posts: list) -> list:
+        ids = [self._assign_post_id(post) for post in posts]
+        self._posts.extend(posts)
+        self._post_order.extend((post.get_time(), post['id']) for post in posts)
+        self._post_order.sort()
+        return ids
+
+    """
+
+    get_post returns the post with the given id, or None if there is no such post (or it was deleted).
+
+    """
+
+    def get_post(self, post_id: int):
+        return self._post_index.get(post_id)
+
+    """
+
+    get_post_page returns up to limit posts in timestamp order, newest first. To get the next (older) page,
+    pass the last post of the current page as after. With oldest_first=True, the pages go from the oldest
+    post forward instead. Finding the start of a page is a binary search, so paging is fast no matter how
+    many posts there are.
+
+    """
+
+    def get_post_page(self, limit: int = 20, after: Post = None, oldest_first: bool = False) -> list:
+        page = []
+        if oldest_first:
+            i = 0 if after is None else bisect_right(self._post_order, (after.get_time(), after['id']))
+            while i < len(self._post_order) and len(page) < limit:
+                post = self._post_index.get(self._post_order[i][1])
+                if post is not None:
+                    page.append(post)
+                i += 1
+        else:
+            i = len(self._post_order) if after is None else \
+                bisect_left(self._post_order, (after.get_time(), after['id']))
+            while i > 0 and len(page) < limit:
+                i -= 1
+                post = self._post_index.get(self._post_order[i][1])
+                if post is not None:
+                    page.append(post)
+        return page
+
+    """
+
+    get_posts_between returns the posts with start <= timestamp < end, oldest first.
+
+    """
+
+    def get_posts_between(self, start: float, end: float) -> list:
+        lo = bisect_left(self._post_order, (start,))
+        hi = bisect_left(self._post_order, (end,))
+        return [self._post_index[post_id] for _, post_id in self._post_order[lo:hi] if post_id in self._post_index]
+
+    """
+
+    del_post_by_id removes the post with the given id and returns True, or False if there is no such post.
+    The post is only marked as deleted here; it is removed from the underlying lists in bulk once deleted
+    posts make up half of them (or when the profile is saved).
+
+    """
+
+    def del_post_by_id(self, post_id: int) -> bool:
+        post = self._post_index.pop(post_id, None)
+        if post is None:
+            return False
+        self._post_tombstones += 1
+        if self._post_tombstones * 2 > len(self._posts):
+            self._compact_posts()
+        return True
+
+    def _assign_post_id(self, post: Post) -> int:
+        if post.get('id') is None or post['id'] in self._post_index:
+            post.set_id(self._next_post_id)
+        self._next_post_id = max(self._next_post_id, post['id'] + 1)
+        self._post_index[post['id']] = post
+        return post['id']
+
+    def _compact_posts(self):
+        if self._post_tombstones:
+            self._posts = [post for post in self._posts if self._post_index.get(post['id']) is post]
+            self._post_order = [key for key in self._post_order if key[1] in self._post_index]
+            self._post_tombstones = 0
 
     """
 
@@ -169,20 +586,134 @@ class Profile:
         
         self._messages.append(message)
 
+        for listener in _message_listeners:
+            listener(self, message)
+
+    """
+
+    add_msgs adds a list of DirectMessage objects at once, the same as calling add_msg for each of them but
+    without searching the users list for every message.
+
+    """
+
+    def add_msgs(self, messages: list) -> None:
+        known = set(self._users)
+        for message in messages:
+            for user in (message['recipient'], message['from']):
+                if user not in known and user != self.username:
+                    known.add(user)
+                    self._users.append(user)
+        self._messages.extend(messages)
+
+        for message in messages:
+            for listener in _message_listeners:
+                listener(self, message)
+
+    """
+
+    merge_messages reconciles the messages in the profile with a list of messages from the server (such as
+    the result of DirectMessenger.retrieve_all), adding the ones the profile doesn't have yet and matching
+    messages sent from this client to the server's copy even when their timestamps differ by up to tolerance
+    seconds. Afterwards the messages list is sorted by timestamp. Returns the ds_reconcile.ReconcileResult so
+    the caller can report what was inserted and any conflicts.
+
+    Remote messages that are already in the archive (see archive_messages) are left out, so they aren't added
+    back to the messages list. Only the segments whose time range overlaps remote messages are read.
+
+    """
+
+    def merge_messages(self, remote: list, tolerance: float = 30.0):
+        from ds_reconcile import reconcile
+
+        if self._archive and remote:
+            remote = self._drop_archived(remote, tolerance)
+        result = reconcile(self._messages, remote, tolerance)
+        self._messages = result.merged
+
+        known = set(self._users)
+        for message in result.inserted:
+            for user in (message['recipient'], message['from']):
+                if user not in known and user != self.username:
+                    known.add(user)
+                    self._users.append(user)
+            for listener in _message_listeners:
+                listener(self, message)
+
+        return result
+
+    def _drop_archived(self, remote: list, tolerance: float) -> list:
+        # removes the remote messages that match an archived message the same way reconcile matches them: same
+        # sender, recipient and text, timestamps at most tolerance seconds apart. Each archived message matches
+        # one remote message at most.
+        archived = set()
+        for segment in self._archive:
+            low, high = segment['start'] - tolerance, segment['end'] + tolerance
+            candidates = [index for index, message in enumerate(remote) if low <= message['timestamp'] <= high]
+            if not candidates:
+                continue
+            by_key = {}
+            for message in self._read_segment(segment['file']):
+                key = (message['from'], message['recipient'], message['message'])
+                by_key.setdefault(key, []).append(message['timestamp'])
+            for index in candidates:
+                if index in archived:
+                    continue
+                message = remote[index]
+                timestamps = by_key.get((message['from'], message['recipient'], message['message']))
+                if not timestamps:
+                    continue
+                closest = min(timestamps, key=lambda timestamp: abs(timestamp - message['timestamp']))
+                if abs(closest - message['timestamp']) <= tolerance:
+                    timestamps.remove(closest)
+                    archived.add(index)
+        if not archived:
+            return remote
+        return [message for index, message in enumerate(remote) if index not in archived]
+
+    """
+
+    enqueue_msg accepts a message and a recipient and adds a pending entry to the outbox. The entry is not
+    delivered here, the Outbox sender in ds_outbox.py takes care of that and moves it into the messages list
+    once the server has accepted it. Returns the new entry.
+
+    """
+
+    def enqueue_msg(self, message: str, recipient: str) -> dict:
+        entry = {'id': '%f-%d' % (time.time(), len(self._outbox)), 'message': message, 'recipient': recipient,
+                 'timestamp': time.time(), 'status': 'pending', 'attempts': 0}
+        self._outbox.append(entry)
+
+        if recipient not in self._users and recipient != self.username:
+            self._users.append(recipient)
+
+        return entry
+
+    """
+
+    get_outbox returns the list of outbox entries that have not been delivered yet. If a username is given,
+    only the entries addressed to that user are returned.
+
+    """
+
+    def get_outbox(self, username: str = None) -> list:
+        if username is None:
+            return self._outbox
+        return [entry for entry in self._outbox if entry['recipient'] == username]
+
     """
 
     del_post removes a Post at a given index and returns True if successful and False if an invalid 
     index was supplied. 
 
     To determine which post to delete you must implement your own search operation on the posts 
-    returned from the get_posts function to find the correct index.
+    returned from the get_posts function to find the correct index. Prefer del_post_by_id, which
+    doesn't depend on the position of the post.
 
     """
 
     def del_post(self, index: int) -> bool:
         try:
-            del self._posts[index]
-            return True
+            return self.del_post_by_id(self.get_posts()[index]['id'])
         except IndexError:
             return False
 
@@ -190,35 +721,57 @@ class Profile:
     
     get_posts returns the list object containing all posts that have been added to the Profile object
 
+    del_post and del_post_by_id can be used to delete posts, rather than modifying the list directly.
+
     """
 
     def get_posts(self) -> list:
+        self._compact_posts()
         return self._posts
 
     """
 
     save_profile accepts an existing dsu file to save the current instance of Profile to the file system.
 
+    The optional compression parameter is one of COMPRESSION_FORMATS ('plain', 'gzip' or 'lzma'), and level
+    is the compression level to use. If compression is not given, the profile is saved in the same format it
+    was loaded from (plain json for new profiles). The json is written through the compressor as it is
+    generated, so the whole uncompressed text is never built in memory.
+
     Example usage:
 
     profile = Profile()
     profile.save_profile('/path/to/file.dsu')
+    profile.save_profile('/path/to/file.dsu', compression='gzip', level=6)
 
     Raises DsuFileError
 
     """
 
-    def save_profile(self, path: str) -> None:
+    def save_profile(self, path: str, compression: str = None, level: int = None) -> None:
 
         # TODO: Use the function that creates the dictionary of conversations
 
         p = Path(path)
 
+        if compression is not None and compression not in COMPRESSION_FORMATS:
+            raise DsuFileError("Unknown DSU compression format", compression)
+
+        if self._partial:
+            raise DsuFileError("Only the recent messages of this profile were loaded, saving would lose the rest")
+
         if os.path.exists(p) and p.suffix == '.dsu':
             try:
-                f = open(p, 'w')
-                json.dump(self.__dict__, f)
+                # saving to another file takes the archive segments along, before the manifest pointing at
+                # them is written
+                archive_dir = p.parent / (p.stem + '.archive')
+                self._copy_archive(archive_dir)
+                if compression is not None:
+                    self._compression, self._compresslevel = compression, level
+                f = open_dsu(p, 'w', self._compression, self._compresslevel)
+                json.dump(self._serializable(), f)
                 f.close()
+                self._archive_dir = archive_dir
             except Exception as ex:
                 raise DsuFileError("An error occurred while attempting to process the DSU file.", ex)
         else:
@@ -226,7 +779,174 @@ class Profile:
 
     """
 
-    load_profile will populate the current instance of Profile with data stored in a DSU file.
+    load_profile_recent is a faster version of load_profile for showing a profile right away. It loads the
+    profile's details, contacts and outbox, but only the latest messages with each contact (up to
+    recent_limit), without reading the full message history. Use load_profile on a new Profile to get
+    everything. A profile loaded this way can't be saved.
+
+    The messages are read backwards from the end of the file, where save_profile puts them, until every contact
+    has recent_limit of them. Compressed files can't be read backwards, so for those (and files written in an
+    older layout) the whole messages list is streamed instead.
+
+    Example usage:
+
+    profile = Profile()
+    profile.load_profile_recent('/path/to/file.dsu')
+
+    Raises DsuProfileError, DsuFileError
+
+    """
+
+    def load_profile_recent(self, path: str) -> None:
+        p = Path(path)
+
+        if not (os.path.exists(p) and p.suffix == '.dsu'):
+            raise DsuFileError()
+
+        try:
+            self._compression = detect_compression(p)
+            self._archive_dir = p.parent / (p.stem + '.archive')
+            self._partial = True
+
+            self._read_details(p)
+            recent = None
+            if self._compression == 'plain':
+                try:
+                    recent = self._recent_from_end(p)
+                except ValueError:
+                    # the messages aren't at the end of the file
+                    pass
+            if recent is None:
+                recent = self._recent_from_stream(p)
+
+            seen = set()
+            for messages in recent.values():
+                for message in messages:
+                    msg = DirectMessage(message=message["message"], timestamp=message["timestamp"],
+                                        recipient=message["recipient"], frm=message["from"])
+                    # a message between two contacts (never the case in practice) shows up under both
+                    key = (msg['timestamp'], msg['from'], msg['recipient'], msg['message'])
+                    if key not in seen:
+                        seen.add(key)
+                        self._messages.append(msg)
+            self._messages.sort(key=lambda message: message['timestamp'])
+        except Exception as ex:
+            raise DsuProfileError(ex)
+
+    def _read_details(self, p: Path) -> None:
+        # reads everything before the posts and messages lists
+        with open_dsu(p, 'r') as f:
+            stream = JsonStream(f)
+            stream.expect('{')
+            while stream.peek() != '}':
+                key = stream.value()
+                stream.expect(':')
+                if key in self._last_keys:
+                    # everything needed has been read, the rest of the file is history
+                    break
+                self._load_detail(key, stream.value())
+                if stream.expect(',}') == '}':
+                    break
+
+    def _load_detail(self, key: str, value) -> None:
+        if key in ('username', 'password', 'dsuserver', 'bio', '_next_post_id'):
+            setattr(self, key, value)
+        elif key == '_users':
+            self._users = list(value)
+        elif key == '_outbox':
+            self._outbox = [dict(entry) for entry in value]
+        elif key == '_archive':
+            self._archive = list(value)
+
+    def _recent_from_end(self, p: Path) -> dict:
+        # reads the messages backwards from the end of the file until every contact has recent_limit of them
+        recent = {}
+        waiting = {user for user in self._users if user != self.username}
+        with open(p, 'rb') as f:
+            for message in reverse_items(f, '_messages'):
+                if 'message' not in message or 'recipient' not in message:
+                    raise ValueError("The dsu file doesn't end with messages")
+                message.setdefault('from', message.get('frm'))
+                for user in (message['from'], message['recipient']):
+                    if user != self.username:
+                        latest = recent.setdefault(user, [])
+                        if len(latest) < self.recent_limit:
+                            latest.append(message)
+                            if len(latest) == self.recent_limit:
+                                waiting.discard(user)
+                if not waiting:
+                    break
+        return recent
+
+    def _recent_from_stream(self, p: Path) -> dict:
+        # reads the whole file, keeping the latest recent_limit messages with each contact. The details are read
+        # again in case some of them come after the messages.
+        recent = {}
+        with open_dsu(p, 'r') as f:
+            stream = JsonStream(f)
+            stream.expect('{')
+            while stream.peek() != '}':
+                key = stream.value()
+                stream.expect(':')
+                if key == '_messages':
+                    for message in stream.items():
+                        for user in (message['from'], message['recipient']):
+                            if user != self.username:
+                                recent.setdefault(user, deque(maxlen=self.recent_limit)).append(message)
+                else:
+                    self._load_detail(key, stream.value())
+                if stream.expect(',}') == '}':
+                    break
+        return recent
+
+    """
+
+    copy returns a new Profile with the same data, whose lists can be changed without affecting this one. The
+    posts and messages themselves are shared, so they must never be changed once added (replace them instead);
+    outbox entries are copied since the outbox sender updates them in place.
+
+    """
+
+    def copy(self):
+        profile = Profile.__new__(Profile)
+        profile.__dict__.update(self.__dict__)
+        profile._posts = list(self._posts)
+        profile._messages = list(self._messages)
+        profile._users = list(self._users)
+        profile._outbox = [dict(entry) for entry in self._outbox]
+        profile._archive = list(self._archive)
+        profile._segments = dict(self._segments)
+        profile._post_index = dict(self._post_index)
+        profile._post_order = list(self._post_order)
+        with self._chat_lock:
+            profile._chat_index = {user: (list(timestamps), list(messages))
+                                   for user, (timestamps, messages) in self._chat_index.items()}
+            profile._chat_source = profile._messages if self._chat_source is self._messages else None
+            profile._chat_indexed = self._chat_indexed
+        profile._chat_lock = threading.Lock()
+        return profile
+
+    """
+
+    _serializable returns the dictionary that is written to the dsu file, which is every attribute of the
+    Profile except the ones only used while the program is running.
+
+    """
+
+    def _serializable(self) -> dict:
+        self._compact_posts()
+        obj = {key: value for key, value in self.__dict__.items() if key not in self._runtime_attrs}
+
+        ordered = {key: obj.pop(key) for key in self._key_order if key in obj}
+        last = {key: obj.pop(key) for key in self._last_keys if key in obj}
+        ordered.update(obj)
+        ordered.update(last)
+        return ordered
+
+    """
+
+    load_profile will populate the current instance of Profile with data stored in a DSU file. Plain,
+    gzip and lzma compressed files are all supported and detected automatically.
 
     Example usage: 
 
@@ -242,21 +962,34 @@ class Profile:
 
         if os.path.exists(p) and p.suffix == '.dsu':
             try:
-                f = open(p, 'r')
+                self._compression = detect_compression(p)
+                f = open_dsu(p, 'r')
                 obj = json.load(f)
                 self.username = obj['username']
                 self.password = obj['password']
                 self.dsuserver = obj['dsuserver']
                 self.bio = obj['bio']
+                posts = []
                 for post_obj in obj['_posts']:
                     post = Post(post_obj['entry'], post_obj['timestamp'])
-                    self._posts.append(post)
+                    # posts saved before ids existed are given new ones
+                    if post_obj.get('id') is not None:
+                        post.set_id(post_obj['id'])
+                    posts.append(post)
+                self._next_post_id = obj.get('_next_post_id', 1)
+                self.add_posts(posts)
                 for message in obj['_messages']:
                     msg = DirectMessage(message=message["message"], timestamp=message["timestamp"],
                                         recipient=message["recipient"], frm=message["frm"])
                     self._messages.append(msg)
                 for user in obj['_users']:
                     self._users.append(user)
+                # older dsu files were written before the outbox existed
+                for entry in obj.get('_outbox', []):
+                    self._outbox.append(dict(entry))
+                # only the manifest is read here, the archived messages are loaded when a query needs them
+                self._archive = list(obj.get('_archive', []))
+                self._archive_dir = p.parent / (p.stem + '.archive')
                 f.close()
             except Exception as ex:
                 raise DsuProfileError(ex)
@@ -0,0 +1,236 @@
+# ds_analytics.py
+#
+# A columnar view of the messages in a Profile, for fast statistics.
+#
+# Requires numpy (pip install numpy). Nothing else in the client depends on this module.
+
+import time
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, see MessageColumns
+    np = None
+
+"""
+The ds_analytics module copies the messages of a Profile into a few flat numpy arrays (one value per message,
+sorted by time) so questions like "messages per contact per day", "busiest hours" or "how fast do I reply" are
+answered with vectorized numpy operations instead of Python loops over the message dictionaries:
+
+- timestamps: float64 seconds since the epoch
+- contacts: int32 index of the other user into the usernames list (usernames are stored once)
+- outgoing: bool, True for messages sent by the profile's user
+- lengths: int32 length of the message text
+
+Building the columns walks the messages once; every query after that only touches the arrays. The view is a
+snapshot, build it again (or call extend) after messages are added to the profile.
+"""
+
+DAY = 86400
+HOUR = 3600
+
+
+def _local_offset() -> int:
+    # seconds east of UTC right now, so day and hour boundaries fall on local midnight and local hours
+    return time.localtime().tm_gmtoff
+
+
+class MessageColumns:
+    """
+    The MessageColumns class holds the columns described in the module docstring. Use from_profile to build it.
+
+    Raises ImportError if numpy isn't installed.
+
+    """
+
+    def __init__(self, username: str = None):
+        if np is None:
+            raise ImportError("ds_analytics needs numpy, install it with 'pip install numpy'")
+        self.username = username
+        self.usernames = []
+        self._codes = {}
+        self.timestamps = np.empty(0, dtype=np.float64)
+        self.contacts = np.empty(0, dtype=np.int32)
+        self.outgoing = np.empty(0, dtype=bool)
+        self.lengths = np.empty(0, dtype=np.int32)
+
+    @classmethod
+    def from_profile(cls, profile, include_archive: bool = False) -> 'MessageColumns':
+        """
+        Builds the columns from the messages of profile. If include_archive is True, messages moved to the
+        archive (Profile.archive_messages) are read from their segments and included too.
+        """
+        columns = cls(profile.username)
+        messages = profile._messages
+        if include_archive and profile._archive:
+            messages = profile.get_archived_messages() + list(messages)
+        columns.extend(messages)
+        return columns
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def _code(self, username: str) -> int:
+        code = self._codes.get(username)
+        if code is None:
+            code = self._codes[username] = len(self.usernames)
+            self.usernames.append(username)
+        return code
+
+    def extend(self, messages) -> None:
+        """Adds messages (DirectMessage or dictionaries with the same keys) to the columns."""
+        messages = list(messages)
+        if not messages:
+            return
+        me = self.username
+        count = len(messages)
+        outgoing = np.fromiter((message['from'] == me for message in messages), dtype=bool, count=count)
+        contacts = np.fromiter((self._code(message['recipient'] if message['from'] == me else message['from'])
+                                for message in messages), dtype=np.int32, count=count)
+        timestamps = np.fromiter((float(message['timestamp']) for message in messages), dtype=np.float64,
+                                 count=count)
+        lengths = np.fromiter((len(message['message'] or '') for message in messages), dtype=np.int32, count=count)
+
+        timestamps = np.concatenate((self.timestamps, timestamps))
+        # stable, so messages with the same timestamp keep the order they were added in
+        order = np.argsort(timestamps, kind='stable')
+        self.timestamps = timestamps[order]
+        self.contacts = np.concatenate((self.contacts, contacts))[order]
+        self.outgoing = np.concatenate((self.outgoing, outgoing))[order]
+        self.lengths = np.concatenate((self.lengths, lengths))[order]
+
+    def _select(self, contact: str = None, start: float = None, end: float = None, outgoing: bool = None):
+        """Returns a slice or boolean mask selecting the messages that match, usable on any column."""
+        lo = 0 if start is None else int(np.searchsorted(self.timestamps, start, 'left'))
+        hi = len(self.timestamps) if end is None else int(np.searchsorted(self.timestamps, end, 'left'))
+        if contact is None and outgoing is None:
+            return slice(lo, hi)
+        mask = np.zeros(len(self.timestamps), dtype=bool)
+        mask[lo:hi] = True
+        if contact is not None:
+            code = self._codes.get(contact)
+            if code is None:
+                return slice(0, 0)
+            mask &= self.contacts == code
+        if outgoing is not None:
+            mask &= self.outgoing == outgoing
+        return mask
+
+    """
+
+    activity_histogram counts messages in bins of bin_size seconds (a day by default) from start to end, which
+    default to the first and last message. Bins start at local midnight unless utc is True. Returns
+    (bin_starts, counts), two arrays of the same length. contact and outgoing limit the messages counted.
+
+    """
+
+    def activity_histogram(self, bin_size: float = DAY, contact: str = None, start: float = None,
+                           end: float = None, outgoing: bool = None, utc: bool = False) -> tuple:
+        timestamps = self.timestamps[self._select(contact, start, end, outgoing)]
+        if not len(timestamps) and (start is None or end is None):
+            return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64)
+        offset = 0 if utc else _local_offset()
+        first = timestamps[0] if start is None else start
+        last = timestamps[-1] if end is None else end
+        origin = np.floor((first + offset) / bin_size) * bin_size - offset
+        bins = int((last - origin) // bin_size) + 1
+        index = ((timestamps - origin) // bin_size).astype(np.int64)
+        counts = np.bincount(index[(index >= 0) & (index < bins)], minlength=bins)
+        return origin + np.arange(bins) * bin_size, counts
+
+    """
+
+    hourly_activity returns an array of 24 counts, the number of messages sent or received in each hour of
+    the day (local time unless utc is True). weekday_activity does the same for the days of the week, Monday
+    first.
+
+    """
+
+    def hourly_activity(self, contact: str = None, start: float = None, end: float = None,
+                        outgoing: bool = None, utc: bool = False):
+        timestamps = self.timestamps[self._select(contact, start, end, outgoing)]
+        offset = 0 if utc else _local_offset()
+        hours = ((timestamps + offset) // HOUR).astype(np.int64) % 24
+        return np.bincount(hours, minlength=24)
+
+    def weekday_activity(self, contact: str = None, start: float = None, end: float = None,
+                         outgoing: bool = None, utc: bool = False):
+        timestamps = self.timestamps[self._select(contact, start, end, outgoing)]
+        offset = 0 if utc else _local_offset()
+        # the epoch was a Thursday
+        days = ((timestamps + offset) // DAY).astype(np.int64) + 3
+        return np.bincount(days % 7, minlength=7)
+
+    """
+
+    contact_day_matrix returns (usernames, day_starts, counts) where counts[i, j] is the number of messages
+    with usernames[i] on the day starting at day_starts[j] (local midnight unless utc is True).
+
+    """
+
+    def contact_day_matrix(self, start: float = None, end: float = None, utc: bool = False) -> tuple:
+        selected = self._select(None, start, end)
+        timestamps = self.timestamps[selected]
+        contacts = self.contacts[selected]
+        if not len(timestamps):
+            return list(self.usernames), np.empty(0, dtype=np.float64), \
+                np.zeros((len(self.usernames), 0), dtype=np.int64)
+        offset = 0 if utc else _local_offset()
+        days = ((timestamps + offset) // DAY).astype(np.int64)
+        first = days[0]
+        width = int(days[-1] - first) + 1
+        cells = contacts.astype(np.int64) * width + (days - first)
+        counts = np.bincount(cells, minlength=len(self.usernames) * width).reshape(len(self.usernames), width)
+        return list(self.usernames), (first + np.arange(width)) * float(DAY) - offset, counts
+
+    """
+
+    top_contacts returns the k users with the most messages as a list of (username, count), busiest first.
+    start, end and outgoing limit the messages counted.
+
+    """
+
+    def top_contacts(self, k: int = 10, start: float = None, end: float = None, outgoing: bool = None) -> list:
+        counts = np.bincount(self.contacts[self._select(None, start, end, outgoing)],
+                             minlength=len(self.usernames))
+        k = min(k, int(np.count_nonzero(counts)))
+        if k <= 0:
+            return []
+        top = np.argpartition(-counts, k - 1)[:k]
+        top = top[np.argsort(-counts[top], kind='stable')]
+        return [(self.usernames[i], int(counts[i])) for i in top]
+
+    """
+
+    response_times measures how long it takes to answer: whenever a message in a conversation is followed by
+    one in the other direction, the time between them is a response time. Returns a dictionary with the
+    statistics of 'mine' (how long the profile's user takes to reply) and 'theirs' (how long contacts take),
+    each with count, mean, median, p90 and max in seconds (None when there are no replies). Gaps longer than
+    max_gap seconds are treated as a new conversation rather than a reply and are left out.
+
+    """
+
+    def response_times(self, contact: str = None, start: float = None, end: float = None,
+                       max_gap: float = DAY) -> dict:
+        selected = self._select(contact, start, end)
+        timestamps = self.timestamps[selected]
+        contacts = self.contacts[selected]
+        outgoing = self.outgoing[selected]
+
+        # group by conversation; the columns are already in time order and a stable sort keeps it that way
+        order = np.argsort(contacts, kind='stable')
+        timestamps, contacts, outgoing = timestamps[order], contacts[order], outgoing[order]
+
+        replies = (contacts[1:] == contacts[:-1]) & (outgoing[1:] != outgoing[:-1])
+        gaps = timestamps[1:] - timestamps[:-1]
+        if max_gap is not None:
+            replies &= gaps <= max_gap
+        return {'mine': _summary(gaps[replies & outgoing[1:]]),
+                'theirs': _summary(gaps[replies & ~outgoing[1:]])}
+
+
+def _summary(values) -> dict:
+    if not len(values):
+        return {'count': 0, 'mean': None, 'median': None, 'p90': None, 'max': None}
+    p50, p90 = np.percentile(values, [50, 90])
+    return {'count': int(len(values)), 'mean': float(values.mean()), 'median': float(p50), 'p90': float(p90),
+            'max': float(values.max())}
@@ -0,0 +1,233 @@
+# ds_benchmark.py
+#
+# Benchmarks for Profile, ds_protocol and DirectMessenger.
+#
+# Usage:
+#   python ds_benchmark.py run [--sizes 1000 10000 100000] [--contacts 50] [-o results.json]
+#                              [--baseline baseline.json] [--threshold 0.25]
+#   python ds_benchmark.py compression [--messages 100000]
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import ds_protocol as dsp
+from Profile import Profile, COMPRESSION_FORMATS
+from ds_messenger import DirectMessage, DirectMessenger
+from ds_server import DspServer
+
+"""
+The ds_benchmark module generates synthetic profiles and times the hot paths of the client: saving and loading
+profiles, adding and looking up messages, encoding and decoding DSP messages, and full DirectMessenger request
+cycles against a local stand-in server (ds_server.py).
+
+Results are written as json. When a baseline results file is given, every benchmark that got slower than the
+baseline by more than the threshold is reported as a regression and the program exits with status 1.
+"""
+
+
+def make_profile(messages: int = 10000, contacts: int = 50, seed: int = 32) -> Profile:
+    """Generates a Profile with the given number of messages spread randomly over the given number of contacts."""
+    rand = random.Random(seed)
+    profile = Profile(dsuserver="127.0.0.1", username="benchuser", password="benchpass")
+    users = [f"contact{i}" for i in range(contacts)]
+    words = "the quick brown fox jumps over the lazy dog hello are you there see you soon".split()
+    timestamp = 1600000000.0
+    for _ in range(messages):
+        timestamp += rand.random() * 60
+        text = ' '.join(rand.choice(words) for _ in range(rand.randint(2, 20)))
+        other = rand.choice(users)
+        if rand.random() < 0.5:
+            msg = DirectMessage(message=text, timestamp=timestamp, recipient=other, frm=profile.username)
+        else:
+            msg = DirectMessage(message=text, timestamp=timestamp, recipient=profile.username, frm=other)
+        profile._messages.append(msg)
+    profile._users = list(users)
+    return profile
+
+
+def timeit(func, repeat: int = 3, number: int = 1) -> float:
+    """Runs func number times, repeat times over, and returns the best average time per call in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_profile(size: int, contacts: int, repeat: int) -> dict:
+    """Times the Profile operations on a synthetic profile with size messages."""
+    results = {}
+    profile = make_profile(size, contacts)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.dsu')
+        open(path, 'w').close()
+
+        results[f'profile.save_profile[{size}]'] = timeit(lambda: profile.save_profile(path), repeat)
+        results[f'profile.load_profile[{size}]'] = timeit(lambda: Profile().load_profile(path), repeat)
+
+    lookups = profile._users[:10]
+    results[f'profile.get_chat_messages[{size}]'] = timeit(
+        lambda: [profile.get_chat_messages(user) for user in lookups], repeat) / len(lookups)
+
+    new = [DirectMessage(message="benchmark", timestamp=2000000000.0 + i, recipient=profile.username,
+                         frm=f"contact{i % (contacts * 2)}") for i in range(1000)]
+
+    def add_messages():
+        target = Profile(username=profile.username)
+        target._messages = list(profile._messages)
+        target._users = list(profile._users)
+        for message in new:
+            target.add_msg(message)
+    results[f'profile.add_msg[{size}]'] = timeit(add_messages, repeat) / len(new)
+    return results
+
+
+def bench_protocol(repeat: int, number: int = 10000) -> dict:
+    """Times building DSP requests and decoding server responses."""
+    response = json.dumps({"response": {"type": "ok", "messages": [
+        {"message": "hello there", "from": "contact1", "timestamp": "1600000000.5"}] * 20}})
+    response_bytes = response.encode('utf-8')
+    return {
+        'protocol.get_joinmsg': timeit(lambda: dsp.get_joinmsg("benchuser", "benchpass"), repeat, number),
+        'protocol.get_sendmsg': timeit(lambda: dsp.get_sendmsg("token", "hello there", "contact1"), repeat, number),
+        'protocol.get_rtrmsg': timeit(lambda: dsp.get_rtrmsg("token", "new"), repeat, number),
+        'protocol.load_srvmsg[str]': timeit(lambda: dsp.load_srvmsg(response), repeat, number),
+        'protocol.load_srvmsg[bytes]': timeit(lambda: dsp.load_srvmsg(response_bytes), repeat, number),
+    }
+
+
+def bench_messenger(repeat: int, number: int = 50, inbox: int = 10000) -> dict:
+    """Times complete DirectMessenger request cycles (connect, join, request) against a local DspServer."""
+    with DspServer() as server:
+        server.deliver("benchuser", [{"message": f"message {i}", "from": f"contact{i % 50}",
+                                      "timestamp": str(1600000000.0 + i)} for i in range(inbox)])
+        messenger = DirectMessenger(dsuserver=server.host, username="benchuser", password="benchpass",
+                                    port=server.port)
+        batch = [(f"batched {i}", "contact1") for i in range(100)]
+        return {
+            'messenger.send': timeit(lambda: messenger.send("hello", "contact1"), repeat, number),
+            'messenger.retrieve_new': timeit(messenger.retrieve_new, repeat, number),
+            f'messenger.retrieve_all[{inbox}]': timeit(messenger.retrieve_all, repeat),
+            'messenger.send_batch[100]': timeit(lambda: messenger.send_batch(batch), repeat) / len(batch),
+        }
+
+
+def bench_compression(profile: Profile, levels: dict = None) -> list:
+    """
+    Saves and loads the profile once for every compression format and level, returning a list of dictionaries
+    with the file size in bytes and the save and load times in seconds.
+    """
+    levels = levels or {'plain': [None], 'gzip': [1, 6, 9], 'lzma': [0, 6]}
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.dsu')
+        for compression in COMPRESSION_FORMATS:
+            for level in levels.get(compression, []):
+                open(path, 'w').close()
+
+                start = time.perf_counter()
+                profile.save_profile(path, compression=compression, level=level)
+                save_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                Profile().load_profile(path)
+                load_time = time.perf_counter() - start
+
+                results.append({'compression': compression, 'level': level, 'size': os.path.getsize(path),
+                                'save': save_time, 'load': load_time})
+    return results
+
+
+def run(sizes: list, contacts: int = 50, repeat: int = 3) -> dict:
+    """Runs every benchmark and returns the results document (see the module docstring)."""
+    results = {}
+    for size in sizes:
+        print(f"Profile benchmarks with {size} messages...", file=sys.stderr)
+        results.update(bench_profile(size, contacts, repeat))
+    print("Protocol benchmarks...", file=sys.stderr)
+    results.update(bench_protocol(repeat))
+    print("Messenger benchmarks...", file=sys.stderr)
+    results.update(bench_messenger(repeat))
+
+    return {'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                     'time': time.time(), 'sizes': sizes, 'contacts': contacts, 'repeat': repeat},
+            'results': results}
+
+
+def compare(current: dict, baseline: dict, threshold: float = 0.25) -> list:
+    """
+    Compares two results documents and returns a list of (name, baseline time, current time, ratio) for every
+    benchmark that is more than threshold (a fraction, 0.25 = 25%) slower than in the baseline.
+    """
+    regressions = []
+    for name, base in baseline['results'].items():
+        value = current['results'].get(name)
+        if value is None or not base:
+            continue
+        ratio = value / base
+        if ratio > 1 + threshold:
+            regressions.append((name, base, value, ratio))
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the Profile, protocol and messenger hot paths.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_cmd = commands.add_parser('run', help="run the benchmark suite")
+    run_cmd.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                         help="the number of messages in each synthetic profile")
+    run_cmd.add_argument('--contacts', type=int, default=50, help="the number of contacts in each profile")
+    run_cmd.add_argument('--repeat', type=int, default=3, help="how many times each benchmark is repeated")
+    run_cmd.add_argument('-o', '--output', help="write the results to this json file (default: stdout)")
+    run_cmd.add_argument('--baseline', help="a previous results file to compare against")
+    run_cmd.add_argument('--threshold', type=float, default=0.25,
+                         help="how much slower than the baseline counts as a regression (default: 0.25)")
+
+    compression_cmd = commands.add_parser('compression', help="compare the dsu compression formats")
+    compression_cmd.add_argument('--messages', type=int, default=100000)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'compression':
+        results = bench_compression(make_profile(args.messages))
+        plain = results[0]['size']
+        print(f"{'format':<8}{'level':>6}{'size (KB)':>12}{'ratio':>8}{'save (s)':>10}{'load (s)':>10}")
+        for r in results:
+            level = '-' if r['level'] is None else r['level']
+            print(f"{r['compression']:<8}{level:>6}{r['size'] / 1024:>12.1f}{plain / r['size']:>8.2f}"
+                  f"{r['save']:>10.3f}{r['load']:>10.3f}")
+        return 0
+
+    current = run(args.sizes, args.contacts, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+    else:
+        json.dump(current, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        for name, base, value, ratio in regressions:
+            print(f"REGRESSION {name}: {base * 1000:.3f} ms -> {value * 1000:.3f} ms ({ratio:.2f}x)",
+                  file=sys.stderr)
+        if regressions:
+            return 1
+        print("No regressions.", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+# ds_broadcast.py
+#
+# Sends one message to many recipients at once.
+
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ds_messenger import DirectMessenger, DirectMessage, DirectMessengerError
+
+"""
+The ds_broadcast module fans a message out to a set of recipients over several connections at the same time.
+Each worker joins the server once and then sends to one recipient after another over its connection, so the
+cost of connecting and joining is paid once per worker instead of once per recipient. A shared token bucket
+keeps the total send rate under a limit, and the number of workers caps how many connections are open at once.
+"""
+
+
+class TokenBucket:
+    """
+    The TokenBucket class limits how often something can happen: rate tokens are added every second, up to burst
+    tokens, and acquire takes one token, waiting for it if the bucket is empty. It is safe to share between threads.
+
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def broadcast(messenger: DirectMessenger, message: str, recipients, rate: float = 20.0, burst: int = 10,
+              concurrency: int = 4, profile=None, path: str = None) -> dict:
+    """
+    Sends message to every recipient and returns a dictionary of recipient -> True if the message was sent to
+    them, False if it wasn't.
+
+    :param messenger: a DirectMessenger with the sender's server, username and password.
+    :param recipients: the usernames to send to (for example profile._users). Duplicates are only sent once.
+    :param rate: the most messages sent per second, across all connections.
+    :param burst: how many messages can go out at once before the rate limit kicks in.
+    :param concurrency: the most connections open at the same time.
+    :param profile: if given, a DirectMessage for every successful send is added to it in one batch.
+    :param path: if given along with profile, the profile is saved to this dsu file afterwards.
+
+    Raises DirectMessengerError if no connection to the server could be made at all. A worker that loses its
+    connection part way leaves its remaining recipients to the other workers; recipients nobody got to are False.
+
+    """
+    recipients = list(dict.fromkeys(recipients))
+    results = {recipient: False for recipient in recipients}
+    sent = []
+    sent_lock = threading.Lock()
+    bucket = TokenBucket(rate, burst)
+    work = queue.Queue()
+    for recipient in recipients:
+        work.put(recipient)
+    connected = []
+
+    def worker():
+        # a worker that can't connect raises, so broadcast finds out when none of them could
+        session = messenger.open_session()
+        connected.append(True)
+        with session:
+            while True:
+                try:
+                    recipient = work.get_nowait()
+                except queue.Empty:
+                    return
+                bucket.acquire()
+                try:
+                    ok = session.send(message, recipient)
+                except DirectMessengerError:
+                    # this connection is gone, leave the rest of the work to the other workers
+                    return
+                results[recipient] = ok
+                if ok:
+                    with sent_lock:
+                        sent.append(DirectMessage(message=message, timestamp=time.time(), recipient=recipient,
+                                                  frm=messenger.username))
+
+    workers = max(1, min(concurrency, len(recipients)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ds-broadcast") as pool:
+        futures = [pool.submit(worker) for _ in range(workers)]
+    error = None
+    for future in futures:
+        try:
+            future.result()
+        except DirectMessengerError as ex:
+            error = ex
+    if error is not None and not connected:
+        raise error
+
+    if profile is not None and sent:
+        sent.sort(key=lambda dm: dm['timestamp'])
+        profile.add_msgs(sent)
+        if path is not None:
+            profile.save_profile(path)
+
+    return results
@@ -0,0 +1,97 @@
+# ds_connection.py
+#
+# Line framing for the sockets used to talk to the DSP server.
+
+import time
+import socket
+
+"""
+The ds_connection module splits the byte stream of a DSP connection into frames. Every request and response in
+the DSP protocol is one line of json terminated by '\\r\\n'.
+"""
+
+DELIMITER = b'\r\n'
+
+
+class FramedConnection:
+    """
+    The FramedConnection class wraps a connected socket and sends and receives whole DSP frames.
+
+    Received data goes into a single bytearray that is reused for the life of the connection: the socket writes
+    straight into it with recv_into, frames are found with bytearray.find and handed out as bytes (ready for
+    json.loads) without decoding them to text first. Several outgoing frames are joined and sent with a single
+    sendall call.
+
+    :param sock: a connected socket.
+    :param bufsize: the starting size of the receive buffer. It grows if a single frame is bigger.
+
+    """
+
+    def __init__(self, sock, bufsize: int = 64 * 1024):
+        self.sock = sock
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._start = 0  # where the unread data starts
+        self._end = 0  # where the unread data ends
+        self._scanned = 0  # everything before this (from _start) is known not to contain a delimiter
+
+    def send(self, *frames) -> None:
+        """Sends one or more frames (str or bytes, without the delimiter) in a single write."""
+        data = bytearray()
+        for frame in frames:
+            data += frame.encode('utf-8') if isinstance(frame, str) else frame
+            data += DELIMITER
+        self.sock.sendall(data)
+
+    def has_frame(self) -> bool:
+        """Returns True if a complete frame is already buffered, so read_frame won't touch the socket."""
+        return self._buf.find(b'\n', self._scanned, self._end) != -1
+
+    def read_frame(self, deadline: float = None) -> bytes:
+        """
+        Returns the next frame (without the delimiter), reading from the socket as needed. Raises ConnectionError if
+        the server closes the connection before a complete frame arrives.
+
+        deadline is an optional time.monotonic() value; socket.timeout is raised if the whole frame hasn't arrived
+        by then, no matter how many reads it takes.
+        """
+        while True:
+            index = self._buf.find(b'\n', self._scanned, self._end)
+            if index != -1:
+                end = index - 1 if index > self._start and self._buf[index - 1] == 0x0d else index
+                frame = bytes(self._view[self._start:end])
+                self._start = self._scanned = index + 1
+                if self._start == self._end:
+                    # nothing left over, start again at the front of the buffer
+                    self._start = self._end = self._scanned = 0
+                return frame
+
+            self._scanned = self._end
+            if self.recv(deadline) == 0:
+                raise ConnectionError("The server closed the connection.")
+
+    def recv(self, deadline: float = None) -> int:
+        """Reads whatever the socket has available into the buffer and returns the number of bytes read."""
+        if self._end == len(self._buf):
+            self._make_room()
+        if deadline is not None:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise socket.timeout("timed out")
+            self.sock.settimeout(left)
+        count = self.sock.recv_into(self._view[self._end:])
+        self._end += count
+        return count
+
+    def _make_room(self):
+        used = self._end - self._start
+        if self._start > 0:
+            # slide the unread data back to the front of the buffer
+            self._buf[:used] = bytes(self._view[self._start:self._end])
+        else:
+            # a single frame fills the whole buffer, so double it
+            self._view.release()
+            self._buf.extend(bytes(len(self._buf)))
+            self._view = memoryview(self._buf)
+        self._scanned -= self._start
+        self._start, self._end = 0, used
@@ -0,0 +1,129 @@
+# ds_contacts.py
+#
+# The model behind the contact list in the GUI.
+
+from bisect import bisect_left, insort
+
+"""
+The ds_contacts module keeps track of the contacts shown in the GUI's Treeview. Every contact gets an item id
+for the Treeview, so going from a selected item back to its username is a dictionary lookup, and the contacts are
+kept sorted by their most recent activity (newest first) in a sorted list, so a new message only moves one
+contact instead of re-sorting everything.
+"""
+
+
+def last_activity(messages: list) -> dict:
+    """Goes through a list of messages once and returns a dictionary of username -> newest message timestamp."""
+    latest = {}
+    for message in messages:
+        for user in (message['from'], message['recipient']):
+            if user is not None and message['timestamp'] > latest.get(user, 0):
+                latest[user] = message['timestamp']
+    return latest
+
+
+class ContactList:
+    """
+    The ContactList class stores the contacts of the active profile along with their Treeview item ids, the time
+    of their last message and how many of their messages haven't been read yet.
+
+    Iterating over a ContactList gives the usernames in display order (most recent activity first).
+
+    """
+
+    def __init__(self):
+        self._by_id = {}  # Treeview item id -> username
+        self._ids = {}  # username -> Treeview item id
+        self._last = {}  # username -> timestamp of the newest message
+        self._unread = {}  # username -> number of unread messages
+        self._order = []  # sorted list of (-timestamp, username), newest first
+        self._next_id = 0
+
+    def __contains__(self, contact) -> bool:
+        return contact in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self):
+        return (contact for _, contact in self._order)
+
+    def add(self, contact: str, timestamp: float = 0) -> int:
+        """Adds a single contact and returns its position in the list, or -1 if it is already in the list."""
+        if contact in self._ids:
+            return -1
+        self._register(contact, timestamp)
+        key = (-timestamp, contact)
+        insort(self._order, key)
+        return bisect_left(self._order, key)
+
+    def add_many(self, contacts: list, activity: dict = None) -> list:
+        """
+        Adds several contacts at once, sorting only once at the end. activity is an optional dictionary of
+        username -> last message timestamp (see last_activity). Returns the usernames that were added, in order.
+        """
+        activity = activity or {}
+        added = []
+        for contact in contacts:
+            if contact not in self._ids:
+                self._register(contact, activity.get(contact, 0))
+                added.append(contact)
+        self._order.extend((-self._last[contact], contact) for contact in added)
+        self._order.sort()
+        added = set(added)
+        return [contact for _, contact in self._order if contact in added]
+
+    def touch(self, contact: str, timestamp: float, unread: bool = False) -> int:
+        """
+        Records a new message from/to a contact (adding the contact if needed) and returns the contact's new
+        position in the list. If unread is true, the contact's unread count goes up by one.
+        """
+        if contact not in self._ids:
+            index = self.add(contact, timestamp)
+        elif timestamp > self._last[contact]:
+            del self._order[bisect_left(self._order, (-self._last[contact], contact))]
+            self._last[contact] = timestamp
+            key = (-timestamp, contact)
+            insort(self._order, key)
+            index = bisect_left(self._order, key)
+        else:
+            index = self.index(contact)
+
+        if unread:
+            self._unread[contact] += 1
+        return index
+
+    def index(self, contact: str) -> int:
+        """Returns the position of a contact in the list."""
+        return bisect_left(self._order, (-self._last[contact], contact))
+
+    def mark_read(self, contact: str) -> None:
+        if contact in self._unread:
+            self._unread[contact] = 0
+
+    def unread(self, contact: str) -> int:
+        return self._unread.get(contact, 0)
+
+    def contact_for(self, item_id: str) -> str:
+        """Returns the username for a Treeview item id."""
+        return self._by_id[item_id]
+
+    def id_for(self, contact: str) -> str:
+        """Returns the Treeview item id for a username."""
+        return self._ids[contact]
+
+    def label(self, contact: str) -> str:
+        """Returns the text shown in the Treeview for a contact, with its unread count if there is one."""
+        count = self._unread.get(contact, 0)
+        return f"{contact} ({count})" if count else contact
+
+    def clear(self) -> None:
+        self.__init__()
+
+    def _register(self, contact, timestamp):
+        item_id = f"contact{self._next_id}"
+        self._next_id += 1
+        self._by_id[item_id] = contact
+        self._ids[contact] = item_id
+        self._last[contact] = timestamp
+        self._unread[contact] = 0
@@ -0,0 +1,176 @@
+# ds_jsonstream.py
+#
+# Incremental reading of large json documents.
+
+import json
+
+"""
+The ds_jsonstream module reads a json document from a text stream a value at a time, so a program can walk
+through a large dsu file (or stop part way through it) without holding the whole document in memory. The
+standard json module can only decode complete documents.
+
+reverse_items goes the other way: it reads the array at the very end of a document backwards from the end of
+the file, so the latest items of a long list (such as the messages of a dsu file) can be read without going
+through everything before them.
+"""
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class JsonStream:
+    """Reads json values one at a time from a text stream, keeping only a small buffer in memory."""
+
+    def __init__(self, f):
+        self._f = f
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        if self._eof:
+            return False
+        chunk = self._f.read(_CHUNK_SIZE)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Skips whitespace and returns the next character without consuming it ('' at the end of the file)."""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buf) or not self._fill():
+                return self._buf[self._pos:self._pos + 1]
+
+    def expect(self, chars: str) -> str:
+        """Consumes the next character, which must be one of chars, and returns it."""
+        ch = self.peek()
+        if ch == '' or ch not in chars:
+            raise ValueError(f"Expected one of {chars!r} in json stream but found {ch!r}")
+        self._pos += 1
+        return ch
+
+    def value(self):
+        """Decodes and returns the next complete json value."""
+        self.peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # a number right at the end of the buffer might continue in the next chunk
+            if end == len(self._buf) and self._fill():
+                continue
+            self._pos = end
+            return obj
+
+    def items(self):
+        """Yields the items of the json array that starts at the current position."""
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+
+class _ReverseReader:
+    # random access to the bytes of a binary file near a position that only moves backwards, keeping only the
+    # bytes from the current position on in memory
+
+    def __init__(self, f):
+        self._f = f
+        f.seek(0, 2)
+        self._base = f.tell()  # file offset of the start of _buf
+        self._buf = b''
+
+    def at(self, pos: int) -> bytes:
+        """Returns the byte at file offset pos, or b'' before the start of the file."""
+        while pos < self._base:
+            if self._base == 0:
+                return b''
+            start = max(0, self._base - _CHUNK_SIZE)
+            self._f.seek(start)
+            self._buf = self._f.read(self._base - start) + self._buf
+            self._base = start
+        return self._buf[pos - self._base:pos - self._base + 1]
+
+    def slice(self, start: int, end: int) -> bytes:
+        self.at(start)
+        return self._buf[start - self._base:end - self._base]
+
+    def forget(self, pos: int) -> None:
+        """Drops the bytes from pos on, they won't be needed again."""
+        self._buf = self._buf[:max(0, pos - self._base)]
+
+
+def reverse_items(f, key: str = None):
+    """
+    Yields the items of the json array that ends the document in the binary file f, last item first, reading
+    the file backwards from the end. Only arrays of flat objects (no objects or arrays inside the items) are
+    supported. If key is given, the array must be the value of that key, which is checked once the start of the
+    array is reached. Raises ValueError if the end of the document doesn't look like that.
+    """
+    reader = _ReverseReader(f)
+    pos = f.tell() - 1
+
+    def skip_space(pos):
+        while reader.at(pos) in (b' ', b'\t', b'\r', b'\n'):
+            pos -= 1
+        return pos
+
+    def expect(pos, chars):
+        pos = skip_space(pos)
+        ch = reader.at(pos)
+        if ch == b'' or ch not in chars:
+            raise ValueError(f"Expected one of {chars!r} at the end of the json document but found {ch!r}")
+        return pos - 1, ch
+
+    pos, _ = expect(pos, b'}')
+    pos, _ = expect(pos, b']')
+    pos, ch = expect(pos, b'}[')
+    while ch == b'}':
+        end = pos + 2
+        in_string = False
+        while True:
+            ch = reader.at(pos)
+            if ch == b'':
+                raise ValueError("Unexpected start of the json document")
+            if ch == b'"':
+                # a quote is escaped if an odd number of backslashes comes right before it
+                slashes = 0
+                while reader.at(pos - 1 - slashes) == b'\\':
+                    slashes += 1
+                if slashes % 2 == 0:
+                    in_string = not in_string
+            elif not in_string:
+                if ch == b'{':
+                    break
+                if ch in b'{}[]':
+                    raise ValueError("Only arrays of flat objects can be read backwards")
+            pos -= 1
+        yield json.loads(reader.slice(pos, end))
+        reader.forget(pos)
+        pos, ch = expect(pos - 1, b',[')
+        if ch == b',':
+            pos, ch = expect(pos, b'}')
+
+    if key is not None:
+        pos, _ = expect(pos, b':')
+        pos = skip_space(pos)
+        end = pos + 1
+        pos, _ = expect(pos, b'"')
+        while reader.at(pos) != b'"':
+            if reader.at(pos) == b'':
+                raise ValueError("Unexpected start of the json document")
+            pos -= 1
+        if json.loads(reader.slice(pos, end)) != key:
+            raise ValueError(f"The json document doesn't end with {key!r}")
@@ -0,0 +1,274 @@
+# ds_loadgen.py
+#
+# Load generator and soak test for DSP clients.
+#
+# Usage: python ds_loadgen.py [--users 50] [--duration 60] [--mix send=0.3,new=0.65,all=0.05]
+#                             [--think 1.0] [--timeout 10] [--host HOST --port PORT] [-o report.json]
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import tracemalloc
+import multiprocessing
+import ds_protocol
+import ds_connection
+import ds_messenger
+from ds_messenger import DirectMessenger, DirectMessengerError, DEFAULT_TIMEOUT
+from ds_server import DspServer
+
+"""
+The ds_loadgen module simulates many clients using DirectMessenger at the same time, the way the GUI does:
+every virtual user polls for "new" messages, sends messages to other virtual users and now and then asks for
+"all" messages. Which action comes next is picked at random using the configured mix, with a random think time
+in between.
+
+Unless a host and port are given, a local stand-in server (ds_server.py) is started in a separate process for
+the run, so its memory isn't counted as the client's. At the end (and every report interval during long soak
+runs) it reports throughput, latency percentiles and error rates for each kind of request, along with the
+memory used by the client side, so leaks such as an ever-growing DirectMessenger.sent_messages list show up as
+steady growth.
+
+Only memory allocated by the client's own modules (or by anything they call) is counted, not the load
+generator's latency lists, which grow with every request. Memory is sampled once every virtual user has made
+its first request, at every report and at the end, and the growth is the slope through those samples.
+"""
+
+# The client's modules, and how many stack frames tracemalloc keeps so allocations made by the standard library
+# on their behalf (sockets, json) are traced back to them
+_CLIENT_MODULES = (ds_messenger, ds_protocol, ds_connection)
+_TRACE_FRAMES = 25
+
+
+class Stats:
+    """The Stats class collects the latency of every request, and every error, for each kind of request."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}  # kind -> list of seconds
+        self.errors = {}  # kind -> count
+
+    def record(self, kind: str, seconds: float, ok: bool) -> None:
+        with self._lock:
+            if ok:
+                self.latencies.setdefault(kind, []).append(seconds)
+            else:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def snapshot(self, elapsed: float) -> dict:
+        """Returns the throughput, error rate and latency percentiles (in milliseconds) of each kind of request."""
+        with self._lock:
+            latencies = {kind: sorted(values) for kind, values in self.latencies.items()}
+            errors = dict(self.errors)
+
+        report = {}
+        for kind in sorted(set(latencies) | set(errors)):
+            values = latencies.get(kind, [])
+            count = len(values) + errors.get(kind, 0)
+            report[kind] = {'requests': count, 'per_second': count / elapsed if elapsed else 0.0,
+                            'errors': errors.get(kind, 0), 'error_rate': errors.get(kind, 0) / count,
+                            'p50_ms': _percentile(values, 50), 'p90_ms': _percentile(values, 90),
+                            'p99_ms': _percentile(values, 99), 'max_ms': values[-1] * 1000 if values else None}
+        return report
+
+
+def _percentile(values: list, percent: float):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * percent / 100))] * 1000
+
+
+def parse_mix(text: str) -> dict:
+    """Turns 'send=0.3,new=0.65,all=0.05' into a dictionary of weights."""
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind.strip() not in ('send', 'new', 'all'):
+            raise ValueError(f"Unknown request kind in mix: {kind}")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+def virtual_user(number: int, users: int, host: str, port: int, mix: dict, think: float, stop: threading.Event,
+                 stats: Stats, seed: int, messengers: list, timeout: float = DEFAULT_TIMEOUT,
+                 ready: threading.Semaphore = None) -> None:
+    """Runs one virtual user until stop is set. ready is released once its first request is done."""
+    rand = random.Random(seed + number)
+    messenger = DirectMessenger(dsuserver=host, username=f"vuser{number}", password="loadtest", port=port)
+    messengers.append(messenger)
+    kinds, weights = list(mix), list(mix.values())
+
+    while not stop.is_set():
+        kind = rand.choices(kinds, weights)[0]
+        start = time.perf_counter()
+        try:
+            if kind == 'send':
+                ok = messenger.send(f"load test message {rand.random()}", f"vuser{rand.randrange(users)}",
+                                    timeout=timeout, raise_errors=True)
+            else:
+                (messenger.retrieve_new if kind == 'new' else messenger.retrieve_all)(timeout=timeout,
+                                                                                      raise_errors=True)
+                ok = True
+        except DirectMessengerError:
+            ok = False
+        stats.record(kind, time.perf_counter() - start, ok)
+        if ready is not None:
+            ready.release()
+            ready = None
+
+        if think:
+            stop.wait(rand.uniform(0, 2 * think))
+
+
+def _serve(conn):
+    server = DspServer()
+    server.start()
+    conn.send(server.port)
+    conn.recv()  # wait until the load test is over
+    conn.send(server.requests)
+    server.stop()
+
+
+def run(users: int = 50, duration: float = 60, mix: dict = None, think: float = 1.0, host: str = None,
+        port: int = None, interval: float = None, seed: int = 32, progress=None,
+        timeout: float = DEFAULT_TIMEOUT) -> dict:
+    """
+    Runs the load test and returns the final report. If interval is given, progress is called with an interim
+    report every interval seconds.
+    """
+    mix = mix or {'send': 0.3, 'new': 0.65, 'all': 0.05}
+    server = None
+    if host is None:
+        server, child = multiprocessing.Pipe()
+        multiprocessing.Process(target=_serve, args=(child,), daemon=True).start()
+        host, port = '127.0.0.1', server.recv()
+
+    tracemalloc.start(_TRACE_FRAMES)
+    stats = Stats()
+    stop = threading.Event()
+    ready = threading.Semaphore(0)
+    messengers = []
+    memory = []
+    threads = [threading.Thread(target=virtual_user, daemon=True,
+                                args=(i, users, host, port, mix, think, stop, stats, seed, messengers, timeout,
+                                      ready))
+               for i in range(users)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    def sample() -> int:
+        current = _client_memory()
+        memory.append({'seconds': time.perf_counter() - start, 'bytes': current})
+        return current
+
+    def report(final: bool) -> dict:
+        elapsed = time.perf_counter() - start
+        current = sample()
+        traced, peak = tracemalloc.get_traced_memory()
+        return {'final': final, 'elapsed': elapsed, 'users': users, 'mix': mix, 'think': think,
+                'requests': stats.snapshot(elapsed),
+                'memory': {'current_bytes': current, 'traced_bytes': traced, 'peak_bytes': peak,
+                           'growth_bytes_per_minute': _growth(memory),
+                           'sent_messages_retained': sum(len(m.sent_messages) for m in messengers)},
+                'server_requests': None}
+
+    try:
+        # the first sample is taken once every user is connected, so their setup doesn't count as growth
+        for _ in range(users):
+            if not ready.acquire(timeout=max(0.0, duration - (time.perf_counter() - start))):
+                break
+        sample()
+
+        next_report = interval
+        while True:
+            elapsed = time.perf_counter() - start
+            if elapsed >= duration:
+                break
+            wait = duration - elapsed if next_report is None else min(duration, next_report) - elapsed
+            time.sleep(max(0.0, wait))
+            if next_report is not None and time.perf_counter() - start >= next_report:
+                next_report += interval
+                if progress is not None:
+                    progress(report(False))
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=5)
+        final = report(True)
+        tracemalloc.stop()
+        if server is not None:
+            server.send('stop')
+            final['server_requests'] = server.recv()
+    return final
+
+
+def _client_memory() -> int:
+    # bytes currently allocated with one of the client's modules anywhere on the stack
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(True, module.__file__, all_frames=True) for module in _CLIENT_MODULES])
+    return sum(stat.size for stat in snapshot.statistics('filename'))
+
+
+def _growth(memory: list):
+    # least squares slope of memory use over time, in bytes per minute
+    if len(memory) < 2:
+        return None
+    n = len(memory)
+    mean_t = sum(point['seconds'] for point in memory) / n
+    mean_b = sum(point['bytes'] for point in memory) / n
+    var = sum((point['seconds'] - mean_t) ** 2 for point in memory)
+    if not var:
+        return None
+    cov = sum((point['seconds'] - mean_t) * (point['bytes'] - mean_b) for point in memory)
+    return cov / var * 60
+
+
+def print_report(report: dict, out=sys.stderr) -> None:
+    label = "FINAL" if report['final'] else "INTERIM"
+    print(f"--- {label} after {report['elapsed']:.1f}s with {report['users']} virtual users ---", file=out)
+    print(f"{'request':<8}{'count':>9}{'per sec':>10}{'errors':>8}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}"
+          f"{'max ms':>9}", file=out)
+    for kind, r in report['requests'].items():
+        def ms(value):
+            return f"{value:>9.1f}" if value is not None else f"{'-':>9}"
+        print(f"{kind:<8}{r['requests']:>9}{r['per_second']:>10.1f}{r['errors']:>8}{ms(r['p50_ms'])}"
+              f"{ms(r['p90_ms'])}{ms(r['p99_ms'])}{ms(r['max_ms'])}", file=out)
+    memory = report['memory']
+    growth = memory['growth_bytes_per_minute']
+    print(f"client memory {memory['current_bytes'] / 1024:.0f} KB (all traced {memory['traced_bytes'] / 1024:.0f} KB, "
+          f"peak {memory['peak_bytes'] / 1024:.0f} KB), "
+          f"growth {'-' if growth is None else f'{growth / 1024:.1f} KB/min'}, "
+          f"sent_messages retained {memory['sent_messages_retained']}", file=out)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Simulate many DSP clients and report latency and throughput.")
+    parser.add_argument('--users', type=int, default=50, help="number of virtual users")
+    parser.add_argument('--duration', type=float, default=60, help="how long to run, in seconds")
+    parser.add_argument('--mix', type=parse_mix, default=None,
+                        help="request mix, default send=0.3,new=0.65,all=0.05")
+    parser.add_argument('--think', type=float, default=1.0, help="average seconds between a user's requests")
+    parser.add_argument('--host', help="use this server instead of a local stand-in")
+    parser.add_argument('--port', type=int, default=3021)
+    parser.add_argument('--interval', type=float, help="print an interim report every this many seconds")
+    parser.add_argument('--seed', type=int, default=32)
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help="the most seconds a request may take before it counts as an error")
+    parser.add_argument('-o', '--output', help="write the final report to this json file")
+    args = parser.parse_args(argv)
+
+    report = run(args.users, args.duration, args.mix, args.think, args.host, args.port if args.host else None,
+                 args.interval, args.seed, progress=print_report, timeout=args.timeout)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
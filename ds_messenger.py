@@ -3,10 +3,55 @@
 # 93592684
 
 import ds_protocol as dsp
+from ds_connection import FramedConnection
 import socket
+import select
+import errno
+import os
+import threading
+import time
 import json
 
 
+"""
+DirectMessengerError is raised when the server can't be reached or rejects the login. The subclasses tell the
+reasons apart: DirectMessengerTimeout when a request ran out of time (it is also a TimeoutError),
+DirectMessengerConnectionError when the connection could not be made or was lost (it is also a ConnectionError)
+and DirectMessengerCancelled when DirectMessenger.cancel stopped the request.
+
+The DirectMessenger send and retrieve functions catch these themselves and report failure through their return
+values, unless they are called with raise_errors=True. DspSession always raises them.
+
+"""
+
+
+class DirectMessengerError(Exception):
+    pass
+
+
+class DirectMessengerTimeout(DirectMessengerError, TimeoutError):
+    pass
+
+
+class DirectMessengerConnectionError(DirectMessengerError, ConnectionError):
+    pass
+
+
+class DirectMessengerCancelled(DirectMessengerError):
+    pass
+
+
+# The total time a request may take by default, in seconds.
+DEFAULT_TIMEOUT = 10.0
+
+# The most time connecting may take, in seconds, however much of the request's time is left. None lets it use
+# the rest of the request's time, like the other steps. Set it to give up on a dead server sooner.
+CONNECT_LIMIT = None
+
+# How often a connect that is still in progress checks whether it was cancelled.
+_CANCEL_POLL = 0.05
+
+
 class DirectMessage(dict):
     """
 
@@ -57,6 +102,21 @@ class DirectMessage(dict):
     def get_time(self):
         return self._timestamp
 
+    @classmethod
+    def from_record(cls, message: str, timestamp: float, recipient: str, frm: str) -> 'DirectMessage':
+        """
+        Builds the same DirectMessage as DirectMessage(message, timestamp, recipient, frm) in about half the time,
+        by filling in the attributes and keys directly instead of going through the setters. Meant for loading
+        many stored messages at once.
+        """
+        timestamp = float(timestamp)
+        dm = cls.__new__(cls)
+        dm.__dict__ = {'_message': message, '_timestamp': timestamp, '_recipient': recipient, '_frm': frm}
+        dict.update(dm, timestamp=timestamp, message=message, recipient=recipient)
+        dict.__setitem__(dm, 'from', frm)
+        dict.__setitem__(dm, 'frm', frm)
+        return dm
+
 
 # class DirectMessageOld:
 #     """The Direct Message class stores all relevant information for a message in the following instance variables:
@@ -113,29 +173,43 @@ class DirectMessenger:
     :param port: The port used to connect to the server (default is set to the port used by the ICS 32 Distributed
      Social Website.
 
+    :param timeout: The total time in seconds each request may take, from connecting until the response has been
+     read (default DEFAULT_TIMEOUT). Every send and retrieve function also takes a timeout of its own that replaces
+     it for that call.
+
      DirectMessenger also saves all sent messages to the instance variable self.sent_messages as a List object.
 
+     Requests that are still running can be stopped from another thread with cancel().
+
 
     """
 
-    def __init__(self, dsuserver="168.235.86.101", username=None, password=None, port=3021):
+    def __init__(self, dsuserver="168.235.86.101", username=None, password=None, port=3021,
+                 timeout: float = DEFAULT_TIMEOUT):
         self.token = None
         self.dsuserver = dsuserver
         self.port = port
         self.username = username
         self.password = password
+        self.timeout = timeout
         self.join_ok = False
+        self.last_error = None
         self.sent_messages = []
+        self._inflight = set()
+        self._inflight_lock = threading.Lock()
 
-    def send(self, message, recipient) -> bool:
+    def send(self, message, recipient, timeout: float = None, raise_errors: bool = False) -> bool:
 
-        server_response = self._communicate_w_server(server=self.dsuserver, port=self.port, taip="send",
-                                                     message=message, recipient=recipient)
+        server_response = self._try(raise_errors, self._communicate_w_server, server=self.dsuserver,
+                                    port=self.port, taip="send", message=message, recipient=recipient,
+                                    timeout=timeout)
 
         # Checks to see if the message was successfully sent and returns the appropriate boolean
         # (true if message successfully sent, false if send failed.)
 
-        if server_response["response"]["message"] == "Direct message sent":
+        if server_response is None:
+            return False
+        elif server_response["response"].get("message") == "Direct message sent":
 
             # saves the message that was successfully sent to the server
             msgdict = dsp.get_msg_dict(message=message, recipient=recipient)
@@ -147,10 +221,13 @@ class DirectMessenger:
         else:
             return False
 
-    def retrieve_new(self) -> list:
+    def retrieve_new(self, timeout: float = None, raise_errors: bool = False) -> list:
         # returns a list of DirectMessage objects containing all new messages
 
-        server_response = self._communicate_w_server(server=self.dsuserver, port=self.port, taip="new")
+        server_response = self._try(raise_errors, self._communicate_w_server, server=self.dsuserver,
+                                    port=self.port, taip="new", timeout=timeout)
+        if server_response is None:
+            return []
 
         messages = server_response["response"]["messages"]
         messagelist = []
@@ -161,9 +238,12 @@ class DirectMessenger:
 
         return messagelist
 
-    def retrieve_all(self) -> list:
+    def retrieve_all(self, timeout: float = None, raise_errors: bool = False) -> list:
         # returns a list of DirectMessage objects containing all messages
-        server_response = self._communicate_w_server(server=self.dsuserver, port=self.port, taip="all")
+        server_response = self._try(raise_errors, self._communicate_w_server, server=self.dsuserver,
+                                    port=self.port, taip="all", timeout=timeout)
+        if server_response is None:
+            return []
 
         messages = server_response["response"]["messages"]
         messagelist = []
@@ -174,8 +254,34 @@ class DirectMessenger:
 
         return messagelist
 
+    def cancel(self) -> int:
+        """
+    Stops every request of this messenger that is running right now (on any thread). They raise
+    DirectMessengerCancelled, or report failure through their return value when raise_errors is off. Requests
+    started afterwards are not affected. Returns the number of requests that were cancelled.
+
+    """
+        with self._inflight_lock:
+            requests = list(self._inflight)
+        for request in requests:
+            request.cancel()
+        return len(requests)
+
+    def _try(self, raise_errors: bool, func, **kwargs):
+        # runs func, keeping the error in last_error; unless raise_errors is set a failure is printed and
+        # None is returned, which is how the send and retrieve functions have always reported it
+        self.last_error = None
+        try:
+            return func(**kwargs)
+        except DirectMessengerError as ex:
+            self.last_error = ex
+            if raise_errors:
+                raise
+            print(ex)
+            return None
+
     def _communicate_w_server(self, server: str, port: int, taip: str, message=str,
-                              recipient=str):
+                              recipient=str, timeout: float = None):
         """
     The send function joins a ds server and sends a message, bio, or both
 
@@ -185,40 +291,110 @@ class DirectMessenger:
                  or "all" to retrieve all received messages.
     :param message: the direct message you wish to send
     :param recipient: the username of the user you want to send a message to.
+    :param timeout: the total time allowed for connecting, joining and the request (default self.timeout).
+
+    Returns the server's response as a dictionary.
+
+    Raises DirectMessengerError (or one of its subclasses) if the server could not be reached in time or the join
+    failed.
 
     """
+        with _Request(self, timeout) as request:
+            client = request.connect(server, port)
+            joinresponse = self._send_to_server(client=client, username=self.username, password=self.password,
+                                                typ="join", deadline=request.phase("joining"))
+
+            if dsp.get_responseType(joinresponse) != "ok":
+                dsp.incorrectlogin_response()
+                raise DirectMessengerError("The server rejected the username or password")
+
+            token = dsp.get_token(joinresponse)
+            self.token = token
+            self.join_ok = True
+
+            deadline = request.phase("waiting for the server")
+            if taip == "send":
+                return self._send_to_server(client=client, token=token, message=message,
+                                            recipient=recipient, typ=taip, deadline=deadline)
+            return self._send_to_server(client=client, token=token, typ=taip, deadline=deadline)
+
+    def send_batch(self, messages: list, timeout: float = None):
+        """
+    Sends several direct messages over a single connection. All of the send requests are written to the socket at
+    once (pipelined) after joining, and the responses are read back in the same order.
+
+    :param messages: a list of (message, recipient) tuples.
+    :param timeout: the total time allowed for the whole batch (default self.timeout).
+
+    Returns a list with one result for each message: True if it was sent, False if the server refused it, or None if
+    it got no answer because time ran out (or the batch was cancelled or the connection lost) part way through the
+    responses. Returns None instead of a list if the server could not be reached at all, in which case none of the
+    messages should be considered sent.
+
+    """
+        if not messages:
+            return []
+
+        self.last_error = None
+        results = []
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-                client.connect((server, port))
+            with _Request(self, timeout) as request:
+                client = request.connect(self.dsuserver, self.port)
                 joinresponse = self._send_to_server(client=client, username=self.username, password=self.password,
-                                                    typ="join")
+                                                    typ="join", deadline=request.phase("joining"))
 
-                if dsp.get_responseType(joinresponse) == "ok":
-                    token = dsp.get_token(joinresponse)
-                    self.token = token
-                    self.join_ok = True
+                if dsp.get_responseType(joinresponse) != "ok":
+                    dsp.incorrectlogin_response()
+                    raise DirectMessengerError("The server rejected the username or password")
+
+                self.token = dsp.get_token(joinresponse)
+                self.join_ok = True
+
+                deadline = request.phase("sending the batch")
+                client.send(*(dsp.get_sendmsg(self.token, message, recipient) for message, recipient in messages))
+
+                for message, recipient in messages:
+                    srv_msg = client.read_frame(deadline)
+                    msg_dict = dsp.load_srvmsg(srv_msg)
+                    sent = msg_dict["response"].get("message") == "Direct message sent"
+                    if sent:
+                        msgdict = dsp.get_msg_dict(message=message, recipient=recipient)
+                        self.sent_messages.append(DirectMessage(timestamp=msgdict["timestamp"], message=message,
+                                                                recipient=recipient, frm=self.username))
+                    results.append(sent)
+        except DirectMessengerError as ex:
+            self.last_error = ex
+            if not results:
+                print("Unable to reach the server, messages will be retried:", ex)
+                return None
+            # the server stopped answering part way through, anything left over got no answer
+            print("Lost the server part way through a batch:", ex)
+            results.extend([None] * (len(messages) - len(results)))
+
+        return results
+
+    def open_session(self, timeout: float = None):
+        """
+    Connects and joins the server, returning a DspSession that can send and retrieve any number of times over the
+    same connection. Use it in a with statement so the connection is closed afterwards.
 
-                    if taip == "send":
-                        if self.join_ok:
-                            server_response = self._send_to_server(client=client, token=token, message=message,
-                                                                   recipient=recipient, typ=taip)
+    :param timeout: the time allowed for connecting and joining, and for each request after that
+     (default self.timeout).
 
-                    else:
-                        server_response = self._send_to_server(client=client, token=token, typ=taip)
+    Raises DirectMessengerError
 
-                else:
-                    dsp.incorrectlogin_response()
-        except socket.gaierror:
-            print("Unable to connect to server, please try again with a valid IP address and Port number!")
+    """
+        return DspSession(self, timeout)
 
-        return server_response
+    def _send_to_server(self, client, username=None, password=None, token=None, message=None, recipient=None, typ=None,
+                        deadline: float = None):
 
-    def _send_to_server(self, client, username=None, password=None, token=None, message=None, recipient=None, typ=None):
+        """Sends a join message to connect and retrieve a token for the requested account.
 
-        """Sends a join message to connect and retrieve a token for the requested account."""
+    :param client: the FramedConnection to the server.
+    :param deadline: the time.monotonic() value by which the response must have arrived, or None to wait forever.
 
-        join_send = client.makefile('w')
-        join_recv = client.makefile('r')
+    """
 
         # print("client connected to {HOST} on {PORT}")
         # print()
@@ -229,11 +405,198 @@ class DirectMessenger:
         else:
             msg = dsp.get_rtrmsg(token, typ)
 
-        join_send.write(msg + '\r\n')
-        join_send.flush()
-        srv_msg = join_recv.readline()
+        client.sock.settimeout(None if deadline is None else max(deadline - time.monotonic(), 0.001))
+        client.send(msg)
+        srv_msg = client.read_frame(deadline)
         msg_dict = dsp.load_srvmsg(srv_msg)
         # print(srv_msg)
         dsp.print_rMessage(msg_dict)
 
-        return msg_dict
\ No newline at end of file
+        return msg_dict
+
+
+class _Request:
+    """
+    The _Request class tracks the time limit of one request and turns socket errors into DirectMessengerErrors.
+    Use it in a with statement: while inside, the request is registered with the messenger so that
+    DirectMessenger.cancel can stop it, and on the way out the socket is closed unless keep_open is set.
+
+    The steps of the request are started with phase: each step may use whatever is left of the total time (or
+    less, if it is given a limit), so a slow join is fine as long as the whole request is on time.
+
+    """
+
+    def __init__(self, messenger: DirectMessenger, timeout: float = None, sock=None, keep_open: bool = False):
+        self.messenger = messenger
+        self.timeout = messenger.timeout if timeout is None else timeout
+        self.expires = None if self.timeout is None else time.monotonic() + self.timeout
+        self.sock = sock
+        self.keep_open = keep_open
+        self.cancelled = False
+        self.step = "connecting to the server"
+        # the seconds the current step was given, for the error message
+        self.allowed = self.timeout
+
+    def __enter__(self):
+        with self.messenger._inflight_lock:
+            self.messenger._inflight.add(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self.messenger._inflight_lock:
+            self.messenger._inflight.discard(self)
+        if not self.keep_open:
+            self.close()
+
+        if exc_type is None or issubclass(exc_type, DirectMessengerError):
+            return False
+        if self.cancelled:
+            raise DirectMessengerCancelled(f"The request was cancelled while {self.step}") from exc
+        if issubclass(exc_type, socket.timeout):
+            raise DirectMessengerTimeout(f"Timed out while {self.step} after {self.allowed:.2g}s (the request was "
+                                         f"allowed {self.timeout:g}s)") from exc
+        if issubclass(exc_type, socket.gaierror):
+            raise DirectMessengerConnectionError(
+                "Unable to connect to server, please try again with a valid IP address and Port number!") from exc
+        if issubclass(exc_type, OSError):
+            if self.step == "connecting to the server":
+                raise DirectMessengerConnectionError(f"Unable to connect to the server: {exc}") from exc
+            raise DirectMessengerConnectionError(f"Lost connection to the server while {self.step}: {exc}") from exc
+        if issubclass(exc_type, (ValueError, KeyError)):
+            # a garbled (non json) response
+            raise DirectMessengerError(f"Invalid response from the server while {self.step}") from exc
+        return False
+
+    def phase(self, step: str, limit: float = None):
+        """
+        Starts the next step of the request and returns the time.monotonic() value it has to finish by (None if
+        there is no time limit): the end of the request, or limit seconds from now if that is sooner. Raises
+        DirectMessengerCancelled or DirectMessengerTimeout right away if the request was cancelled or is already
+        out of time.
+        """
+        self.step = step
+        if self.cancelled:
+            raise DirectMessengerCancelled(f"The request was cancelled before {step}")
+        if self.expires is None:
+            return None
+        now = time.monotonic()
+        if now >= self.expires:
+            raise DirectMessengerTimeout(f"Timed out before {step} (the request was allowed {self.timeout:g}s)")
+        deadline = self.expires if limit is None else min(self.expires, now + limit)
+        self.allowed = deadline - now
+        return deadline
+
+    def connect(self, server: str, port: int) -> FramedConnection:
+        """Connects to the server (within CONNECT_LIMIT, if set) and returns the framed connection."""
+        deadline = self.phase("connecting to the server", CONNECT_LIMIT)
+        # resolving the name can't be given a time limit, but servers are normally given as ip addresses
+        address = socket.getaddrinfo(server, port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        # connect without blocking, so the time limit and cancel are checked while waiting for the server
+        self.sock.setblocking(False)
+        error = self.sock.connect_ex(address)
+        while error in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            if self.cancelled:
+                raise DirectMessengerCancelled("The request was cancelled while connecting to the server")
+            wait = _CANCEL_POLL
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise socket.timeout("timed out")
+                wait = min(wait, left)
+            _, writable, _ = select.select([], [self.sock], [], wait)
+            if writable:
+                error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise ConnectionRefusedError(error, os.strerror(error))
+        self.sock.setblocking(True)
+        return FramedConnection(self.sock)
+
+    def cancel(self) -> None:
+        self.cancelled = True
+        if self.sock is not None:
+            try:
+                # wakes up a thread blocked reading from the socket
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self) -> None:
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+
+class DspSession:
+    """
+    The DspSession class is a single joined connection to the DSP server, for callers that make many requests in a
+    row (see DirectMessenger.open_session). Every request waits for its response before returning, for at most
+    timeout seconds (default: the messenger's timeout). DirectMessenger.cancel stops a request that is running,
+    which also closes the session.
+
+    """
+
+    def __init__(self, messenger: DirectMessenger, timeout: float = None):
+        self.messenger = messenger
+        self.timeout = timeout
+        self._sock = None
+        with _Request(messenger, timeout, keep_open=True) as request:
+            try:
+                self.connection = request.connect(messenger.dsuserver, messenger.port)
+                self._sock = request.sock
+                joinresponse = messenger._send_to_server(client=self.connection, username=messenger.username,
+                                                         password=messenger.password, typ="join",
+                                                         deadline=request.phase("joining"))
+            except BaseException:
+                request.close()
+                raise
+
+        if dsp.get_responseType(joinresponse) != "ok":
+            self.close()
+            raise DirectMessengerError("The server rejected the username or password")
+        self.token = dsp.get_token(joinresponse)
+        messenger.token = self.token
+        messenger.join_ok = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, message, recipient, timeout: float = None) -> bool:
+        """Sends a direct message and returns true if the server accepted it."""
+        response = self._request(timeout, token=self.token, message=message, recipient=recipient, typ="send")
+        return response["response"].get("message") == "Direct message sent"
+
+    def retrieve(self, taip: str = "new", timeout: float = None) -> list:
+        """Returns the "new" or "all" messages for the user as a list of DirectMessage objects."""
+        response = self._request(timeout, token=self.token, typ=taip)
+        return [DirectMessage(timestamp=message["timestamp"], message=message["message"],
+                              recipient=self.messenger.username, frm=message["from"])
+                for message in response["response"].get("messages", [])]
+
+    def close(self) -> None:
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    def _request(self, timeout: float = None, **kwargs) -> dict:
+        if self._sock is None:
+            raise DirectMessengerError("The session is closed")
+        try:
+            with _Request(self.messenger, self.timeout if timeout is None else timeout, self._sock,
+                          keep_open=True) as request:
+                return self.messenger._send_to_server(client=self.connection,
+                                                      deadline=request.phase("waiting for the server"), **kwargs)
+        except DirectMessengerError:
+            # the connection is in an unknown state (a response may still be on its way), so it can't be reused
+            self.close()
+            raise
@@ -0,0 +1,375 @@
+# ds_ndjson.py
+#
+# Streams the messages and posts in a dsu file to and from newline delimited json.
+#
+# Usage:
+#   python ds_ndjson.py export profile.dsu [-o out.ndjson] [--contact NAME] [--start TIME] [--end TIME]
+#   python ds_ndjson.py import profile.dsu [-i in.ndjson]
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from Profile import Post, open_dsu, detect_compression, DsuFileError, DsuProfileError
+from ds_jsonstream import JsonStream
+from ds_messenger import DirectMessage
+
+"""
+The ds_ndjson module moves profile data in and out of dsu files one record at a time, so even very large
+profiles can be exported and imported without loading them into a Profile.
+
+Every line of the ndjson file is a json object with a "type" key:
+
+- {"type": "profile", "username": ..., "password": ..., "dsuserver": ..., "bio": ..., ...} (first line of an export)
+  It carries every key of the dsu file that isn't a list, such as _next_post_id, so nothing is lost in a round
+  trip. Keys that only come after the records in the dsu file follow in a second "profile" line at the end.
+- {"type": "message", "message": ..., "timestamp": ..., "recipient": ..., "from": ...}
+- {"type": "post", "entry": ..., "timestamp": ..., "id": ...}
+- {"type": "user", "username": ...} for every contact, including ones without any messages
+- {"type": "outbox", "id": ..., "message": ..., "recipient": ..., ...} for every message still in the outbox
+
+Importing merges the records into an existing dsu file, skipping any message, post, contact or outbox entry
+that is already there. The records themselves are streamed, but to recognize duplicates a digest of every
+message and post (in the profile and in the import) is kept in a set, which takes roughly 70 bytes per record:
+about 70 MB to import into a profile with a million messages. Exporting uses the same small amount of memory
+however big the profile is.
+"""
+
+# The top level keys of a dsu file that hold lists. Their items are streamed one at a time.
+LIST_KEYS = ('_posts', '_messages', '_users', '_outbox', '_archive')
+
+
+def iter_dsu(path):
+    """
+    Streams the top level of a dsu file, yielding (key, value) pairs. For the keys in LIST_KEYS, one pair is
+    yielded for every item in the list instead of one for the whole list.
+    """
+    with open_dsu(path, 'r') as f:
+        stream = JsonStream(f)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            if key in LIST_KEYS and stream.peek() == '[':
+                for item in stream.items():
+                    yield key, item
+            else:
+                yield key, stream.value()
+            if stream.expect(',}') == '}':
+                return
+
+
+def iter_segment(path):
+    """Streams the messages in an archive segment written by Profile.archive_messages."""
+    with open_dsu(path, 'r') as f:
+        yield from JsonStream(f).items()
+
+
+def _to_message(obj: dict) -> DirectMessage:
+    return DirectMessage(message=obj["message"], timestamp=obj["timestamp"], recipient=obj["recipient"],
+                         frm=obj.get("from", obj.get("frm")))
+
+
+def _message_key(obj: dict) -> int:
+    raw = json.dumps([float(obj["timestamp"]), obj.get("from", obj.get("frm")), obj["recipient"], obj["message"]])
+    return int.from_bytes(hashlib.blake2b(raw.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def _post_key(obj: dict) -> int:
+    raw = json.dumps([float(obj["timestamp"]), obj["entry"]])
+    return int.from_bytes(hashlib.blake2b(raw.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def _in_range(timestamp, start, end) -> bool:
+    return (start is None or timestamp >= start) and (end is None or timestamp < end)
+
+
+def iter_records(path, contacts=None, start: float = None, end: float = None, messages=True, posts=True):
+    """
+    Streams the records of a dsu file as ndjson dictionaries (see the module docstring), including messages in
+    archive segments. contacts is an optional collection of usernames to limit the messages to; posts are left
+    out when it is given. start and end limit records to start <= timestamp < end.
+    """
+    contacts = set(contacts) if contacts else None
+    p = Path(path)
+    header = {'type': 'profile'}
+    header_sent = False
+    late = {}  # keys that come after the header was sent
+
+    for key, value in iter_dsu(p):
+        if key not in LIST_KEYS:
+            (late if header_sent else header)[key] = value
+            continue
+        if not header_sent:
+            header_sent = True
+            yield header
+
+        if key == '_posts' and posts and contacts is None:
+            if _in_range(float(value['timestamp']), start, end):
+                record = {'type': 'post', 'entry': value['entry'], 'timestamp': value['timestamp']}
+                if value.get('id') is not None:
+                    record['id'] = value['id']
+                yield record
+        elif key == '_users':
+            if contacts is None or value in contacts:
+                yield {'type': 'user', 'username': value}
+        elif key == '_outbox' and messages:
+            if _in_range(float(value['timestamp']), start, end) and \
+                    (contacts is None or value['recipient'] in contacts):
+                yield dict(value, type='outbox')
+        elif key == '_messages' and messages:
+            message = _to_message(value)
+            if _in_range(message['timestamp'], start, end) and \
+                    (contacts is None or message['from'] in contacts or message['recipient'] in contacts):
+                yield _message_record(message)
+        elif key == '_archive' and messages:
+            segment = value
+            if (start is not None and segment['end'] < start) or (end is not None and segment['start'] >= end):
+                continue
+            if contacts is not None and contacts.isdisjoint(segment['contacts']):
+                continue
+            for item in iter_segment(p.parent / (p.stem + '.archive') / segment['file']):
+                message = _to_message(item)
+                if _in_range(message['timestamp'], start, end) and \
+                        (contacts is None or message['from'] in contacts or message['recipient'] in contacts):
+                    yield _message_record(message)
+
+    if not header_sent:
+        yield header
+    if late:
+        yield dict(type='profile', **late)
+
+
+def _message_record(message: DirectMessage) -> dict:
+    return {'type': 'message', 'message': message['message'], 'timestamp': message['timestamp'],
+            'recipient': message['recipient'], 'from': message['from']}
+
+
+def export_ndjson(path, out, **filters) -> int:
+    """Writes the records of the dsu file at path to the text stream out and returns how many were written."""
+    count = 0
+    for record in iter_records(path, **filters):
+        out.write(json.dumps(record))
+        out.write('\n')
+        count += 1
+    return count
+
+
+def _read_ndjson(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as ex:
+                    raise DsuProfileError(f"Invalid json on line {number} of {path}", ex)
+
+
+def import_ndjson(path, source) -> dict:
+    """
+    Merges the records in the ndjson file source into the dsu file at path, skipping records that are already
+    in the profile. If the dsu file is empty or missing, a new profile is created from the "profile" line of the
+    ndjson file. The dsu file keeps its compression format. Returns a dictionary counting the records that were
+    added and skipped.
+
+    Raises DsuFileError, DsuProfileError
+    """
+    p = Path(path)
+    if p.suffix != '.dsu':
+        raise DsuFileError("Invalid DSU file path or type")
+
+    exists = p.exists() and p.stat().st_size > 0
+    header = {'username': None, 'password': None, 'dsuserver': None, 'bio': ''}
+    seen_messages, seen_posts, users = set(), set(), []
+    outbox_ids = set()
+
+    # First pass over the profile: remember what is already there
+    if exists:
+        try:
+            for key, value in iter_dsu(p):
+                if key not in LIST_KEYS:
+                    header[key] = value
+                elif key == '_messages':
+                    seen_messages.add(_message_key(value))
+                elif key == '_posts':
+                    seen_posts.add(_post_key(value))
+                elif key == '_users':
+                    users.append(value)
+                elif key == '_outbox':
+                    outbox_ids.add(value.get('id'))
+                elif key == '_archive':
+                    for item in iter_segment(p.parent / (p.stem + '.archive') / value['file']):
+                        seen_messages.add(_message_key(item))
+        except (ValueError, KeyError) as ex:
+            raise DsuProfileError(ex)
+    else:
+        for record in _read_ndjson(source):
+            if record.get('type') == 'profile':
+                header.update((key, value) for key, value in record.items()
+                              if key != 'type' and key not in LIST_KEYS)
+
+    # Collect the contacts (of the new messages too), so _users can be written before the messages are streamed
+    known_users = set(users)
+    counts = {'messages': 0, 'posts': 0, 'outbox': 0, 'skipped': 0}
+    for record in _read_ndjson(source):
+        if record.get('type') == 'message':
+            new = (record['from'], record['recipient'])
+        elif record.get('type') == 'user':
+            new = (record['username'],)
+        else:
+            continue
+        for user in new:
+            if user not in known_users and user != header['username'] and user is not None:
+                known_users.add(user)
+                users.append(user)
+
+    compression = detect_compression(p) if exists else 'plain'
+    fd, tmp = tempfile.mkstemp(suffix='.dsu', dir=p.parent)
+    os.close(fd)
+    try:
+        with open_dsu(tmp, 'w', compression) as out:
+            out.write('{')
+            for key, value in header.items():
+                out.write(f"{json.dumps(key)}: {json.dumps(value)}, ")
+
+            out.write('"_posts": [')
+            first = True
+            for item in _existing(p, '_posts', exists):
+                first = _write_item(out, item, first)
+            for record in _read_ndjson(source):
+                if record.get('type') == 'post':
+                    key = _post_key(record)
+                    if key in seen_posts:
+                        counts['skipped'] += 1
+                        continue
+                    seen_posts.add(key)
+                    post = Post(record['entry'], record['timestamp'])
+                    if record.get('id') is not None:
+                        # load_profile gives the post a new id if another post already has this one
+                        post.set_id(record['id'])
+                    first = _write_item(out, post, first)
+                    counts['posts'] += 1
+
+            out.write('], "_messages": [')
+            first = True
+            for item in _existing(p, '_messages', exists):
+                first = _write_item(out, item, first)
+            for record in _read_ndjson(source):
+                if record.get('type') == 'message':
+                    key = _message_key(record)
+                    if key in seen_messages:
+                        counts['skipped'] += 1
+                        continue
+                    seen_messages.add(key)
+                    first = _write_item(out, _to_message(record), first)
+                    counts['messages'] += 1
+
+            out.write(f'], "_users": {json.dumps(users)}, "_outbox": [')
+            first = True
+            for item in _existing(p, '_outbox', exists):
+                first = _write_item(out, item, first)
+            for record in _read_ndjson(source):
+                if record.get('type') == 'outbox':
+                    if record.get('id') in outbox_ids:
+                        counts['skipped'] += 1
+                        continue
+                    outbox_ids.add(record.get('id'))
+                    first = _write_item(out, {key: value for key, value in record.items() if key != 'type'}, first)
+                    counts['outbox'] += 1
+
+            out.write('], "_archive": [')
+            first = True
+            for item in _existing(p, '_archive', exists):
+                first = _write_item(out, item, first)
+            out.write(']}')
+        os.replace(tmp, p)
+    except Exception as ex:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        if isinstance(ex, (DsuFileError, DsuProfileError)):
+            raise
+        raise DsuFileError("An error occurred while importing into the DSU file.", ex)
+
+    return counts
+
+
+def _existing(p, wanted, exists):
+    if exists:
+        for key, value in iter_dsu(p):
+            if key == wanted:
+                yield value
+
+
+def _write_item(out, item, first) -> bool:
+    if not first:
+        out.write(', ')
+    json.dump(item, out)
+    return False
+
+
+def _parse_time(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream dsu profile data to and from newline delimited json.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_cmd = commands.add_parser('export', help="write the messages and posts of a profile as ndjson")
+    export_cmd.add_argument('profile', help="the dsu file to export")
+    export_cmd.add_argument('-o', '--output', default='-', help="the ndjson file to write (default: stdout)")
+    export_cmd.add_argument('--contact', action='append', help="only export messages with this user (repeatable)")
+    export_cmd.add_argument('--start', type=_parse_time, help="only export records at or after this time")
+    export_cmd.add_argument('--end', type=_parse_time, help="only export records before this time")
+    export_cmd.add_argument('--no-posts', action='store_true', help="leave posts out of the export")
+    export_cmd.add_argument('--no-messages', action='store_true', help="leave messages out of the export")
+
+    import_cmd = commands.add_parser('import', help="merge ndjson records into a profile")
+    import_cmd.add_argument('profile', help="the dsu file to merge into (created if empty or missing)")
+    import_cmd.add_argument('-i', '--input', default='-', help="the ndjson file to read (default: stdin)")
+
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'export':
+            filters = dict(contacts=args.contact, start=args.start, end=args.end,
+                           messages=not args.no_messages, posts=not args.no_posts)
+            if args.output == '-':
+                count = export_ndjson(args.profile, sys.stdout, **filters)
+            else:
+                with open(args.output, 'w', encoding='utf-8') as out:
+                    count = export_ndjson(args.profile, out, **filters)
+            print(f"Exported {count} records.", file=sys.stderr)
+        else:
+            source = args.input
+            if source == '-':
+                # the input is read more than once, so stdin is copied to a temporary file first
+                with tempfile.NamedTemporaryFile('w', suffix='.ndjson', delete=False, encoding='utf-8') as spool:
+                    for line in sys.stdin:
+                        spool.write(line)
+                source = spool.name
+            try:
+                counts = import_ndjson(args.profile, source)
+            finally:
+                if args.input == '-':
+                    os.remove(source)
+            print(f"Imported {counts['messages']} messages, {counts['posts']} posts and {counts['outbox']} outbox "
+                  f"entries, skipped {counts['skipped']} duplicates.", file=sys.stderr)
+    except (DsuFileError, DsuProfileError, OSError, ValueError) as ex:
+        print("Error:", ex, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+# ds_outbox.py
+#
+# A durable, store-and-forward queue for outgoing direct messages.
+
+import threading
+from Profile import Profile
+from ds_messenger import DirectMessenger, DirectMessage
+from ds_profile_cache import profiles
+
+"""
+The ds_outbox module keeps outgoing messages in the profile's outbox (Profile._outbox) until the DSP server has
+accepted them. Messages are written to the dsu file as soon as they are queued, so nothing is lost if the server
+is unreachable or the program is closed before they go out.
+
+Every entry in the outbox has a status:
+
+- 'pending': waiting to be sent (or waiting for the next retry)
+- 'failed': the server refused it max_attempts times, call Outbox.retry_failed to queue it again
+
+Only a refusal from the server uses up an attempt. While the server can't be reached (or doesn't answer in time)
+messages stay pending however long that lasts, and the sender keeps retrying with its backoff.
+
+Once the server accepts a message it is removed from the outbox and added to the profile's messages with add_msg,
+so a message that is in the messages list has been sent.
+"""
+
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+
+
+class Outbox:
+    """
+    The Outbox class owns the outbox of the dsu file at path and drains it with a background thread.
+
+    :param path: the dsu file holding the outbox.
+    :param batch_size: how many queued messages are pipelined over one connection.
+    :param base_delay: seconds to wait before the first retry, doubled after every failed attempt.
+    :param max_delay: the longest the sender will wait between retries.
+    :param max_attempts: how many times the server may refuse a message before it is marked 'failed'.
+
+    The profile is loaded and saved through the shared profile cache (ds_profile_cache.profiles), and Outbox.lock
+    is the cache's lock for the file. Anything else that changes the same dsu file while the sender is running
+    should do it with profiles.edit (or hold Outbox.lock), otherwise the two can overwrite each other's changes.
+
+    """
+
+    def __init__(self, path: str, dsuserver=None, port=3021, batch_size=20, base_delay=1.0, max_delay=60.0,
+                 max_attempts=8):
+        self.path = path
+        self.dsuserver = dsuserver
+        self.port = port
+        self.batch_size = batch_size
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+        self.lock = profiles.lock(path)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._delay = 0
+
+    def enqueue(self, message: str, recipient: str) -> dict:
+        """Adds a message to the outbox, saves it to the dsu file and wakes up the sender. Returns the entry."""
+        with profiles.edit(self.path) as profile:
+            entry = profile.enqueue_msg(message, recipient)
+
+        self._wake.set()
+        return entry
+
+    def enqueue_many(self, messages: list) -> list:
+        """
+        Adds every (message, recipient) pair in messages to the outbox with a single save of the dsu file and
+        wakes up the sender. Returns the entries.
+        """
+        with profiles.edit(self.path) as profile:
+            entries = [profile.enqueue_msg(message, recipient) for message, recipient in messages]
+
+        self._wake.set()
+        return entries
+
+    def retry_failed(self) -> int:
+        """Puts every 'failed' entry back into 'pending' and returns how many there were."""
+        count = 0
+        with profiles.edit(self.path) as profile:
+            for entry in profile.get_outbox():
+                if entry['status'] == FAILED:
+                    entry['status'] = PENDING
+                    entry['attempts'] = 0
+                    count += 1
+
+        self._delay = 0
+        self._wake.set()
+        return count
+
+    def start(self) -> None:
+        """Starts the background sender. Anything left in the outbox from a previous run is sent first."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="ds-outbox", daemon=True)
+        self._thread.start()
+        self._wake.set()
+
+    def stop(self, timeout=None) -> None:
+        """Stops the background sender. Pending messages stay in the dsu file."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def flush(self) -> int:
+        """
+        Sends one batch of pending messages right away and returns how many were sent. The background thread
+        calls this in a loop, but it can also be called directly (for example from a script without a sender).
+        """
+        with self.lock:
+            profile = self.profile()
+            batch = [dict(entry) for entry in profile.get_outbox() if entry['status'] == PENDING]
+            batch = batch[:self.batch_size]
+            username, password = profile.username, profile.password
+            dsuserver = self.dsuserver or profile.dsuserver
+
+        if not batch:
+            return 0
+
+        if dsuserver:
+            messenger = DirectMessenger(dsuserver=dsuserver, username=username, password=password, port=self.port)
+        else:
+            messenger = DirectMessenger(username=username, password=password, port=self.port)
+        results = messenger.send_batch([(entry['message'], entry['recipient']) for entry in batch])
+
+        if results is None:
+            # could not reach the server at all, which doesn't count against the messages
+            results = [None] * len(batch)
+
+        sent = 0
+        # edit picks up any change made to the file while we were talking to the server
+        with profiles.edit(self.path) as profile:
+            outcome = {entry['id']: ok for entry, ok in zip(batch, results)}
+            remaining = []
+            for entry in profile.get_outbox():
+                ok = outcome.get(entry['id'])
+                if ok is None:
+                    # not in this batch, or it never got an answer
+                    remaining.append(entry)
+                elif ok:
+                    profile.add_msg(DirectMessage(message=entry['message'], timestamp=entry['timestamp'],
+                                                  recipient=entry['recipient'], frm=profile.username))
+                    sent += 1
+                else:
+                    entry['attempts'] += 1
+                    if entry['attempts'] >= self.max_attempts:
+                        entry['status'] = FAILED
+                    remaining.append(entry)
+            profile._outbox = remaining
+
+        if sent:
+            self._delay = 0
+        else:
+            self._delay = min(max(self._delay * 2, self.base_delay), self.max_delay)
+        return sent
+
+    def pending_count(self) -> int:
+        """Returns the number of messages still waiting to be sent."""
+        with self.lock:
+            return sum(1 for entry in self.profile().get_outbox() if entry['status'] == PENDING)
+
+    def profile(self) -> Profile:
+        """Returns the up to date profile of the outbox's dsu file from the shared profile cache, read only."""
+        return profiles.get(self.path)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.flush()
+            except Exception as ex:
+                # keep the sender alive, the entries are still in the dsu file and will be retried
+                print("Outbox error:", ex)
+                self._delay = min(max(self._delay * 2, self.base_delay), self.max_delay)
+
+            if self._delay:
+                # back off, but wake up early if the outbox is stopped or retry_failed is called
+                self._wake.wait(self._delay)
+            elif self.pending_count() == 0:
+                # nothing left to send, sleep until something is queued
+                self._wake.wait()
+            self._wake.clear()
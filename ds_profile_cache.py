@@ -0,0 +1,170 @@
+# ds_profile_cache.py
+#
+# A process-wide cache of loaded profiles, with file locking for editing them.
+
+import os
+import threading
+from contextlib import contextmanager
+from Profile import Profile, DsuFileError
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where only threads of this process are kept apart
+    fcntl = None
+
+"""
+The ds_profile_cache module keeps one Profile per dsu file for the whole program, so the GUI, the outbox sender
+and anything else that needs the profile share it instead of each parsing the file again. Before handing out a
+cached profile the file's identity (modification time, size, inode and device) is checked with a single
+os.stat; the file is only parsed again when it was changed by something else, for example another program.
+
+Changes go through ProfileCache.edit, which holds a lock for the file while the profile is changed and saved:
+a per-file threading.RLock between threads of this program, and an advisory fcntl.flock on the dsu file
+itself between programs (on systems that have fcntl). Inside edit the profile is guaranteed to be the latest
+version on disk, so two programs adding messages to the same file can't overwrite each other's changes.
+
+A profile handed out by get is never changed afterwards: edit hands out a copy of the cached profile and only
+replaces the cached one with it once it has been saved. So the GUI can keep reading the profile it got (on the
+Tk thread) while the outbox sender or a background load edits the file, without any locking, and it picks up
+the changes with its next get. The copy has its own lists, but the messages and posts in them are the same
+objects, so code inside edit must replace a message rather than change it (as ds_reconcile does when it
+adopts the server's timestamp).
+
+Everything that saves the file should do it through edit (or call ProfileCache.saved afterwards), otherwise
+the next get will see a changed file and parse it again, which is safe, just slower.
+"""
+
+
+def _identity(path: str):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino, st.st_dev
+
+
+class ProfileCache:
+    """
+    The ProfileCache class maps the path of a dsu file to the Profile loaded from it. Use the module's shared
+    instance, profiles, so the whole program sees the same Profile objects.
+
+    """
+
+    def __init__(self):
+        self._entries = {}  # real path -> (file identity, Profile)
+        self._locks = {}  # real path -> RLock
+        self._lock = threading.Lock()
+        self.loads = 0  # how many times a file was actually parsed
+        self.hits = 0
+
+    def lock(self, path: str) -> threading.RLock:
+        """Returns the lock that threads of this program hold while editing the dsu file at path."""
+        key = os.path.realpath(path)
+        with self._lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.RLock()
+            return lock
+
+    def get(self, path: str) -> Profile:
+        """
+        Returns the Profile for the dsu file at path, parsing the file only if it isn't cached or has changed
+        since. The same Profile object is returned to every caller, so treat it as read only; changes go through
+        edit.
+
+        Raises DsuFileError, DsuProfileError
+        """
+        key = os.path.realpath(path)
+        identity = _identity(key)
+        entry = self._entries.get(key)
+        if entry is not None and identity is not None and entry[0] == identity:
+            self.hits += 1
+            return entry[1]
+
+        with self.lock(key):
+            with _FileLock(key, shared=True):
+                return self._load(key)
+
+    @contextmanager
+    def edit(self, path: str, save: bool = True):
+        """
+        Locks the dsu file at path (against other threads and other programs) and yields a copy of its up to
+        date Profile. When the with block finishes the copy is saved and becomes the cached profile, and the
+        lock is released. If the block raises, or save is False, the copy is thrown away and nothing changes.
+
+        Raises DsuFileError, DsuProfileError
+        """
+        key = os.path.realpath(path)
+        with self.lock(key):
+            with _FileLock(key, shared=False):
+                profile = self._load(key).copy()
+                yield profile
+                if save:
+                    try:
+                        profile.save_profile(path)
+                    except DsuFileError:
+                        self.invalidate(key)
+                        raise
+                    self.saved(key, profile)
+
+    def saved(self, path: str, profile: Profile) -> None:
+        """Records that profile was just saved to path, so the next get doesn't parse the file again."""
+        key = os.path.realpath(path)
+        identity = _identity(key)
+        with self._lock:
+            if identity is None:
+                self._entries.pop(key, None)
+            else:
+                self._entries[key] = (identity, profile)
+
+    def invalidate(self, path: str = None) -> None:
+        """Forgets the cached profile for path, or every cached profile if path is None."""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.realpath(path), None)
+
+    def _load(self, key: str) -> Profile:
+        # called with the file locked, so it can't change between the stat and the parse
+        identity = _identity(key)
+        entry = self._entries.get(key)
+        if entry is not None and identity is not None and entry[0] == identity:
+            self.hits += 1
+            return entry[1]
+
+        profile = Profile()
+        profile.load_profile(key)
+        self.loads += 1
+        with self._lock:
+            self._entries[key] = (identity, profile)
+        return profile
+
+
+class _FileLock:
+    """An advisory lock on a whole file with fcntl.flock, or nothing where fcntl isn't available."""
+
+    def __init__(self, path: str, shared: bool):
+        self.path = path
+        self.shared = shared
+        self._fd = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            try:
+                self._fd = os.open(self.path, os.O_RDONLY)
+            except OSError:
+                # a missing file is reported by load_profile
+                return self
+            fcntl.flock(self._fd, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+# The cache shared by the whole program
+profiles = ProfileCache()
@@ -44,7 +44,8 @@ def get_joinmsg(username, password)->str:
 
 
 def load_srvmsg(srv_msg)->dict:
-    """Loads the server's response from json into a python dictionary and returns it."""
+    """Loads the server's response from json into a python dictionary and returns it. srv_msg can be a str or the
+    raw bytes of the frame."""
     return json.loads(srv_msg)
 
 
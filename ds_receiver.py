@@ -0,0 +1,283 @@
+# ds_receiver.py
+#
+# Event driven delivery of incoming direct messages over a persistent connection.
+
+import math
+import time
+import selectors
+import ds_protocol as dsp
+from ds_messenger import DirectMessenger, DirectMessage, DirectMessengerError
+
+"""
+The ds_receiver module receives direct messages without polling the server on a timer from the GUI thread.
+A MessageReceiver keeps one joined connection to the server open and never blocks on it after connecting:
+whatever the event loop it is attached to reports that the socket is readable, the receiver reads what has
+arrived and hands complete messages to its callback right away.
+
+Two event loops are supported:
+
+- TkReceiver registers the socket with the Tk event loop (tkinter's createfilehandler, available on Linux and
+  macOS), so the GUI reacts to the server like it reacts to a key press.
+- SelectorReceiver runs a selectors based loop, for scripts and other programs without a GUI.
+
+Right after joining, the receiver asks to be subscribed ("subscribe", see ds_server.py). A server that supports
+it pushes every new message the moment it arrives, so an idle client uses no CPU and sends no requests. The
+ICS 32 server only answers requests, so when it refuses the subscription the receiver falls back to sending a
+"new" request every poll_interval seconds over the same connection. That still saves connecting and joining
+every time, and the Tk thread never waits for the answer.
+
+While a request is waiting for its answer the event loop just waits for the socket to become readable; it only
+wakes up on its own to give up on an answer that took longer than the messenger's timeout.
+"""
+
+PUSH = 'push'
+POLL = 'poll'
+
+
+class MessageReceiver:
+    """
+    The MessageReceiver class owns the persistent connection. It doesn't run an event loop itself, one of
+    TkReceiver or SelectorReceiver calls handle_readable and poll for it.
+
+    :param messenger: a DirectMessenger with the server, username and password to use.
+    :param on_messages: called with a list of DirectMessage objects whenever messages arrive.
+    :param poll_interval: seconds between "new" requests when the server can't push messages.
+
+    """
+
+    def __init__(self, messenger: DirectMessenger, on_messages, poll_interval: float = 1.0):
+        self.messenger = messenger
+        self.on_messages = on_messages
+        self.poll_interval = poll_interval
+        self.mode = None  # PUSH or POLL, known once the server answered the subscription
+        self.session = None
+        self._waiting = 0  # requests sent that haven't been answered yet
+        self._sent = 0.0  # when the last request was sent
+        self._last_poll = 0.0
+
+    def connect(self, timeout: float = None) -> None:
+        """
+        Connects, joins and asks for a subscription. Connecting blocks for up to timeout seconds (default: the
+        messenger's timeout); after that nothing does.
+
+        Raises DirectMessengerError
+        """
+        self.close()
+        self.session = self.messenger.open_session(timeout)
+        self.session.connection.sock.setblocking(False)
+        self.mode = None
+        self._waiting = 0
+        self._request("subscribe")
+
+    @property
+    def connected(self) -> bool:
+        return self.session is not None and self.session._sock is not None
+
+    def fileno(self) -> int:
+        return self.session.connection.sock.fileno()
+
+    def handle_readable(self) -> None:
+        """
+        Reads whatever the server has sent and delivers every complete response. Call it when the socket is
+        readable.
+
+        Raises DirectMessengerError if the connection was lost (the receiver is closed by then).
+        """
+        connection = self.session.connection
+        try:
+            while True:
+                try:
+                    count = connection.recv()
+                except BlockingIOError:
+                    break
+                if count == 0:
+                    raise ConnectionError("The server closed the connection.")
+        except OSError as ex:
+            self.close()
+            raise DirectMessengerError("Lost connection to the server", ex)
+
+        messages = []
+        while connection.has_frame():
+            try:
+                response = dsp.load_srvmsg(connection.read_frame())["response"]
+            except (ValueError, KeyError) as ex:
+                self.close()
+                raise DirectMessengerError("Invalid response from the server", ex)
+            if self._waiting:
+                self._waiting -= 1
+            if self.mode is None:
+                # the first answer is to the subscription
+                self.mode = PUSH if response.get("type") == "ok" else POLL
+            for message in response.get("messages", []):
+                messages.append(DirectMessage(timestamp=message["timestamp"], message=message["message"],
+                                              recipient=self.messenger.username, frm=message["from"]))
+        if messages:
+            self.on_messages(messages)
+
+    def poll(self) -> float:
+        """
+        Sends a "new" request if the server can't push messages and it is time to. Returns how many seconds until
+        poll should be called again (always more than 0), or None if it only needs to be called once the socket
+        is readable: the server pushes messages, or an answer is on its way and there is no timeout.
+
+        Raises DirectMessengerError if the connection was lost or an answer is overdue (the receiver is closed).
+        """
+        now = time.monotonic()
+        if not self._waiting and self.mode == POLL and now - self._last_poll >= self.poll_interval:
+            self._last_poll = now
+            self._request("new")
+
+        if self._waiting:
+            # the answer shows up as the socket becoming readable, only its deadline needs a wake up
+            timeout = self.messenger.timeout
+            if timeout is None:
+                return None
+            remaining = self._sent + timeout - now
+            if remaining <= 0:
+                self.close()
+                raise DirectMessengerError(f"The server didn't answer within {timeout:g}s")
+            return remaining
+        if self.mode == PUSH:
+            return None
+        return self._last_poll + self.poll_interval - now
+
+    def close(self) -> None:
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def _request(self, taip: str) -> None:
+        try:
+            # requests are a few dozen bytes, they always fit in the socket's send buffer
+            self.session.connection.send(dsp.get_rtrmsg(self.session.token, taip))
+        except OSError as ex:
+            self.close()
+            raise DirectMessengerError("Lost connection to the server", ex)
+        self._waiting += 1
+        self._sent = time.monotonic()
+
+
+class TkReceiver:
+    """
+    The TkReceiver class attaches a MessageReceiver to the Tk event loop of root. on_messages is called on the
+    Tk thread. If the connection is lost, on_error is called with the DirectMessengerError and the receiver
+    tries to connect again every retry_delay seconds.
+
+    Raises DirectMessengerError from start if the first connection fails, and RuntimeError if this Tk can't
+    watch sockets (createfilehandler isn't available on Windows).
+
+    """
+
+    def __init__(self, root, messenger: DirectMessenger, on_messages, on_error=None, poll_interval: float = 1.0,
+                 retry_delay: float = 5.0, connect_timeout: float = 2.0):
+        import tkinter
+
+        if not hasattr(root.tk, 'createfilehandler'):
+            raise RuntimeError("This Tk can't watch sockets")
+        self._mask = tkinter.READABLE
+        self.root = root
+        self.receiver = MessageReceiver(messenger, on_messages, poll_interval)
+        self.on_error = on_error
+        self.retry_delay = retry_delay
+        self.connect_timeout = connect_timeout
+        self._fileno = None
+        self._job = None
+        self._running = False
+
+    def start(self) -> None:
+        self._running = True
+        self._connect()
+
+    def stop(self) -> None:
+        self._running = False
+        self._cancel_job()
+        self._unwatch()
+        self.receiver.close()
+
+    def _connect(self):
+        self.receiver.connect(self.connect_timeout)
+        self._fileno = self.receiver.fileno()
+        self.root.tk.createfilehandler(self._fileno, self._mask, self._readable)
+        # gives up on the subscription's answer if it never comes
+        self._schedule_poll()
+
+    def _readable(self, fileno, mask):
+        try:
+            self.receiver.handle_readable()
+        except DirectMessengerError as ex:
+            self._lost(ex)
+            return
+        self._schedule_poll()
+
+    def _schedule_poll(self):
+        self._cancel_job()
+        try:
+            wait = self.receiver.poll()
+        except DirectMessengerError as ex:
+            self._lost(ex)
+            return
+        if wait is not None and self._running:
+            self._job = self.root.after(max(1, math.ceil(wait * 1000)), self._schedule_poll)
+
+    def _lost(self, ex):
+        self._unwatch()
+        if self.on_error is not None:
+            self.on_error(ex)
+        if self._running:
+            self._cancel_job()
+            self._job = self.root.after(int(self.retry_delay * 1000), self._retry)
+
+    def _retry(self):
+        self._job = None
+        try:
+            self._connect()
+        except DirectMessengerError as ex:
+            self._lost(ex)
+
+    def _unwatch(self):
+        if self._fileno is not None:
+            self.root.tk.deletefilehandler(self._fileno)
+            self._fileno = None
+
+    def _cancel_job(self):
+        if self._job is not None:
+            self.root.after_cancel(self._job)
+            self._job = None
+
+
+class SelectorReceiver:
+    """
+    The SelectorReceiver class runs a MessageReceiver with a selectors loop, for programs without a GUI.
+    on_messages is called on the thread that calls run.
+
+    """
+
+    def __init__(self, messenger: DirectMessenger, on_messages, poll_interval: float = 1.0):
+        self.receiver = MessageReceiver(messenger, on_messages, poll_interval)
+        self._selector = None
+
+    def run(self, duration: float = None, stop=None) -> None:
+        """
+        Connects and handles incoming messages until duration seconds have passed, stop (a threading.Event) is
+        set or the connection is lost. A set stop is noticed within a second.
+
+        Raises DirectMessengerError
+        """
+        self.receiver.connect()
+        end = None if duration is None else time.monotonic() + duration
+        self._selector = selectors.DefaultSelector()
+        try:
+            self._selector.register(self.receiver.fileno(), selectors.EVENT_READ)
+            while stop is None or not stop.is_set():
+                if end is not None and time.monotonic() >= end:
+                    return
+                wait = self.receiver.poll()
+                timeout = 1.0 if wait is None else min(wait, 1.0)
+                if end is not None:
+                    timeout = min(timeout, end - time.monotonic())
+                if self._selector.select(max(0.0, timeout)):
+                    self.receiver.handle_readable()
+        finally:
+            self._selector.close()
+            self._selector = None
+            self.receiver.close()
@@ -0,0 +1,128 @@
+# ds_reconcile.py
+#
+# Reconciles the messages stored in a profile with the history returned by the DSP server.
+
+import copy
+from collections import namedtuple, deque
+
+"""
+The ds_reconcile module merges the messages kept locally in a Profile with the messages returned by
+DirectMessenger.retrieve_all.
+
+The same message can have two different timestamps: messages sent from this client are stored with the time
+the client sent them, while the server's copy carries the time the server recorded. reconcile treats a local and
+a remote message with the same sender, recipient and text as the same message when their timestamps are within
+a tolerance window of each other.
+
+Both sides are sorted by timestamp once and then walked together in a single pass, keeping only the local
+messages that fall inside the tolerance window of the current remote message, so the whole reconciliation is
+O(n log n) for the sort and linear after that.
+
+reconcile never changes the messages it is given. When a matched local message takes the server's timestamp,
+merged holds a copy of it with the new timestamp, since the original may be shared with other profiles (see
+ds_profile_cache) whose order and indexes depend on its timestamp.
+"""
+
+# merged: every message from both sides, sorted by timestamp
+# inserted: remote messages that were not in the profile
+# matched: (local, remote) pairs that are the same message, local as it was passed in
+# conflicts: (local, remote) pairs with the same sender, recipient and timestamp but different text
+ReconcileResult = namedtuple('ReconcileResult', ['merged', 'inserted', 'matched', 'conflicts'])
+
+
+def _key(message) -> tuple:
+    return message['from'], message['recipient'], message['message']
+
+
+def reconcile(local: list, remote: list, tolerance: float = 30.0, adopt_server_time: bool = True) -> ReconcileResult:
+    """
+    Merges the local and remote lists of messages.
+
+    :param local: the messages in the profile.
+    :param remote: the messages returned by the server.
+    :param tolerance: the most seconds apart two copies of the same message can be.
+    :param adopt_server_time: if True, matched local messages are replaced in merged by copies with the
+        server's timestamp, so the next reconciliation matches them exactly.
+
+    Nothing is dropped: a remote message that conflicts with a local one is still added to merged.
+
+    """
+    local_sorted = sorted(local, key=lambda message: message['timestamp'])
+    remote_sorted = sorted(remote, key=lambda message: message['timestamp'])
+
+    window = deque()  # the local messages that could still match, in timestamp order
+    by_key = {}  # (from, recipient, message) -> deque of unmatched local messages in the window
+    by_time = {}  # (from, recipient, timestamp) -> unmatched local message in the window
+    matched_ids = set()
+
+    inserted, matched, conflicts = [], [], []
+    next_local = 0
+
+    for remote_msg in remote_sorted:
+        timestamp = remote_msg['timestamp']
+
+        # bring in every local message that is close enough to match this one
+        while next_local < len(local_sorted) and local_sorted[next_local]['timestamp'] <= timestamp + tolerance:
+            message = local_sorted[next_local]
+            window.append(message)
+            by_key.setdefault(_key(message), deque()).append(message)
+            by_time[(message['from'], message['recipient'], message['timestamp'])] = message
+            next_local += 1
+
+        # and drop the ones that are now too old to match anything
+        while window and window[0]['timestamp'] < timestamp - tolerance:
+            _forget(window.popleft(), by_key, by_time, matched_ids)
+
+        candidates = by_key.get(_key(remote_msg))
+        while candidates and id(candidates[0]) in matched_ids:
+            candidates.popleft()
+        while candidates and candidates[0]['timestamp'] < timestamp - tolerance:
+            candidates.popleft()
+
+        if candidates:
+            local_msg = candidates.popleft()
+            if not candidates:
+                del by_key[_key(remote_msg)]
+            matched_ids.add(id(local_msg))
+            matched.append((local_msg, remote_msg))
+            continue
+
+        other = by_time.get((remote_msg['from'], remote_msg['recipient'], timestamp))
+        if other is not None and id(other) not in matched_ids and other['message'] != remote_msg['message']:
+            conflicts.append((other, remote_msg))
+        inserted.append(remote_msg)
+
+    if adopt_server_time:
+        adopted = {}  # id of a local message -> its copy with the server's timestamp
+        for local_msg, remote_msg in matched:
+            if local_msg['timestamp'] != remote_msg['timestamp']:
+                adopted[id(local_msg)] = _with_timestamp(local_msg, remote_msg['timestamp'])
+        if adopted:
+            local_sorted = [adopted.get(id(message), message) for message in local_sorted]
+
+    # both lists are already sorted runs, so this sort is close to linear
+    merged = local_sorted + inserted
+    merged.sort(key=lambda message: message['timestamp'])
+
+    return ReconcileResult(merged, inserted, matched, conflicts)
+
+
+def _with_timestamp(message, timestamp):
+    message = copy.copy(message)
+    if hasattr(message, 'set_timestamp'):
+        message.set_timestamp(timestamp)
+    else:
+        message['timestamp'] = timestamp
+    return message
+
+
+def _forget(message, by_key, by_time, matched_ids):
+    time_key = (message['from'], message['recipient'], message['timestamp'])
+    if by_time.get(time_key) is message:
+        del by_time[time_key]
+    candidates = by_key.get(_key(message))
+    if candidates and candidates[0] is message:
+        candidates.popleft()
+        if not candidates:
+            del by_key[_key(message)]
+    matched_ids.discard(id(message))
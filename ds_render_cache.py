@@ -0,0 +1,106 @@
+# ds_render_cache.py
+#
+# A size-bounded cache of conversation pages that have already been formatted for display.
+
+import threading
+from collections import OrderedDict
+
+"""
+The ds_render_cache module keeps the formatted text of recently viewed conversation pages, so switching back to
+a conversation (or scrolling back over pages that were dropped from the message viewer) does not have to format
+the same messages again. The cache is bounded by the total number of characters it holds and evicts the least
+recently used page first.
+
+Pages are cached per contact, under any hashable key that identifies the page (ds_scrollback uses its size and
+the timestamps of its first and last messages). Invalidating a contact drops every page of their conversation.
+"""
+
+
+class RenderCache:
+    """
+    The RenderCache class maps (contact, page key) to the rendered text of that page of the conversation.
+
+    :param max_chars: the most characters the cache will hold across all pages. A single page bigger than this
+    is not cached at all.
+
+    The cache is safe to use from more than one thread, since messages can be added by the outbox sender while
+    the GUI is reading.
+
+    """
+
+    def __init__(self, max_chars: int = 4_000_000):
+        self.max_chars = max_chars
+        self._entries = OrderedDict()  # (contact, page key) -> text
+        self._pages = {}  # contact -> set of page keys cached for them
+        self._size = 0
+        self._versions = {}  # contact -> number of times it has been invalidated
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, contact: str, page):
+        """Returns the cached text for the page of contact's conversation, or None if it isn't cached."""
+        with self._lock:
+            text = self._entries.get((contact, page))
+            if text is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((contact, page))
+            self.hits += 1
+            return text
+
+    def version(self, contact: str) -> int:
+        """
+        Returns a token that changes every time contact is invalidated. Take it before rendering and pass it
+        to put, so a page rendered from messages that changed in the meantime is not cached.
+        """
+        with self._lock:
+            return self._versions.get(contact, 0)
+
+    def put(self, contact: str, page, text: str, version: int = None) -> None:
+        with self._lock:
+            if version is not None and version != self._versions.get(contact, 0):
+                return
+            self._discard((contact, page))
+            if len(text) > self.max_chars:
+                return
+            self._entries[(contact, page)] = text
+            self._pages.setdefault(contact, set()).add(page)
+            self._size += len(text)
+            while self._size > self.max_chars:
+                key = next(iter(self._entries))
+                self._discard(key)
+                self.evictions += 1
+
+    def invalidate(self, *contacts) -> None:
+        """Drops every cached page of the conversations with the given contacts."""
+        with self._lock:
+            for contact in contacts:
+                for page in list(self._pages.get(contact, ())):
+                    self._discard((contact, page))
+                self._versions[contact] = self._versions.get(contact, 0) + 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._pages.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        """Returns the hit, miss and eviction counts along with the number of pages and characters cached."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / total if total else 0.0,
+                    'entries': len(self._entries), 'chars': self._size}
+
+    def _discard(self, key):
+        text = self._entries.pop(key, None)
+        if text is not None:
+            self._size -= len(text)
+            pages = self._pages.get(key[0])
+            if pages is not None:
+                pages.discard(key[1])
+                if not pages:
+                    del self._pages[key[0]]
@@ -0,0 +1,196 @@
+# ds_scrollback.py
+#
+# Keeps track of which part of a long conversation is shown in the message viewer.
+
+"""
+The ds_scrollback module lets the GUI show a conversation a few pages at a time instead of putting the whole
+history into the Text widget. A ConversationWindow starts with the latest page of messages, loads older pages
+(with Profile.get_chat_page) when the user scrolls near the top and newer ones again when they scroll back
+down. Once more than max_pages pages are loaded, the page at the far end from where the user is reading is
+dropped, so the widget never holds more than max_pages * page_size messages, no matter how long the
+conversation is.
+
+The window only deals with messages and their formatted text. Each change returns what to insert and how
+many lines to remove, and the GUI applies it to the widget. Whole pages are formatted through a
+ds_render_cache.RenderCache when one is given, so pages that are shown again aren't formatted again.
+"""
+
+
+class ConversationWindow:
+    """
+    The ConversationWindow class holds the pages of one conversation that are currently rendered, oldest first.
+
+    :param format_message: turns a message into the text shown for it (without a trailing newline). It may span
+    more than one line.
+    :param page_size: how many messages are loaded at a time.
+    :param max_pages: the most pages kept at once.
+    :param cache: a RenderCache for the formatted pages, or None to format them every time. Whoever adds
+    messages has to invalidate the contacts they belong to.
+
+    """
+
+    def __init__(self, format_message, page_size: int = 100, max_pages: int = 5, cache=None):
+        self.format_message = format_message
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.cache = cache
+        self.contact = None
+        self.pages = []  # lists of messages, oldest page first
+        self._lines = []  # the number of lines each page takes up in the widget
+        self.at_start = True  # True if the first message of the conversation is loaded
+        self.at_end = True  # True if the latest message of the conversation is loaded
+
+    def __len__(self) -> int:
+        return sum(len(page) for page in self.pages)
+
+    @property
+    def line_count(self) -> int:
+        """The number of lines the loaded pages take up in the widget."""
+        return sum(self._lines)
+
+    def clear(self) -> None:
+        """Forgets the conversation, for example when another profile is opened."""
+        self.contact = None
+        self.pages = []
+        self._lines = []
+        self.at_start = self.at_end = True
+
+    def reset(self, profile, contact: str) -> str:
+        """Loads the latest page of the conversation with contact and returns the text to show."""
+        self.contact = contact
+        page = profile.get_chat_page(contact, limit=self.page_size)
+        self.pages = [page] if page else []
+        self._lines = [_count_lines(self._render_page(page))] if page else []
+        self.at_start = len(page) < self.page_size
+        self.at_end = True
+        return self.text()
+
+    def text(self) -> str:
+        """Returns the text of every loaded page."""
+        return '\n'.join(self._render_page(page) for page in self.pages)
+
+    def load_older(self, profile) -> tuple:
+        """
+        Loads the page before the first loaded one. Returns (text, added_lines, dropped_lines): text goes at the
+        top of the widget (it ends with a newline) and takes up added_lines lines, and dropped_lines lines are
+        removed from the bottom because the newest page was dropped. Returns None at the start of the conversation.
+        """
+        if self.at_start or not self.pages:
+            return None
+        page = profile.get_chat_page(self.contact, before=self.pages[0][0]['timestamp'], limit=self.page_size)
+        if len(page) < self.page_size:
+            self.at_start = True
+        if not page:
+            return None
+
+        text = self._render_page(page)
+        self.pages.insert(0, page)
+        self._lines.insert(0, _count_lines(text))
+        dropped = 0
+        if len(self.pages) > self.max_pages:
+            self.pages.pop()
+            dropped = self._lines.pop()
+            self.at_end = False
+        return text + '\n', self._lines[0], dropped
+
+    def load_newer(self, profile) -> tuple:
+        """
+        Loads the page after the last loaded one. Returns (text, added_lines, dropped_lines): text goes at the
+        bottom of the widget (it starts with a newline) and dropped_lines lines are removed from the top because
+        the oldest page was dropped. Returns None if the latest messages are already loaded.
+        """
+        if self.at_end or not self.pages:
+            return None
+        page = self._after(profile)
+        if len(page) < self.page_size:
+            self.at_end = True
+        if not page:
+            return None
+
+        text = self._render_page(page)
+        self.pages.append(page)
+        self._lines.append(_count_lines(text))
+        dropped = 0
+        if len(self.pages) > self.max_pages:
+            self.pages.pop(0)
+            dropped = self._lines.pop(0)
+            self.at_start = False
+        return '\n' + text, self._lines[-1], dropped
+
+    def refresh(self, profile) -> tuple:
+        """
+        Adds messages that arrived since the last loaded one, when the latest messages are shown. They fill up
+        the newest page and then go into new pages, and if that makes more than max_pages pages the oldest ones
+        are dropped. Returns (text, dropped_lines): text goes at the bottom of the widget (it starts with a
+        newline unless the window was empty) and dropped_lines lines are removed from the top. Returns ('', 0) if
+        there is nothing new.
+        """
+        if not self.at_end:
+            return '', 0
+        if not self.pages:
+            return self.reset(profile, self.contact), 0
+
+        new = self._after(profile)
+        if not new:
+            return '', 0
+
+        start = 0
+        while start < len(new):
+            last = self.pages[-1]
+            # messages sharing a timestamp always stay on the same page, like get_chat_page keeps them together,
+            # so paging back with before= never skips any
+            end = start
+            while end < len(new) and new[end]['timestamp'] == last[-1]['timestamp']:
+                end += 1
+            end = max(end, start + self.page_size - len(last))
+            if end > start:
+                chunk = new[start:_page_end(new, end)]
+                last.extend(chunk)
+                self._lines[-1] += _count_lines(self._render(chunk))
+            else:
+                chunk = new[start:_page_end(new, start + self.page_size)]
+                self.pages.append(chunk)
+                self._lines.append(_count_lines(self._render(chunk)))
+            start += len(chunk)
+
+        dropped = 0
+        while len(self.pages) > self.max_pages:
+            self.pages.pop(0)
+            dropped += self._lines.pop(0)
+            self.at_start = False
+        return '\n' + self._render(new), dropped
+
+    def _after(self, profile) -> list:
+        # the next page after the last loaded message. Messages with the same timestamp as that one are asked
+        # for too (and the ones already loaded left out), so nothing that shares its timestamp is skipped.
+        last = self.pages[-1]
+        shown = [message for message in last if message['timestamp'] == last[-1]['timestamp']]
+        page = profile.get_chat_page(self.contact, after=last[-1]['timestamp'], limit=self.page_size + len(shown))
+        return [message for message in page if message not in shown]
+
+    def _render(self, messages: list) -> str:
+        return '\n'.join(self.format_message(message) for message in messages)
+
+    def _render_page(self, page: list) -> str:
+        # a page is known by its size and the messages it starts and ends with; a message added in between
+        # invalidates the contact in the cache
+        if self.cache is None or not page:
+            return self._render(page)
+        key = (len(page), page[0]['timestamp'], page[0]['message'], page[-1]['timestamp'], page[-1]['message'])
+        text = self.cache.get(self.contact, key)
+        if text is None:
+            version = self.cache.version(self.contact)
+            text = self._render(page)
+            self.cache.put(self.contact, key, text, version)
+        return text
+
+
+def _count_lines(text: str) -> int:
+    return text.count('\n') + 1
+
+
+def _page_end(messages: list, end: int) -> int:
+    # moves the end of a page past any messages with the same timestamp as the last one on it
+    while 0 < end < len(messages) and messages[end]['timestamp'] == messages[end - 1]['timestamp']:
+        end += 1
+    return end
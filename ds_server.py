@@ -0,0 +1,201 @@
+# ds_server.py
+#
+# A small local stand-in for the ICS 32 DSP server, for benchmarks and load tests.
+#
+# Usage: python ds_server.py [port]
+
+import sys
+import json
+import time
+import uuid
+import socket
+import threading
+
+"""
+The ds_server module implements just enough of the DSP protocol to exercise DirectMessenger without the real
+server: join (any username is accepted, and the first password used for it becomes its password), sending a
+direct message, and retrieving "new" or "all" messages. Everything is kept in memory.
+
+It also understands one request the real server doesn't, {"token": ..., "directmessage": "subscribe"}: the
+reply carries the unread messages like "new" does, and from then on every message sent to the user is pushed
+over that connection as soon as it arrives, as an unrequested {"response": {"type": "ok", "messages": [...]}}
+frame. ds_receiver uses it when the server supports it, and polls with "new" otherwise.
+"""
+
+
+class DspServer:
+    """
+    The DspServer class runs the stand-in server on a background thread, one thread per connection.
+
+    :param host: the address to listen on.
+    :param port: the port to listen on, 0 picks a free port (read it back from DspServer.port).
+
+    Use it as a context manager, or call start and stop.
+
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self.port = self._sock.getsockname()[1]
+
+        self._lock = threading.Lock()
+        self._passwords = {}  # username -> password
+        self._tokens = {}  # token -> username
+        self._inbox = {}  # username -> list of every message received
+        self._unread = {}  # username -> index into the inbox of the first unread message
+        self._subscribers = {}  # username -> list of (socket, send lock) that get new messages pushed
+        self._running = False
+        self.requests = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self) -> None:
+        self._sock.listen(128)
+        self._running = True
+        threading.Thread(target=self._accept, name="dsp-server", daemon=True).start()
+
+    def stop(self) -> None:
+        self._running = False
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+
+    def deliver(self, username: str, messages: list) -> None:
+        """
+        Puts messages (dictionaries with message, from and timestamp) straight into a user's inbox, pushing them
+        to the user's subscribed connections. They are only marked as read once a push has gone through, so if
+        every push fails the next "new" request still returns them.
+        """
+        with self._lock:
+            inbox = self._inbox.setdefault(username, [])
+            start = len(inbox)
+            inbox.extend(messages)
+            end = len(inbox)
+            subscribers = list(self._subscribers.get(username, []))
+
+        frame = json.dumps({"response": {"type": "ok", "messages": messages}}).encode('utf-8') + b'\r\n'
+        pushed = False
+        for client, send_lock in subscribers:
+            try:
+                with send_lock:
+                    client.sendall(frame)
+                pushed = True
+            except OSError:
+                self._unsubscribe(username, client)
+
+        if pushed:
+            with self._lock:
+                # messages before these that never reached the user (a failed push) stay unread with them
+                unread = self._unread.get(username, 0)
+                if unread >= start:
+                    self._unread[username] = max(unread, end)
+
+    def _unsubscribe(self, username, client):
+        with self._lock:
+            subscribers = self._subscribers.get(username, [])
+            subscribers[:] = [(sock, lock) for sock, lock in subscribers if sock is not client]
+
+    def _accept(self):
+        while self._running:
+            try:
+                client, _ = self._sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        token_user = None
+        buffer = b''
+        # pushed messages are sent from other connections' threads, so sends are taken in turns
+        send_lock = threading.Lock()
+        with client:
+            try:
+                while True:
+                    try:
+                        data = client.recv(65536)
+                    except OSError:
+                        return
+                    if not data:
+                        return
+                    buffer += data
+                    *lines, buffer = buffer.split(b'\r\n')
+                    replies = []
+                    for line in lines:
+                        if line.strip():
+                            reply, token_user = self._handle(line, token_user, client, send_lock)
+                            replies.append(json.dumps(reply).encode('utf-8') + b'\r\n')
+                    if replies:
+                        try:
+                            with send_lock:
+                                client.sendall(b''.join(replies))
+                        except OSError:
+                            return
+            finally:
+                if token_user is not None:
+                    self._unsubscribe(token_user, client)
+
+    def _handle(self, line: bytes, token_user, client=None, send_lock=None):
+        with self._lock:
+            self.requests += 1
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return _error("Invalid json"), token_user
+
+        if 'join' in request:
+            join = request['join']
+            username, password = join.get('username'), join.get('password')
+            with self._lock:
+                if self._passwords.setdefault(username, password) != password:
+                    return _error("Invalid password or username already taken"), token_user
+                token = uuid.uuid4().hex
+                self._tokens[token] = username
+            return {"response": {"type": "ok", "message": "Welcome to the ICS 32 Distributed Social!",
+                                 "token": token}}, username
+
+        with self._lock:
+            username = self._tokens.get(request.get('token'))
+        if username is None or username != token_user:
+            return _error("Invalid token"), token_user
+
+        dm = request.get('directmessage')
+        if isinstance(dm, dict):
+            message = {"message": dm.get('entry'), "from": username,
+                       "timestamp": str(dm.get('timestamp', time.time()))}
+            self.deliver(dm.get('recipient'), [message])
+            return {"response": {"type": "ok", "message": "Direct message sent"}}, token_user
+        elif dm in ("new", "all", "subscribe"):
+            with self._lock:
+                inbox = self._inbox.get(username, [])
+                start = 0 if dm == "all" else self._unread.get(username, 0)
+                messages = inbox[start:]
+                self._unread[username] = len(inbox)
+                if dm == "subscribe" and client is not None:
+                    self._subscribers.setdefault(username, []).append((client, send_lock))
+            return {"response": {"type": "ok", "messages": messages}}, token_user
+
+        return _error("Unknown request"), token_user
+
+
+def _error(message: str) -> dict:
+    return {"response": {"type": "error", "message": message}}
+
+
+if __name__ == "__main__":
+    server = DspServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 3021)
+    server.start()
+    print(f"DSP stand-in server listening on {server.host}:{server.port}, Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
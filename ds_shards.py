@@ -0,0 +1,345 @@
+# ds_shards.py
+#
+# Stores a profile as a small manifest plus one file per contact, so it can be loaded in parallel and saved a
+# conversation at a time.
+#
+# Usage:
+#   python ds_shards.py split profile.dsu profile.shards
+#   python ds_shards.py join profile.shards profile.dsu [--compression gzip]
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+from operator import is_, le
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from Profile import Profile, Post, DsuFileError, DsuProfileError, COMPRESSION_FORMATS
+from ds_messenger import DirectMessage
+
+"""
+The ds_shards module is an alternative to the single json document of a dsu file for profiles with a lot of
+messages. A sharded profile is a folder holding:
+
+- manifest.json: the profile's details, contacts, outbox and archive manifest, and a list of the shards
+- posts.json: the profile's posts
+- one shard per contact (c-<hash of the username>.json) with every message sent to or received from that user
+- archive/: the archive segments, if messages have been archived (see Profile.archive_messages)
+
+ShardedProfile.load reads and parses the shards in parallel with a pool of processes. The DirectMessage objects
+themselves have to be built by the loading process, which it does for each shard as soon as a worker has parsed
+it, so with enough cores loading takes about as long as building the messages (DirectMessage.from_record), not
+parsing them too. That is the floor: more cores won't bring it down further.
+
+ShardedProfile.save only rewrites the shards of conversations that changed since the profile was loaded or last
+saved, so adding a message to one conversation costs writing that conversation and the manifest, however many
+other conversations there are. Messages appended to the profile mark their conversation as changed without
+looking at any other message. Only when the messages list was replaced (merge_messages, archive_messages) are
+the messages grouped again, and then a shard counts as changed if it doesn't hold the very same message objects
+as before (messages are never changed in place, see Profile.copy). Every file is written to a temporary file first and moved into place, so an
+interrupted save never leaves half a shard behind.
+
+dsu_to_shards and shards_to_dsu convert between the two formats, so a profile can be moved back to a dsu file
+at any time. This module is a library and command line tool: the GUI, the outbox and ds_profile_cache still
+work with dsu files.
+"""
+
+MANIFEST = 'manifest.json'
+POSTS = 'posts.json'
+ARCHIVE = 'archive'
+
+# The version of the layout, written to the manifest
+FORMAT = 1
+
+# Profiles with fewer messages than this are loaded by the calling process, since starting a pool of processes
+# takes longer than parsing them
+PARALLEL_MIN = 20000
+
+
+def _contact(message: dict, username: str) -> str:
+    # the other user in the conversation, messages without one go to the '' shard
+    other = message['recipient'] if message['from'] == username else message['from']
+    return other if other is not None else ''
+
+
+def _shard_file(contact: str) -> str:
+    # usernames can hold characters that aren't allowed in file names, so the file is named after a hash
+    return 'c-' + hashlib.blake2b(contact.encode('utf-8'), digest_size=8).hexdigest() + '.json'
+
+
+def _same(old: list, new: list) -> bool:
+    # True if both lists hold the same objects in the same order
+    return len(old) == len(new) and all(map(is_, old, new))
+
+
+def _in_order(messages: list) -> bool:
+    timestamps = [message['timestamp'] for message in messages]
+    return all(map(le, timestamps, timestamps[1:]))
+
+
+def _read_shard(path) -> list:
+    # runs in the worker processes. Tuples are the cheapest thing to send back to the parent.
+    with open(path, 'r', encoding='utf-8') as f:
+        return [(record['message'], record['timestamp'], record['recipient'], record['from'])
+                for record in json.load(f)]
+
+
+def _write_json(path: Path, obj) -> None:
+    temp = path.with_name(path.name + '.tmp')
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+
+class ShardedProfile:
+    """
+    The ShardedProfile class reads and writes a profile in the sharded layout at path (a folder). Keep using
+    the same ShardedProfile for a profile between load and save, it remembers which shards are already up to
+    date. Like a dsu file, a sharded profile should only be written by one program at a time.
+
+    :param path: the folder holding the sharded profile, created by the first save.
+    :param workers: how many processes load the shards (default: one per core). 1 loads them in this process.
+
+    """
+
+    def __init__(self, path, workers: int = None):
+        self.path = Path(path)
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.written = []  # the files rewritten by the last save
+        self._shards = {}  # contact -> manifest entry of the shard on disk
+        self._saved_posts = None  # (next post id, list of posts) as last written
+        # the messages grouped by contact, kept up to date with the profile's messages list like Profile's
+        # chat index: only messages added since the last save are grouped again
+        self._groups = {}
+        self._source = None
+        self._grouped = 0
+        self._dirty = set()  # contacts whose shard doesn't match their group any more
+
+    def exists(self) -> bool:
+        return (self.path / MANIFEST).exists()
+
+    def load(self) -> Profile:
+        """
+        Loads the sharded profile and returns it as a Profile, with its messages sorted by time.
+
+        Raises DsuFileError, DsuProfileError
+        """
+        if not self.exists():
+            raise DsuFileError("Invalid sharded profile path", str(self.path))
+
+        try:
+            with open(self.path / MANIFEST, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('format') != FORMAT:
+                raise ValueError("Unsupported sharded profile format", manifest.get('format'))
+
+            # biggest shards first, so one large conversation doesn't end up being parsed last
+            shards = sorted(manifest['shards'].items(), key=lambda item: item[1]['count'], reverse=True)
+            paths = [self.path / shard['file'] for _, shard in shards]
+            total = sum(shard['count'] for _, shard in shards)
+
+            groups = {}
+            if self.workers > 1 and len(paths) > 1 and total >= PARALLEL_MIN:
+                with ProcessPoolExecutor(max_workers=min(self.workers, len(paths))) as pool:
+                    pending = pool.map(_read_shard, paths)
+                    # the posts are read here while the workers parse the shards
+                    profile = self._load_manifest(manifest)
+                    # each shard's messages are built as soon as it has been parsed, while the workers go on
+                    # with the rest
+                    for (contact, _), records in zip(shards, pending):
+                        groups[contact] = [DirectMessage.from_record(*record) for record in records]
+            else:
+                profile = self._load_manifest(manifest)
+                for contact, shard in shards:
+                    groups[contact] = [DirectMessage.from_record(*record)
+                                       for record in _read_shard(self.path / shard['file'])]
+        except (DsuFileError, DsuProfileError):
+            raise
+        except Exception as ex:
+            raise DsuProfileError(ex)
+
+        messages = [message for group in groups.values() for message in group]
+        # the shards are each in order already, which the sort takes advantage of
+        messages.sort(key=lambda message: message['timestamp'])
+        profile._messages = messages
+
+        self._groups = groups
+        self._source = messages
+        self._grouped = len(messages)
+        self._shards = dict(manifest['shards'])
+        self._dirty = set()
+        return profile
+
+    def save(self, profile: Profile) -> list:
+        """
+        Writes the profile to the sharded layout, rewriting only the shards whose conversation changed (and the
+        posts if they did), then the manifest. Returns the names of the files written.
+
+        The cost is that of the changed shards plus the manifest, unless the profile's messages list was
+        replaced since the last save, which takes one pass over the messages to group them again.
+
+        Raises DsuFileError
+        """
+        if profile._partial:
+            raise DsuFileError("Only the recent messages of this profile were loaded, saving would lose the rest")
+
+        written = []
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._group(profile)
+
+            shards = dict(self._shards)
+            for contact in self._dirty:
+                messages = self._groups.get(contact)
+                if not messages:
+                    shards.pop(contact, None)
+                    continue
+                # messages are usually in order already, only sort the shards that need it
+                if not _in_order(messages):
+                    messages.sort(key=lambda message: message['timestamp'])
+                name = _shard_file(contact)
+                _write_json(self.path / name, [{'message': message['message'], 'timestamp': message['timestamp'],
+                                                'recipient': message['recipient'], 'from': message['from']}
+                                               for message in messages])
+                written.append(name)
+                shards[contact] = {'file': name, 'count': len(messages), 'start': messages[0]['timestamp'],
+                                   'end': messages[-1]['timestamp']}
+
+            posts = (profile._next_post_id, profile.get_posts())
+            if self._saved_posts is None or posts[0] != self._saved_posts[0] \
+                    or not _same(self._saved_posts[1], posts[1]) or not (self.path / POSTS).exists():
+                _write_json(self.path / POSTS, posts[1])
+                written.append(POSTS)
+
+            profile._copy_archive(self.path / ARCHIVE)
+
+            details = {key: value for key, value in profile.__dict__.items()
+                       if key not in profile._runtime_attrs and key not in ('_messages', '_posts')}
+            _write_json(self.path / MANIFEST, {'format': FORMAT, 'profile': details, 'posts': POSTS,
+                                               'shards': shards})
+            written.append(MANIFEST)
+
+            # shards of conversations that are gone (archived, for example) are removed once the manifest no
+            # longer lists them
+            for contact in self._shards.keys() - shards.keys():
+                try:
+                    os.remove(self.path / _shard_file(contact))
+                except FileNotFoundError:
+                    pass
+        except Exception as ex:
+            raise DsuFileError("An error occurred while attempting to save the sharded profile.", ex)
+
+        self._shards = shards
+        self._dirty = set()
+        self._saved_posts = (posts[0], list(posts[1]))
+        profile._archive_dir = self.path / ARCHIVE
+        self.written = written
+        return written
+
+    def _load_manifest(self, manifest: dict) -> Profile:
+        profile = Profile()
+        for key, value in manifest['profile'].items():
+            setattr(profile, key, value)
+        profile._archive_dir = self.path / ARCHIVE
+
+        with open(self.path / manifest['posts'], 'r', encoding='utf-8') as f:
+            posts = []
+            for post_obj in json.load(f):
+                post = Post(post_obj['entry'], post_obj['timestamp'])
+                if post_obj.get('id') is not None:
+                    post.set_id(post_obj['id'])
+                posts.append(post)
+        profile.add_posts(posts)
+        self._saved_posts = (profile._next_post_id, list(profile.get_posts()))
+        return profile
+
+    def _group(self, profile: Profile) -> None:
+        if self._source is not profile._messages or self._grouped > len(profile._messages):
+            # a different profile, or its list was replaced (merge_messages, archive_messages), so group every
+            # message again and compare the groups with the old ones to find the shards that changed
+            old = self._groups
+            self._groups = {}
+            for message in profile._messages:
+                self._groups.setdefault(_contact(message, profile.username), []).append(message)
+            for contact in old.keys() | self._groups.keys():
+                if not _same(old.get(contact, []), self._groups.get(contact, [])):
+                    self._dirty.add(contact)
+            self._dirty.update(self._groups.keys() - self._shards.keys())
+            self._source = profile._messages
+            self._grouped = len(profile._messages)
+            return
+
+        for message in profile._messages[self._grouped:]:
+            contact = _contact(message, profile.username)
+            self._groups.setdefault(contact, []).append(message)
+            self._dirty.add(contact)
+        self._grouped = len(profile._messages)
+
+
+def dsu_to_shards(dsu_path, shard_path, workers: int = None) -> ShardedProfile:
+    """
+    Converts the dsu file at dsu_path to a sharded profile in the folder shard_path, copying its archive
+    segments along. The dsu file is left as it is.
+
+    Raises DsuFileError, DsuProfileError
+    """
+    profile = Profile()
+    profile.load_profile(dsu_path)
+    shards = ShardedProfile(shard_path, workers)
+    shards.save(profile)
+    return shards
+
+
+def shards_to_dsu(shard_path, dsu_path, compression: str = None, level: int = None, workers: int = None) -> None:
+    """
+    Converts the sharded profile in the folder shard_path to the dsu file at dsu_path (created if it doesn't
+    exist), copying its archive segments along. compression and level are passed to Profile.save_profile.
+
+    Raises DsuFileError, DsuProfileError
+    """
+    profile = ShardedProfile(shard_path, workers).load()
+    p = Path(dsu_path)
+    if p.suffix != '.dsu':
+        raise DsuFileError("Invalid DSU file path or type")
+    try:
+        p.touch(exist_ok=True)
+    except OSError as ex:
+        raise DsuFileError("An error occurred while attempting to process the DSU file.", ex)
+    profile.save_profile(p, compression, level)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert dsu profiles to and from the sharded layout.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    split_cmd = commands.add_parser('split', help="convert a dsu file to a sharded profile")
+    split_cmd.add_argument('profile', help="the dsu file to convert")
+    split_cmd.add_argument('shards', help="the folder to write the sharded profile to")
+
+    join_cmd = commands.add_parser('join', help="convert a sharded profile to a dsu file")
+    join_cmd.add_argument('shards', help="the folder holding the sharded profile")
+    join_cmd.add_argument('profile', help="the dsu file to write (created if missing)")
+    join_cmd.add_argument('--compression', choices=COMPRESSION_FORMATS, help="how to store the dsu file")
+
+    for command in (split_cmd, join_cmd):
+        command.add_argument('--workers', type=int, help="processes used to load shards (default: one per core)")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'split':
+            shards = dsu_to_shards(args.profile, args.shards, args.workers)
+            print(f"Wrote {len(shards.written)} files to {args.shards}.", file=sys.stderr)
+        else:
+            shards_to_dsu(args.shards, args.profile, args.compression, workers=args.workers)
+            print(f"Wrote {args.profile}.", file=sys.stderr)
+    except (DsuFileError, DsuProfileError) as ex:
+        print("Error:", ex, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
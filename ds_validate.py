@@ -0,0 +1,196 @@
+# ds_validate.py
+#
+# Validates (and optionally migrates) every dsu file in a directory tree, using all CPU cores.
+#
+# Usage: python ds_validate.py DIRECTORY [--migrate] [--compression gzip] [--workers N] [-o report.json]
+
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from pathlib import Path
+from Profile import Profile, COMPRESSION_FORMATS, open_dsu, DsuFileError, DsuProfileError
+
+"""
+The ds_validate module checks dsu files against the layout Profile.load_profile expects, so broken or outdated
+files are found by a batch job instead of by a user opening them. Files are checked in parallel with a
+multiprocessing pool, and a report with the result and timing of every file is produced.
+
+With --migrate, valid files that were written by an older version of Profile (posts without ids, no
+_next_post_id) are loaded and saved again in the current format, optionally switching their compression.
+"""
+
+_REQUIRED = {'username': (str, type(None)), 'password': (str, type(None)), 'dsuserver': (str, type(None)),
+             'bio': (str,), '_posts': (list,), '_messages': (list,), '_users': (list,)}
+_OPTIONAL = {'_outbox': (list,), '_archive': (list,), '_next_post_id': (int,)}
+_NUMBER = (int, float, str)  # message timestamps from the server are strings, DirectMessage turns them into floats
+_TIME = (int, float)  # post timestamps are used as they are, so they have to be numbers
+
+
+def validate_document(obj, archive_dir: Path = None) -> tuple:
+    """
+    Checks a decoded dsu document. Returns (errors, outdated) where errors is a list of problems that would stop
+    load_profile (or corrupt data) and outdated is True if the file should be rewritten in the current format.
+    """
+    errors = []
+    if not isinstance(obj, dict):
+        return ["the file is not a json object"], False
+
+    for key, types in _REQUIRED.items():
+        if key not in obj:
+            errors.append(f"missing '{key}'")
+        elif not isinstance(obj[key], types):
+            errors.append(f"'{key}' should be {' or '.join(t.__name__ for t in types)}")
+    for key, types in _OPTIONAL.items():
+        if key in obj and not isinstance(obj[key], types):
+            errors.append(f"'{key}' should be {' or '.join(t.__name__ for t in types)}")
+    if errors:
+        return errors, False
+
+    for i, post in enumerate(obj['_posts']):
+        if not isinstance(post, dict) or 'entry' not in post or 'timestamp' not in post:
+            errors.append(f"post {i} is missing its entry or timestamp")
+        elif not isinstance(post['timestamp'], _TIME) or isinstance(post['timestamp'], bool):
+            errors.append(f"post {i} has a timestamp that isn't a number")
+    for i, message in enumerate(obj['_messages']):
+        if not isinstance(message, dict) or 'message' not in message or 'recipient' not in message \
+                or 'frm' not in message or not isinstance(message.get('timestamp'), _NUMBER):
+            errors.append(f"message {i} is missing message, recipient, frm or timestamp")
+            continue
+        try:
+            float(message['timestamp'])
+        except ValueError:
+            errors.append(f"message {i} has an invalid timestamp")
+    for i, user in enumerate(obj['_users']):
+        if not isinstance(user, str):
+            errors.append(f"user {i} is not a string")
+    for i, segment in enumerate(obj.get('_archive', [])):
+        if not isinstance(segment, dict) or not isinstance(segment.get('file'), str) \
+                or not isinstance(segment.get('start'), _TIME) or not isinstance(segment.get('end'), _TIME) \
+                or not isinstance(segment.get('contacts'), list):
+            errors.append(f"archive manifest entry {i} is invalid")
+        elif archive_dir is not None and not (archive_dir / segment['file']).exists():
+            errors.append(f"archive segment {segment['file']} is missing")
+
+    outdated = '_next_post_id' not in obj or \
+        any(isinstance(post, dict) and post.get('id') is None for post in obj['_posts'])
+
+    # keep reports readable when a file is badly broken
+    if len(errors) > 20:
+        errors = errors[:20] + [f"... and {len(errors) - 20} more"]
+    return errors, outdated
+
+
+def check_file(args) -> dict:
+    """
+    Validates one dsu file and, if migrate is set, rewrites it in the current format. Runs in a worker process.
+    args is a (path, migrate, compression) tuple so it can be used with Pool.imap_unordered.
+    """
+    path, migrate, compression = args
+    p = Path(path)
+    start = time.perf_counter()
+    result = {'path': str(p), 'ok': False, 'errors': [], 'outdated': False, 'migrated': False,
+              'size': 0, 'seconds': 0.0}
+    try:
+        result['size'] = p.stat().st_size
+        try:
+            with open_dsu(p, 'r') as f:
+                obj = json.load(f)
+        except (ValueError, EOFError, OSError) as ex:
+            result['errors'] = [f"unreadable: {ex}"]
+            return result
+
+        errors, outdated = validate_document(obj, p.parent / (p.stem + '.archive'))
+        result['errors'] = errors
+        result['outdated'] = outdated
+        result['ok'] = not errors
+
+        if result['ok'] and migrate and (outdated or compression is not None):
+            # make sure Profile itself can load it before writing anything back
+            profile = Profile()
+            profile.load_profile(str(p))
+            profile.save_profile(str(p), compression=compression)
+            result['migrated'] = True
+            result['size'] = p.stat().st_size
+    except (DsuFileError, DsuProfileError) as ex:
+        result['ok'] = False
+        result['errors'].append(f"Profile could not load the file: {ex}")
+    finally:
+        result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def find_profiles(root) -> list:
+    """Returns the paths of every dsu file under root."""
+    found = []
+    for directory, _, files in os.walk(root):
+        found.extend(os.path.join(directory, name) for name in files if name.endswith('.dsu'))
+    return sorted(found)
+
+
+def validate_tree(root, migrate: bool = False, compression: str = None, workers: int = None,
+                  progress=None) -> dict:
+    """
+    Checks every dsu file under root in a pool of worker processes (one per core by default) and returns the
+    report: a summary and the result of every file. progress, if given, is called with each result as it comes in.
+    """
+    paths = find_profiles(root)
+    start = time.perf_counter()
+    results = []
+
+    if paths:
+        workers = workers or os.cpu_count() or 1
+        # small files are cheap, so hand them out in chunks to keep the workers busy
+        chunksize = max(1, len(paths) // (workers * 8))
+        with multiprocessing.Pool(workers) as pool:
+            for result in pool.imap_unordered(check_file, [(path, migrate, compression) for path in paths],
+                                              chunksize):
+                results.append(result)
+                if progress is not None:
+                    progress(result)
+
+    results.sort(key=lambda result: result['path'])
+    return {'summary': {'files': len(results),
+                        'valid': sum(result['ok'] for result in results),
+                        'invalid': sum(not result['ok'] for result in results),
+                        'outdated': sum(result['ok'] and result['outdated'] and not result['migrated']
+                                        for result in results),
+                        'migrated': sum(result['migrated'] for result in results),
+                        'bytes': sum(result['size'] for result in results),
+                        'seconds': time.perf_counter() - start,
+                        'workers': workers},
+            'files': results}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Validate and migrate every dsu file in a directory tree.")
+    parser.add_argument('root', help="the directory to search for dsu files")
+    parser.add_argument('--migrate', action='store_true', help="rewrite outdated files in the current format")
+    parser.add_argument('--compression', choices=COMPRESSION_FORMATS,
+                        help="with --migrate, also convert every valid file to this compression")
+    parser.add_argument('--workers', type=int, help="number of worker processes (default: one per core)")
+    parser.add_argument('-o', '--output', help="write the full json report to this file")
+    parser.add_argument('-q', '--quiet', action='store_true', help="only print the summary")
+    args = parser.parse_args(argv)
+
+    def progress(result):
+        if not args.quiet and not result['ok']:
+            print(f"INVALID {result['path']}: {'; '.join(result['errors'])}", file=sys.stderr)
+
+    report = validate_tree(args.root, args.migrate, args.compression, args.workers, progress)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    summary = report['summary']
+    print(f"{summary['files']} files checked in {summary['seconds']:.2f}s with {summary['workers']} workers: "
+          f"{summary['valid']} valid, {summary['invalid']} invalid, {summary['outdated']} outdated, "
+          f"{summary['migrated']} migrated.")
+    return 1 if summary['invalid'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,9 +7,24 @@
 
 import tkinter as tk
 from tkinter import ttk, filedialog, TclError
-from Profile import Post, Profile
-from ds_messenger import DirectMessenger, DirectMessage
+from Profile import Post, Profile, add_message_listener, DsuFileError, DsuProfileError
+from ds_messenger import DirectMessenger, DirectMessage, DirectMessengerError
+from ds_contacts import ContactList, last_activity
+from ds_scrollback import ConversationWindow
+from ds_render_cache import RenderCache
 import copy
+import threading
+# ds_outbox, ds_profile_cache, ds_receiver and ds_broadcast are imported in the methods that use them, so the
+# window is painted before they (and concurrent.futures, selectors, ...) are loaded
+
+# update_messages polls the server on the Tk thread, so it gives up after this many seconds
+# rather than freezing the window when the server stalls.
+UPDATE_TIMEOUT = 2.0
+
+
+def _message_key(message) -> tuple:
+    # messages are dictionaries, which can't go in a set
+    return message['timestamp'], message['from'], message['recipient'], message['message']
 
 
 """
@@ -26,11 +41,15 @@ class Body(tk.Frame):
         self.current_profile = Profile()
         self.current_path = ""
 
+        # the outbox for the active DSU file, its lock is held whenever the file is loaded and saved
+        self.outbox = None
+
         # a list of the messages available in the active DSU file
         self._messages = []
 
-        # A list of usernames that the current profile has sent/recieved messages
-        self._contacts = []
+        # The usernames that the current profile has sent/recieved messages, in the order
+        # shown in the TreeView (most recent activity first)
+        self._contacts = ContactList()
 
         # This is a variable to be set by node select when clicked on a particular
         # contact, is accessed in order to send to correct recipient
@@ -39,6 +58,27 @@ class Body(tk.Frame):
         # This is what will be tied to each username so that when a contact is clicked on the
         # TreeView widget, it will display the chat history
         self._chat_history = []
+
+        # The pages of the selected conversation that are shown in the message_viewer. Only a few pages
+        # are in the widget at a time, older and newer ones are loaded as the user scrolls. Formatted
+        # pages are kept in _rendered, so switching back to a conversation doesn't format it again.
+        self._rendered = RenderCache()
+        self._window = ConversationWindow(self._format_message, cache=self._rendered)
+        # Set when a message is added somewhere in the middle of the shown conversation, so it is redrawn
+        self._window_stale = False
+        add_message_listener(self._message_added)
+
+        # The outbox lines shown under the conversation, so they are only replaced when they change
+        self._displayed_outbox = None
+
+        # The pending root.after_idle call that loads another page, while one is scheduled
+        self._page_job = None
+
+        # The pending root.after call for the next update_messages, if the update timer is running
+        self._update_job = None
+
+        # The TkReceiver delivering messages for the active DSU file, see start_updates
+        self._receiver = None
         
         # After all initialization is complete, call the _draw method to pack the widgets
         # into the Body instance 
@@ -50,36 +90,162 @@ class Body(tk.Frame):
     Clicking on a node will open the chat history (sent and recieved messages in chronologial order)
     """
     def node_select(self, event):
-        #index = int(self.posts_tree.selection()[0])
-        #entry = self._posts[index].entry
-        #self.set_text_entry(entry)
-        digits = self.posts_tree.selection()[0][1:]
-        leading_zeros = True
-        value = ''
-
-        # The .selection()[0] method of our treeview widget returns a 4 character string as an id
-        # here I just got rid of the leading zeroes and got an accurate index value by converting
-        # it from hexadecimal
-        for i in digits:
-            if i == '0' and leading_zeros:
-                continue
-            elif i != '0':
-                leading_zeros = False
-            value = value + i
-            
-        index = int(value, 16) - 1
-
-        self.selected_contact = self._contacts[index]
+        selection = self.posts_tree.selection()
+        if not selection:
+            return
 
-        contact_messages = self.current_profile.get_chat_messages(self.selected_contact)
+        # Each contact is inserted with its own item id, so the ContactList can map it straight
+        # back to the username
+        self.selected_contact = self._contacts.contact_for(selection[0])
+        self._contacts.mark_read(self.selected_contact)
+        self._refresh_contact(self.selected_contact)
 
-        # FUTURE VERSIONS NEED TO CALL CHAT HISTORY, NOT JUST SENT MESSAGES
-        # ALSO NEED TO WRITE A NEW DISPLAY FUNCTION THAT WILL DIFFERENTIATE BETWEEN
-        # RECIPIENT AND SENDER IN MESSAGE_VIEW - not just set_text_entry
-        self.set_text_entry(str(contact_messages))
+        self.show_conversation(self.current_profile)
 
         print("CURENT CONTACT SELECTED: ", self.selected_contact)
 
+    """
+    Displays the chat history with the selected contact, followed by any messages to them that are
+    still waiting in the outbox. Each message is shown with its delivery status. Only the latest
+    page of a long conversation is shown at first, see _viewer_scrolled.
+    """
+    def show_conversation(self, profile: Profile):
+        if self.selected_contact == '':
+            return
+
+        if self._window.contact != self.selected_contact or self._window_stale:
+            self._window_stale = False
+            self.set_text_entry(self._window.reset(profile, self.selected_contact))
+            self.message_viewer.see('end')
+        else:
+            text, dropped = self._window.refresh(profile)
+            if text:
+                # follow new messages if the user was looking at the bottom of the conversation
+                following = self.message_viewer.yview()[1] >= 1.0
+                top = self.message_viewer.index('@0,0')
+                self.message_viewer.insert(self._history_end(), text)
+                if dropped:
+                    # the oldest pages were dropped to keep the widget small
+                    self.message_viewer.delete('1.0', f'{dropped + 1}.0')
+                    if not following:
+                        line = max(1, int(top.split('.')[0]) - dropped)
+                        self.message_viewer.yview(f'{line}.0')
+                if following:
+                    self.message_viewer.see('end')
+
+        # The outbox changes as messages go out, so it is always formatted fresh (it is usually tiny).
+        # It goes under the latest message, so it is only shown when the latest page is.
+        lines = []
+        if self._window.at_end:
+            lines = [f"me: {entry['message']}  [{entry['status']}]"
+                     for entry in profile.get_outbox(self.selected_contact)]
+        if lines != self._displayed_outbox:
+            self._set_outbox(lines)
+
+    """
+    Formats a message for the message_viewer.
+    """
+    def _format_message(self, message) -> str:
+        from ds_outbox import SENT
+        if message['from'] == self.current_profile.username:
+            return f"me: {message['message']}  [{SENT}]"
+        return f"{message['from']}: {message['message']}"
+
+    """
+    Replaces the outbox lines at the bottom of the message_viewer. They carry the 'outbox' tag so
+    they can be found again.
+    """
+    def _set_outbox(self, lines: list):
+        ranges = self.message_viewer.tag_ranges('outbox')
+        if ranges:
+            self.message_viewer.delete(ranges[0], ranges[-1])
+        if lines:
+            prefix = '\n' if self._window.pages else ''
+            self.message_viewer.insert('end-1c', prefix + '\n'.join(lines), 'outbox')
+        self._displayed_outbox = lines
+
+    """
+    Returns the index just after the last message of the conversation, where newer messages go.
+    """
+    def _history_end(self):
+        ranges = self.message_viewer.tag_ranges('outbox')
+        return ranges[0] if ranges else 'end-1c'
+
+    """
+    Called by the message_viewer whenever it scrolls. Passes the position on to the scrollbar and,
+    when the view gets close to the top or bottom of the pages that are loaded, schedules loading
+    the next older or newer page.
+    """
+    def _viewer_scrolled(self, first, last):
+        self.message_viewer_scrollbar.set(first, last)
+        if self._page_job is not None or not self._window.pages:
+            return
+        if float(first) < 0.1 and not self._window.at_start:
+            self._page_job = self.after_idle(self._load_older_page)
+        elif float(last) > 0.9 and not self._window.at_end:
+            self._page_job = self.after_idle(self._load_newer_page)
+
+    """
+    Adds the page before the first one shown to the top of the message_viewer, dropping the newest
+    page if there are too many, and keeps the same messages in view.
+    """
+    def _load_older_page(self):
+        self._page_job = None
+        change = self._window.load_older(self.current_profile)
+        if change is None:
+            return
+        text, added, dropped = change
+        top = self.message_viewer.index('@0,0')
+        self.message_viewer.insert('1.0', text)
+        if dropped:
+            remaining = self._window.line_count
+            self.message_viewer.delete(f'{remaining}.end', self._history_end())
+            self._set_outbox([])
+        # everything moved down by the inserted lines, scroll back to what was on top before
+        line = int(top.split('.')[0]) + added
+        self.message_viewer.yview(f'{line}.0')
+
+    """
+    Adds the page after the last one shown to the bottom of the message_viewer, dropping the oldest
+    page if there are too many, and keeps the same messages in view.
+    """
+    def _load_newer_page(self):
+        self._page_job = None
+        change = self._window.load_newer(self.current_profile)
+        if change is None:
+            return
+        text, added, dropped = change
+        top = self.message_viewer.index('@0,0')
+        self.message_viewer.insert(self._history_end(), text)
+        if dropped:
+            self.message_viewer.delete('1.0', f'{dropped + 1}.0')
+            line = max(1, int(top.split('.')[0]) - dropped)
+            self.message_viewer.yview(f'{line}.0')
+        if self._window.at_end:
+            self.show_conversation(self.current_profile)
+
+    """
+    Called by Profile.add_msg (possibly from the outbox thread). The formatted pages of the
+    conversation the message belongs to are dropped from the cache. Messages newer than the ones
+    shown are picked up by the next show_conversation, but one that lands in the middle of the
+    shown conversation means it has to be redrawn.
+    """
+    def _message_added(self, profile, message):
+        self._rendered.invalidate(message['from'], message['recipient'])
+        if self.selected_contact not in (message['from'], message['recipient']) or not self._window.pages:
+            return
+        if message['timestamp'] < self._window.pages[-1][-1]['timestamp']:
+            self._window_stale = True
+
+    """
+    Replaces the active profile, for example once the full history of a profile opened in
+    fast-start mode has loaded, and redraws the selected conversation.
+    """
+    def set_profile(self, profile: Profile):
+        self.current_profile = profile
+        self._window_stale = True
+        self.show_conversation(profile)
+
     """
     Returns the text that is currently displayed in the message_editor widget.
     """
@@ -92,6 +258,7 @@ class Body(tk.Frame):
     def set_text_entry(self, text:str):
         self.message_viewer.delete(0.0, "end")
         self.message_viewer.insert(0.0, text)
+        self._displayed_outbox = None
 
     
     """
@@ -102,27 +269,54 @@ class Body(tk.Frame):
  
 
     """
-    Populates the ._contacts attribute with the users from the acive DSU file
+    Populates the ._contacts attribute with the users from the acive DSU file. activity is an optional
+    dictionary of username -> timestamp of the last message (see ds_contacts.last_activity) used to sort
+    the contacts with the most recent conversations first.
     """
-    def set_contacts(self, users: list):
-        self._contacts = copy.deepcopy(users)
-        for contact in self._contacts:
+    def set_contacts(self, users: list, activity: dict = None):
+        # The contacts are sorted once and then appended to the end of the tree in order, which is
+        # much cheaper than inserting each one at its sorted position
+        for contact in self._contacts.add_many(users, activity):
             try:
-                self._insert_post_tree(len(self._messages), contact)
+                self._insert_post_tree('end', contact)
             except TclError as e:
                 print("set_contacts error")
                 continue
 
     """
-    Adds an individual contact to the list of contacts.
+    Adds an individual contact to the list of contacts. Returns False if the contact was already there.
     """
-    def add_contact(self, username: str):
-        self._contacts.append(username)
+    def add_contact(self, username: str) -> bool:
+        index = self._contacts.add(username)
+        if index == -1:
+            return False
         try:
-            self._insert_post_tree(len(self._messages), username)
+            self._insert_post_tree(index, username)
         except TclError as e:
             print("add_contacts error")
-            return
+        return True
+
+    """
+    Records a new message with a contact, moving them to their new place in the TreeView and
+    updating their unread count. Contacts that aren't in the list yet are added.
+    """
+    def contact_activity(self, username: str, timestamp: float, unread: bool = False):
+        is_new = username not in self._contacts
+        index = self._contacts.touch(username, timestamp, unread)
+        try:
+            if is_new:
+                self._insert_post_tree(index, username)
+            else:
+                self.posts_tree.move(self._contacts.id_for(username), '', index)
+                self._refresh_contact(username)
+        except TclError as e:
+            print("contact_activity error")
+
+    """
+    Updates the text shown in the TreeView for a single contact.
+    """
+    def _refresh_contact(self, username: str):
+        self.posts_tree.item(self._contacts.id_for(username), text=self._contacts.label(username))
         
 
     """
@@ -138,7 +332,7 @@ class Body(tk.Frame):
     Get list of current contacts for current profile in main app in order to save to dsu file
     """
     def get_contacts(self):
-        return self._contacts
+        return list(self._contacts)
 
 
     """
@@ -149,8 +343,12 @@ class Body(tk.Frame):
         self.set_text_entry("")
         self.message_editor.configure(state=tk.NORMAL)
         self._messages = []
-        for item in self.posts_tree.get_children():
-            self.posts_tree.delete(item)
+        self._contacts.clear()
+        self._window.clear()
+        self._rendered.clear()
+        self.selected_contact = ''
+        self.stop_updates()
+        self.posts_tree.delete(*self.posts_tree.get_children())
 
 
     """
@@ -158,29 +356,88 @@ class Body(tk.Frame):
     """
     def _insert_post_tree(self, id, contact):
         # Title for messages in message tree will be the username of the 'frm' variable
-        self.posts_tree.insert('', id, text=contact)
+        self.posts_tree.insert('', id, iid=self._contacts.id_for(contact), text=self._contacts.label(contact))
 
 
     """
-    Will run on a timer to check for incoming messages to the user.
+    Starts receiving messages for the active DSU file. Messages are delivered by a TkReceiver as
+    soon as the server sends them; if the socket can't be watched or the server can't be reached,
+    update_messages polls on a timer instead.
+    """
+    def start_updates(self):
+        from ds_profile_cache import profiles
+        from ds_receiver import TkReceiver
+        self.stop_updates()
+        profile = profiles.get(self.current_path)
+        messenger = DirectMessenger(username=profile.username, password=profile.password)
+        try:
+            self._receiver = TkReceiver(self.root, messenger, self._messages_received,
+                                        on_error=lambda e: print("Receiver error:", e))
+            self._receiver.start()
+        except (RuntimeError, DirectMessengerError) as e:
+            print("Checking for new messages on a timer instead:", e)
+            self._receiver = None
+            self.update_messages()
+            return
+        self._refresh_view()
+
+    """
+    Will run on a timer to check for incoming messages to the user, when they can't be received
+    as they arrive (see start_updates).
     """
     def update_messages(self):
-        current_user = Profile()
-        current_user.load_profile(self.current_path)
+        from ds_profile_cache import profiles
+        # the profile cache only reads the file again when something else has changed it
+        current_user = profiles.get(self.current_path)
         update_messenger = DirectMessenger(username=current_user.username, password=current_user.password)
-        newmessages = update_messenger.retrieve_new()
-        
-        for message in newmessages:
-            if message not in current_user._messages:
-                current_user.add_msg(message)
+        self._messages_received(update_messenger.retrieve_new(timeout=UPDATE_TIMEOUT))
+
+        self._update_job = self.root.after(ms=1000, func=self.update_messages)
+
+    """
+    Adds newly received messages to the active DSU file and shows them.
+    """
+    def _messages_received(self, newmessages: list):
+        from ds_profile_cache import profiles
+        added = []
+        if newmessages:
+            # edit gets the latest version of the file, the outbox sender may have saved while we were
+            # waiting on the server
+            with profiles.edit(self.current_path) as current_user:
+                known = set(map(_message_key, current_user._messages))
+                for message in newmessages:
+                    if _message_key(message) not in known:
+                        current_user.add_msg(message)
+                        added.append(message)
 
-        current_user.save_profile(self.current_path)
+        for message in added:
+            self.contact_activity(message['from'], message['timestamp'],
+                                  unread=message['from'] != self.selected_contact)
 
-        if self.selected_contact != '':
-            contact_messages = current_user.get_chat_messages(self.selected_contact)
-            self.set_text_entry(str(contact_messages))
+        self.current_profile = profiles.get(self.current_path)
+        self.show_conversation(self.current_profile)
 
-        self.root.after(ms=1000, func=self.update_messages)
+    """
+    Redraws the selected conversation once a second while messages are received by the TkReceiver,
+    so the delivery status of outgoing messages stays current. It doesn't touch the network, and
+    the profile cache only reads the file when the outbox sender has changed it.
+    """
+    def _refresh_view(self):
+        from ds_profile_cache import profiles
+        self.current_profile = profiles.get(self.current_path)
+        self.show_conversation(self.current_profile)
+        self._update_job = self.root.after(ms=1000, func=self._refresh_view)
+
+    """
+    Stops receiving messages and the update_messages timer.
+    """
+    def stop_updates(self):
+        if self._receiver is not None:
+            self._receiver.stop()
+            self._receiver = None
+        if self._update_job is not None:
+            self.root.after_cancel(self._update_job)
+            self._update_job = None
 
     """
     Call only once upon initialization to add widgets to the frame
@@ -217,9 +474,9 @@ class Body(tk.Frame):
         self.message_editor = tk.Text(master=message_frame, height=10, width=0)
         self.message_editor.pack(fill=tk.BOTH, side=tk.TOP, expand=True)
 
-        message_viewer_scrollbar = tk.Scrollbar(master=viewer_scroll_frame, command=self.message_viewer.yview)
-        self.message_viewer['yscrollcommand'] = message_viewer_scrollbar.set
-        message_viewer_scrollbar.pack(fill=tk.Y, side=tk.LEFT, expand=False, padx=0, pady=0)
+        self.message_viewer_scrollbar = tk.Scrollbar(master=viewer_scroll_frame, command=self.message_viewer.yview)
+        self.message_viewer['yscrollcommand'] = self._viewer_scrolled
+        self.message_viewer_scrollbar.pack(fill=tk.Y, side=tk.LEFT, expand=False, padx=0, pady=0)
 
         message_editor_scrollbar = tk.Scrollbar(master=editor_scroll_frame, command=self.message_editor.yview)
         self.message_editor['yscrollcommand'] = message_editor_scrollbar.set
@@ -232,11 +489,13 @@ A subclass of tk.Frame that is responsible for drawing all of the widgets
 in the footer portion of the root frame.
 """
 class Footer(tk.Frame):
-    def __init__(self, root, send_callback=None, add_callback=None):
+    def __init__(self, root, send_callback=None, add_callback=None, broadcast_callback=None, retry_callback=None):
         tk.Frame.__init__(self, root)
         self.root = root
         self._send_callback = send_callback
         self._add_callback = add_callback
+        self._broadcast_callback = broadcast_callback
+        self._retry_callback = retry_callback
 
         # IntVar is a variable class that provides access to special variables
         # for Tkinter widgets. is_online is used to hold the state of the chk_button widget.
@@ -265,6 +524,24 @@ class Footer(tk.Frame):
     def send_click(self):
         if self._send_callback is not None:
             self._send_callback()
+
+
+    """
+    Calls the callback function specified in the broadcast_callback class attribute, if
+    available, when the broadcast_button has been clicked.
+    """
+    def broadcast_click(self):
+        if self._broadcast_callback is not None:
+            self._broadcast_callback()
+
+
+    """
+    Calls the callback function specified in the retry_callback class attribute, if
+    available, when the retry_button has been clicked.
+    """
+    def retry_click(self):
+        if self._retry_callback is not None:
+            self._retry_callback()
     
 
     """
@@ -275,11 +552,29 @@ class Footer(tk.Frame):
         send_button.configure(command=self.send_click)
         send_button.pack(fill=tk.BOTH, side=tk.RIGHT, padx=5, pady=5)
 
+        broadcast_button = tk.Button(master=self, text="Send to All", width=12)
+        broadcast_button.configure(command=self.broadcast_click)
+        broadcast_button.pack(fill=tk.BOTH, side=tk.RIGHT, padx=5, pady=5)
+
+        retry_button = tk.Button(master=self, text="Retry Failed", width=12)
+        retry_button.configure(command=self.retry_click)
+        retry_button.pack(fill=tk.BOTH, side=tk.RIGHT, padx=5, pady=5)
+
         # ADD USER BUTTON INSTEAD OF READY LABEL
         add_user_button = tk.Button(master=self, text="Add User", width=10)
         add_user_button.configure(command=self.add_click)
         add_user_button.pack(fill=tk.BOTH, side=tk.LEFT, padx=10, pady=5)
 
+        self.status_label = tk.Label(master=self, text="", anchor='w')
+        self.status_label.pack(fill=tk.BOTH, side=tk.LEFT, expand=True, padx=5, pady=5)
+
+
+    """
+    Shows text in the status area of the footer, for example the result of a broadcast.
+    """
+    def set_status(self, text: str):
+        self.status_label.configure(text=text)
+
 
 """
 A subclass of tk.Frame that is responsible for drawing all of the widgets
@@ -297,6 +592,18 @@ class MainApp(tk.Frame):
         # To make sure that a file is open before using send/add
         self._profile_filename = False
 
+        # Delivers queued messages for the active DSU file in the background
+        self.outbox = None
+
+        # Filled by _load_in_background when the full profile has been loaded / synced with the
+        # server: generation -> profile. Every open_profile starts a new generation, results of
+        # older ones are ignored.
+        self._loaded = {}
+        self._synced = {}
+        self._generation = 0
+        # The messenger _load_in_background is using, so its request can be cancelled
+        self._sync_messenger = None
+
         # After all initialization is complete, call the _draw method to pack the widgets
         # into the root frame
         self._draw()
@@ -311,23 +618,103 @@ class MainApp(tk.Frame):
         # May need to plan this to accept an index from a contacts list instead of
         # passing in a username. 
         message = self.body.get_text_entry()
-        dm_user = DirectMessenger(username = self._current_profile.username, 
-                                  password= self._current_profile.password)
-        
-        dm_user.send(message, self.body.selected_contact)
+        if self._profile_filename is False or self.body.selected_contact == '':
+            print("No filename or contact selected.")
+            return
 
-        currentprofile = Profile()
-        if self._profile_filename is not False:
-            currentprofile.load_profile(self._profile_filename)
-            currentprofile.add_msg(dm_user.sent_messages[0])
-            currentprofile.save_profile(self._profile_filename)
-        print("MESSAGE SENT")
+        # The message is saved to the outbox right away and delivered in the background, so it is
+        # not lost if the server can't be reached right now
+        entry = self.outbox.enqueue(message, self.body.selected_contact)
+        self.body.contact_activity(self.body.selected_contact, entry['timestamp'])
+        self.body.message_editor.delete('1.0', 'end')
+        self.body.show_conversation(self.outbox.profile())
+        print("MESSAGE QUEUED")
 
 
 
+    """
+    Puts every message the server refused too many times back into the outbox, so the sender
+    tries them again.
+    """
+    def retry_failed(self):
+        if self.outbox is None:
+            print("No filename provided.")
+            return
+        count = self.outbox.retry_failed()
+        self.footer.set_status(f"Retrying {count} failed message{'' if count == 1 else 's'}")
+        self.body.show_conversation(self.outbox.profile())
+
+
     # EDITED AFTER HARSHAL GUI ^^^^
 
 
+    """
+    Sends the message in the message editor to every contact at once. The messages go out
+    on a background thread over a few connections at a time, see ds_broadcast.py.
+    """
+    def broadcast_message(self):
+        message = self.body.get_text_entry()
+        if self._profile_filename is False or message == '':
+            print("No filename or message provided.")
+            return
+
+        recipients = self.body.get_contacts()
+        messenger = DirectMessenger(username=self._current_profile.username,
+                                    password=self._current_profile.password)
+        outcome = []
+        threading.Thread(target=self._broadcast_in_background,
+                         args=(messenger, message, recipients, self._profile_filename, self.outbox, outcome),
+                         daemon=True).start()
+        self.body.message_editor.delete('1.0', 'end')
+        self.footer.set_status("Sending to all contacts...")
+        self.root.after(100, self._check_broadcast, outcome)
+
+
+    """
+    Runs on a background thread: broadcasts the message, then adds everything that was sent
+    to the DSU file in one go. Recipients it couldn't be sent to are queued in the outbox, so
+    they get it once the server can be reached. A line describing the result is appended to
+    outcome for _check_broadcast.
+    """
+    def _broadcast_in_background(self, messenger, message, recipients, path, outbox, outcome):
+        from ds_profile_cache import profiles
+        from ds_broadcast import broadcast
+        sent = Profile(username=messenger.username)
+        try:
+            results = broadcast(messenger, message, recipients, profile=sent)
+        except DirectMessengerError as e:
+            print("Broadcast could not reach the server:", e)
+            results = dict.fromkeys(recipients, False)
+
+        failed = [recipient for recipient, ok in results.items() if not ok]
+        try:
+            if sent._messages:
+                with profiles.edit(path) as profile:
+                    profile.add_msgs(sent._messages)
+            if failed:
+                outbox.enqueue_many([(message, recipient) for recipient in failed])
+        except (DsuFileError, DsuProfileError) as e:
+            outcome.append(f"Broadcast sent to {len(results) - len(failed)} of {len(results)}, "
+                           f"but the DSU file could not be saved: {e}")
+            return
+
+        if failed:
+            outcome.append(f"Broadcast sent to {len(results) - len(failed)} of {len(results)} contacts, "
+                           f"{len(failed)} queued to retry")
+        else:
+            outcome.append(f"Broadcast sent to all {len(results)} contacts")
+
+
+    """
+    Polls for the result of _broadcast_in_background and shows it in the footer.
+    """
+    def _check_broadcast(self, outcome):
+        if not outcome:
+            self.root.after(100, self._check_broadcast, outcome)
+            return
+        self.footer.set_status(outcome[0])
+
+
     """
     Creates a new DSU file when the 'New' menu item is clicked.
     """
@@ -389,6 +776,7 @@ class MainApp(tk.Frame):
     and password and save profile to the dsu file
     """
     def submit_info(self):            
+        from ds_profile_cache import profiles
         self._current_profile.username = self.user_input.get("1.0",'end-1c')
         self._current_profile.password = self.password_input.get("1.0",'end-1c')
 
@@ -399,7 +787,21 @@ class MainApp(tk.Frame):
             self._current_profile.password = "dpassword123"
 
         self._current_profile.save_profile(self._profile_filename)
+        profiles.saved(self._profile_filename, self._current_profile)
         self.newfile_popup.destroy()
+        self.start_outbox()
+
+
+    """
+    Starts a new outbox sender for the active DSU file, stopping the one for the previous file if needed.
+    """
+    def start_outbox(self):
+        from ds_outbox import Outbox
+        if self.outbox is not None:
+            self.outbox.stop(timeout=1)
+        self.outbox = Outbox(self._profile_filename)
+        self.body.outbox = self.outbox
+        self.outbox.start()
 
 
     # vvvv-------------------ADDED AFTER HARSHAL GUI---------------------vvvvv
@@ -409,26 +811,27 @@ class MainApp(tk.Frame):
     to insert an empty chat history with a given username supplied by the message editor
     """
     def add_user(self):
+        from ds_profile_cache import profiles
         if self._profile_filename is False:
             print("No filename provided.")
             return   
 
-        self._current_profile.load_profile(self._profile_filename) # Load first
-        contact = self.contact_input.get("1.0",'end-1c') 
-
+        contact = self.contact_input.get("1.0",'end-1c')
         # If contact is nothing, do not add
         if contact == '':
             return
-        elif contact not in self.body._contacts:
-            self.body.add_contact(contact)
-            self._current_profile._users = self.body.get_contacts()
-
-            print("CURRENT USERS from MAINAPP: ", self._current_profile._users)
 
+        if self.body.add_contact(contact):
+            try:
+                # only the new contact is added, the file may have contacts the body hasn't been shown yet
+                with profiles.edit(self._profile_filename) as profile:
+                    if contact not in profile._users:
+                        profile._users.append(contact)
+                print("CURRENT USERS from MAINAPP: ", profile._users)
+            except (DsuFileError, DsuProfileError) as e:
+                print("Unable to save contact: ", e)
         else:
             print("Contact already exists.")
-        
-        self._current_profile.save_profile(self._profile_filename) # Save last
         self.add_popup.destroy()
 
     #^^^^----------------EDITED AFTER HARSHAL GUI----------------^^^^^^
@@ -443,25 +846,104 @@ class MainApp(tk.Frame):
         filename = tk.filedialog.askopenfile(filetypes=[('Distributed Social Profile', '*.dsu')])
         try:
             self._profile_filename = filename.name
+            # Fast start: only the contacts and the latest messages with each of them are read
+            # here, so the window can be drawn right away. The full history is loaded and synced
+            # with the server in the background by _load_in_background.
             self._current_profile = Profile()
-            self._current_profile.load_profile(self._profile_filename)
+            self._current_profile.load_profile_recent(self._profile_filename)
             self.body.reset_ui() # Reset UI
             # self.body.set_messages(self._current_profile._messages)
-            self.body.set_contacts(self._current_profile._users)
+            self.body.set_contacts(self._current_profile._users, last_activity(self._current_profile._messages))
             self.body.current_profile = self._current_profile
             self.body.current_path = self._profile_filename
-            
-            # UPDATE MESSAGES HERE
-            self.body.update_messages()
+            self.start_outbox()
+
+            self._generation += 1
+            self._loaded.clear()
+            self._synced.clear()
+            self._cancel_sync()
+            threading.Thread(target=self._load_in_background,
+                             args=(self._profile_filename, self._generation), daemon=True).start()
+            self.root.after(50, self._check_loaded, self._generation)
 
         except AttributeError as e:
             print("Open operation interrupted.")
+        except (DsuFileError, DsuProfileError) as e:
+            print("Unable to open profile: ", e)
+
+
+    """
+    Runs on a background thread after a profile is opened: loads the whole profile, then
+    retrieves all messages from the server and merges them into the profile. The results are
+    picked up on the Tk thread by _check_loaded, tagged with generation so results of a profile
+    that is no longer open are ignored.
+    """
+    def _load_in_background(self, path, generation):
+        from ds_profile_cache import profiles
+        try:
+            profile = profiles.get(path)
+            self._loaded[generation] = profile
+
+            messenger = DirectMessenger(username=profile.username, password=profile.password)
+            if generation != self._generation:
+                return
+            self._sync_messenger = messenger
+            remote = messenger.retrieve_all()
+            if remote:
+                with profiles.edit(path) as profile:
+                    profile.merge_messages(remote)
+            self._synced[generation] = profile
+        except (DsuFileError, DsuProfileError) as e:
+            print("Unable to load profile: ", e)
+            self._synced[generation] = None
+
+
+    """
+    Stops the server request of a _load_in_background that is still running, for example when
+    another profile is opened or the program is closed.
+    """
+    def _cancel_sync(self):
+        messenger, self._sync_messenger = self._sync_messenger, None
+        if messenger is not None:
+            messenger.cancel()
+
+
+    """
+    Polls for the results of the _load_in_background run of generation and hands them to the
+    body. It keeps polling until that run has synced the profile with the server, then the body
+    starts receiving new messages. A poll for an older generation stops, open_profile started a
+    new one.
+    """
+    def _check_loaded(self, generation):
+        if generation != self._generation:
+            return
+
+        loaded = self._loaded.pop(generation, None)
+        if loaded is not None:
+            self._current_profile = loaded
+            self.body.set_profile(loaded)
+
+        if generation not in self._synced:
+            self.root.after(50, self._check_loaded, generation)
+            return
+
+        synced = self._synced.pop(generation)
+        if synced is not None:
+            self._current_profile = synced
+            self.body.set_profile(synced)
+            for contact, timestamp in last_activity(synced._messages).items():
+                if contact != synced.username:
+                    self.body.contact_activity(contact, timestamp)
+        self.body.start_updates()
          
 
     """
     Closes the program when the 'Close' menu item is clicked.
     """
     def close(self):
+        self._cancel_sync()
+        if self.outbox is not None:
+            self.outbox.stop(timeout=1)
         self.root.destroy()
 
 
@@ -494,7 +976,8 @@ class MainApp(tk.Frame):
         # The Body and Footer classes must be initialized and packed into the root window.
         self.body = Body(self.root, self._current_profile)
         self.body.pack(fill=tk.BOTH, side=tk.TOP, expand=True)
-        self.footer = Footer(self.root, send_callback=self.send_message, add_callback=self.add_user_window)
+        self.footer = Footer(self.root, send_callback=self.send_message, add_callback=self.add_user_window,
+                             broadcast_callback=self.broadcast_message, retry_callback=self.retry_failed)
         self.footer.pack(fill=tk.BOTH, side=tk.BOTTOM)
 
 
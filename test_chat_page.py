@@ -0,0 +1,68 @@
+# test_chat_page.py
+#
+# Tests for Profile.get_chat_page, with and without archived messages. Run with: python -m pytest
+
+import time
+import pytest
+from Profile import Profile
+from ds_messenger import DirectMessage
+
+DAY = 24 * 60 * 60
+START = time.mktime((2024, 1, 1, 12, 0, 0, 0, 0, -1))
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = tmp_path / 'me.dsu'
+    path.touch()
+    profile = Profile('server', 'me', 'pw')
+    # a message a day for 90 days, so the archive gets a segment per month
+    for i in range(90):
+        contact = 'bob' if i % 3 else 'alice'
+        profile.add_msg(DirectMessage(f'm{i}', START + i * DAY, contact, 'me'))
+    profile.save_profile(str(path))
+    return str(path)
+
+
+def _load(path) -> Profile:
+    profile = Profile()
+    profile.load_profile(path)
+    return profile
+
+
+def _text(page: list) -> list:
+    return [message['message'] for message in page]
+
+
+def _pages(profile: Profile, contact: str, limit: int) -> list:
+    # pages backwards through the whole conversation, oldest message first
+    messages, before = [], None
+    while True:
+        page = profile.get_chat_page(contact, before=before, limit=limit)
+        if not page:
+            return messages
+        messages = page + messages
+        before = page[0]['timestamp']
+
+
+def test_pages_in_the_dsu_file(path):
+    profile = _load(path)
+    assert _text(profile.get_chat_page('alice', limit=3)) == ['m81', 'm84', 'm87']
+    assert _text(profile.get_chat_page('alice', after=START + 30 * DAY, limit=2)) == ['m30', 'm33']
+    assert _text(_pages(profile, 'bob', 7)) == [f'm{i}' for i in range(90) if i % 3]
+
+
+def test_pages_reach_back_across_archive_segments(path):
+    profile = _load(path)
+    assert profile.archive_messages(path, before=START + 75 * DAY) == 75
+    profile.save_profile(path)
+    profile = _load(path)
+    assert len(profile._archive) >= 3
+    assert len(profile._messages) == 15
+
+    # the first page is all in the dsu file, the next one starts there and goes on into the archive
+    assert _text(profile.get_chat_page('alice', limit=5)) == ['m75', 'm78', 'm81', 'm84', 'm87']
+    assert _text(profile.get_chat_page('alice', before=START + 81 * DAY, limit=4)) == ['m69', 'm72', 'm75', 'm78']
+    # the whole conversation, a page at a time, across every segment
+    assert _text(_pages(profile, 'alice', 4)) == [f'm{i}' for i in range(0, 90, 3)]
+    assert _text(_pages(profile, 'bob', 9)) == [f'm{i}' for i in range(90) if i % 3]
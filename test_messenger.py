@@ -0,0 +1,36 @@
+# test_messenger.py
+#
+# Tests for the time limits of ds_messenger requests, against the ds_server stand-in. Run with: python -m pytest
+
+import re
+import time
+import pytest
+from ds_server import DspServer
+from ds_messenger import DirectMessenger, DirectMessengerTimeout
+
+
+class _SlowJoinServer(DspServer):
+    # takes delay seconds to answer a join
+    delay = 0.6
+
+    def _handle(self, line, token_user, client=None, send_lock=None):
+        if b'"join"' in line:
+            time.sleep(self.delay)
+        return super()._handle(line, token_user, client, send_lock)
+
+
+def test_slow_join_may_use_the_rest_of_the_budget():
+    with _SlowJoinServer() as server:
+        messenger = DirectMessenger('127.0.0.1', 'alice', 'pw', port=server.port, timeout=1.0)
+        assert messenger.send('hi', 'bob')
+
+
+def test_timeout_reports_what_the_step_was_allowed():
+    with _SlowJoinServer() as server:
+        messenger = DirectMessenger('127.0.0.1', 'alice', 'pw', port=server.port, timeout=0.3)
+        with pytest.raises(DirectMessengerTimeout) as error:
+            messenger.retrieve_new(raise_errors=True)
+        assert 'while joining' in str(error.value)
+        # connecting to the local server takes next to nothing, so joining had (nearly) all of it
+        allowed = float(re.search(r'after ([\d.]+)s', str(error.value)).group(1))
+        assert allowed == pytest.approx(0.3, abs=0.05)
@@ -0,0 +1,98 @@
+# test_ndjson.py
+#
+# Tests for ds_ndjson. Run with: python -m pytest
+
+import io
+import json
+import pytest
+from Profile import Profile, Post
+from ds_messenger import DirectMessage
+from ds_ndjson import export_ndjson, import_ndjson, iter_records
+
+
+@pytest.fixture
+def dsu(tmp_path):
+    path = tmp_path / 'me.dsu'
+    path.touch()
+    profile = Profile('server', 'me', 'pw')
+    profile.bio = 'hello'
+    profile._users.append('lonely')
+    for i in range(20):
+        contact = 'alice' if i % 2 else 'bob'
+        profile.add_msg(DirectMessage(f'm{i}', 1000.0 + i, contact, 'me'))
+    profile.add_post(Post('first', 500.0))
+    profile.add_post(Post('second', 1010.0))
+    profile.enqueue_msg('queued', 'bob')
+    profile.save_profile(str(path))
+    return str(path)
+
+
+def _export(path, **filters) -> str:
+    out = io.StringIO()
+    export_ndjson(path, out, **filters)
+    return out.getvalue()
+
+
+def _load(path) -> Profile:
+    profile = Profile()
+    profile.load_profile(str(path))
+    return profile
+
+
+def test_round_trip_into_a_new_file(dsu, tmp_path):
+    source = tmp_path / 'out.ndjson'
+    source.write_text(_export(dsu))
+    copy = tmp_path / 'copy.dsu'
+    counts = import_ndjson(str(copy), str(source))
+    assert counts == {'messages': 20, 'posts': 2, 'outbox': 1, 'skipped': 0}
+
+    original, imported = _load(dsu), _load(copy)
+    assert imported.username == 'me' and imported.bio == 'hello'
+    assert imported._next_post_id == original._next_post_id
+    assert imported._users == original._users and 'lonely' in imported._users
+    assert [entry['message'] for entry in imported.get_outbox()] == ['queued']
+    assert imported.get_outbox()[0]['id'] == original.get_outbox()[0]['id']
+    assert [(p['id'], p['entry']) for p in imported.get_posts()] == [(p['id'], p['entry']) for p in original.get_posts()]
+    assert [(m['timestamp'], m['message']) for m in imported._messages] == \
+        [(m['timestamp'], m['message']) for m in original._messages]
+
+
+def test_importing_twice_skips_everything(dsu, tmp_path):
+    source = tmp_path / 'out.ndjson'
+    source.write_text(_export(dsu))
+    counts = import_ndjson(dsu, str(source))
+    assert counts == {'messages': 0, 'posts': 0, 'outbox': 0, 'skipped': 23}
+    assert len(_load(dsu)._messages) == 20
+
+
+def test_duplicates_within_the_import_are_skipped(dsu, tmp_path):
+    record = json.dumps({'type': 'message', 'message': 'new', 'timestamp': 5000.0, 'recipient': 'carol',
+                         'from': 'me'})
+    source = tmp_path / 'dup.ndjson'
+    source.write_text(record + '\n' + record + '\n')
+    assert import_ndjson(dsu, str(source))['messages'] == 1
+    profile = _load(dsu)
+    assert len(profile._messages) == 21 and 'carol' in profile._users
+
+
+def test_contact_filter(dsu):
+    records = [json.loads(line) for line in _export(dsu, contacts=['alice']).splitlines()]
+    messages = [record for record in records if record['type'] == 'message']
+    assert len(messages) == 10 and all(record['recipient'] == 'alice' for record in messages)
+    assert not [record for record in records if record['type'] in ('post', 'outbox')]
+    assert [record['username'] for record in records if record['type'] == 'user'] == ['alice']
+
+
+def test_time_filter(dsu):
+    records = list(iter_records(dsu, start=1005.0, end=1010.0))
+    assert [record['message'] for record in records if record['type'] == 'message'] == \
+        [f'm{i}' for i in range(5, 10)]
+    assert not [record for record in records if record['type'] == 'post']
+
+
+def test_archived_messages_are_exported(dsu, tmp_path):
+    profile = _load(dsu)
+    profile.archive_messages(dsu, before=1010.0)
+    profile.save_profile(dsu)
+    records = [record for record in iter_records(dsu) if record['type'] == 'message']
+    assert sorted(record['message'] for record in records) == sorted(f'm{i}' for i in range(20))
@@ -0,0 +1,80 @@
+# test_outbox.py
+#
+# Tests for ds_outbox against the ds_server stand-in. Run with: python -m pytest
+
+import json
+import socket
+import pytest
+import ds_server
+from Profile import Profile
+from ds_server import DspServer
+from ds_outbox import Outbox, PENDING, FAILED
+
+
+class _RefusingServer(DspServer):
+    # refuses every direct message
+    def _handle(self, line, token_user, client=None, send_lock=None):
+        if isinstance(json.loads(line).get('directmessage'), dict):
+            return ds_server._error("Message refused"), token_user
+        return super()._handle(line, token_user, client, send_lock)
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = tmp_path / 'me.dsu'
+    path.touch()
+    Profile('127.0.0.1', 'me', 'pw').save_profile(str(path))
+    return str(path)
+
+
+def _closed_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_sent_messages_move_to_the_history(path):
+    with DspServer() as server:
+        outbox = Outbox(path, dsuserver='127.0.0.1', port=server.port)
+        outbox.enqueue('hello', 'bob')
+        outbox.enqueue('again', 'bob')
+        assert outbox.pending_count() == 2
+        assert outbox.flush() == 2
+    profile = outbox.profile()
+    assert profile.get_outbox() == []
+    assert [message['message'] for message in profile._messages] == ['hello', 'again']
+
+
+def test_unreachable_server_uses_no_attempts(path):
+    outbox = Outbox(path, dsuserver='127.0.0.1', port=_closed_port(), max_attempts=2)
+    outbox.enqueue('hello', 'bob')
+    for _ in range(5):
+        assert outbox.flush() == 0
+    [entry] = outbox.profile().get_outbox()
+    assert entry['status'] == PENDING and entry['attempts'] == 0
+
+
+def test_refused_messages_fail_and_can_be_retried(path):
+    with _RefusingServer() as server:
+        outbox = Outbox(path, dsuserver='127.0.0.1', port=server.port, max_attempts=2)
+        outbox.enqueue('hello', 'bob')
+        outbox.flush()
+        [entry] = outbox.profile().get_outbox()
+        assert entry['status'] == PENDING and entry['attempts'] == 1
+        outbox.flush()
+        [entry] = outbox.profile().get_outbox()
+        assert entry['status'] == FAILED
+        assert outbox.pending_count() == 0
+        assert outbox.flush() == 0
+
+    assert outbox.retry_failed() == 1
+    [entry] = outbox.profile().get_outbox()
+    assert entry['status'] == PENDING and entry['attempts'] == 0
+
+
+def test_outbox_survives_a_reload(path):
+    outbox = Outbox(path, dsuserver='127.0.0.1', port=_closed_port())
+    outbox.enqueue('hello', 'bob')
+    profile = Profile()
+    profile.load_profile(path)
+    assert [entry['message'] for entry in profile.get_outbox()] == ['hello']
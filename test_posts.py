@@ -0,0 +1,77 @@
+# test_posts.py
+#
+# Tests for the post index of Profile. Run with: python -m pytest
+
+from Profile import Profile, Post
+
+
+def _profile(count: int = 10) -> Profile:
+    profile = Profile('server', 'me', 'pw')
+    # added out of timestamp order on purpose
+    for i in reversed(range(count)):
+        profile.add_post(Post(f'p{i}', 100.0 + i))
+    return profile
+
+
+def _entries(posts: list) -> list:
+    return [post['entry'] for post in posts]
+
+
+def test_ids_are_stable():
+    profile = _profile()
+    post = profile.get_post_page(limit=1)[0]
+    assert profile.get_post(post['id']) is post
+    profile.del_post_by_id(profile.get_post_page(limit=1, oldest_first=True)[0]['id'])
+    assert profile.get_post(post['id']) is post
+    assert profile.add_post(Post('new', 500.0)) == 11
+
+
+def test_paging_both_ways():
+    profile = _profile()
+    first = profile.get_post_page(limit=4)
+    assert _entries(first) == ['p9', 'p8', 'p7', 'p6']
+    assert _entries(profile.get_post_page(limit=4, after=first[-1])) == ['p5', 'p4', 'p3', 'p2']
+    oldest = profile.get_post_page(limit=4, oldest_first=True)
+    assert _entries(oldest) == ['p0', 'p1', 'p2', 'p3']
+    assert _entries(profile.get_post_page(limit=20, after=oldest[-1], oldest_first=True)) == \
+        [f'p{i}' for i in range(4, 10)]
+
+
+def test_deleted_posts_are_skipped_and_compacted():
+    profile = _profile()
+    newest = profile.get_post_page(limit=3)
+    for post in newest:
+        assert profile.del_post_by_id(post['id'])
+    assert not profile.del_post_by_id(newest[0]['id'])
+    assert _entries(profile.get_post_page(limit=3)) == ['p6', 'p5', 'p4']
+    assert _entries(profile.get_posts_between(105.0, 200.0)) == ['p5', 'p6']
+
+    # deleting more than half removes them from the lists
+    for post in profile.get_post_page(limit=3):
+        profile.del_post_by_id(post['id'])
+    assert len(profile._posts) == 4 and len(profile._post_order) == 4
+    assert _entries(profile.get_post_page()) == ['p3', 'p2', 'p1', 'p0']
+
+
+def test_del_post_by_position():
+    profile = _profile(3)
+    assert profile.del_post(0)
+    assert not profile.del_post(5)
+    assert _entries(profile.get_posts()) == ['p1', 'p0']
+
+
+def test_ids_survive_save_and_load(tmp_path):
+    path = tmp_path / 'me.dsu'
+    path.touch()
+    profile = _profile()
+    # p0 was added last, so it has the highest id
+    profile.del_post_by_id(10)
+    profile.save_profile(str(path))
+
+    loaded = Profile()
+    loaded.load_profile(str(path))
+    assert {post['id']: post['entry'] for post in loaded.get_posts()} == \
+        {post['id']: post['entry'] for post in profile.get_posts()}
+    assert loaded.get_post(10) is None
+    # ids of deleted posts aren't handed out again
+    assert loaded.add_post(Post('new', 1.0)) == 11
@@ -0,0 +1,69 @@
+# test_profile_cache.py
+#
+# Tests for ds_profile_cache. Run with: python -m pytest
+
+import pytest
+from Profile import Profile
+from ds_messenger import DirectMessage
+from ds_profile_cache import ProfileCache
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = tmp_path / 'me.dsu'
+    path.touch()
+    profile = Profile('server', 'me', 'pw')
+    profile._users.append('bob')
+    profile.add_msgs([DirectMessage(f'm{i}', 1000.0 + i * 10, 'bob', 'me') for i in range(50)])
+    profile.enqueue_msg('queued', 'bob')
+    profile.save_profile(str(path))
+    return str(path)
+
+
+def _state(profile: Profile) -> tuple:
+    return ([(m['message'], m['timestamp']) for m in profile._messages], list(profile._users),
+            [dict(entry) for entry in profile._outbox])
+
+
+def test_handed_out_profile_is_unchanged_by_edit(path):
+    cache = ProfileCache()
+    cached = cache.get(path)
+    before = _state(cached)
+    page = cached.get_chat_page('bob', limit=10)
+
+    with cache.edit(path) as profile:
+        profile.merge_messages([DirectMessage(f'm{i}', 1005.0 + i * 10, 'bob', 'me') for i in range(50)])
+        profile.add_msg(DirectMessage('new', 2000.0, 'me', 'carol'))
+        profile._outbox[0]['attempts'] += 1
+
+    assert _state(cached) == before
+    assert page[-1]['timestamp'] == 1490.0
+    assert cached.get_chat_page('bob', limit=1)[0]['timestamp'] == 1490.0
+
+    latest = cache.get(path)
+    assert latest is not cached
+    assert latest._messages[-1]['message'] == 'new'
+    assert latest.get_chat_page('bob', limit=1)[0]['timestamp'] == 1495.0
+    assert latest._outbox[0]['attempts'] == 1
+
+
+def test_failed_edit_keeps_the_cached_profile(path):
+    cache = ProfileCache()
+    cached = cache.get(path)
+    with pytest.raises(RuntimeError):
+        with cache.edit(path) as profile:
+            profile._users.append('zz')
+            raise RuntimeError
+    assert cache.get(path) is cached
+    assert 'zz' not in cached._users
+
+
+def test_get_reloads_after_an_outside_change(path):
+    cache = ProfileCache()
+    cached = cache.get(path)
+    other = Profile()
+    other.load_profile(path)
+    other._users.append('dave')
+    other.save_profile(path)
+    assert 'dave' in cache.get(path)._users
+    assert 'dave' not in cached._users
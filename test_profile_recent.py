@@ -0,0 +1,45 @@
+# test_profile_recent.py
+#
+# Tests for Profile.load_profile_recent. Run with: python -m pytest
+
+import pytest
+from Profile import Profile, DsuFileError
+from ds_messenger import DirectMessage
+
+
+def _save(path, compression: str) -> Profile:
+    path.touch()
+    profile = Profile('server', 'me', 'pw')
+    profile._users.extend(['alice', 'bob', 'quiet'])
+    for i in range(100):
+        # alice writes a lot, bob only now and then
+        contact = 'bob' if i % 10 == 0 else 'alice'
+        profile.add_msg(DirectMessage(f'm{i}', 1000.0 + i, contact, 'me'))
+    profile.enqueue_msg('queued', 'bob')
+    profile.save_profile(str(path), compression=compression)
+    return profile
+
+
+@pytest.mark.parametrize('compression', ['plain', 'gzip'])
+def test_latest_messages_per_contact(tmp_path, compression):
+    path = tmp_path / 'me.dsu'
+    full = _save(path, compression)
+    recent = Profile()
+    recent.recent_limit = 5
+    recent.load_profile_recent(str(path))
+
+    assert recent.username == 'me' and recent._users == full._users
+    assert [entry['message'] for entry in recent.get_outbox()] == ['queued']
+    expected = sorted([m for m in full._messages if m['recipient'] == 'alice'][-5:] +
+                      [m for m in full._messages if m['recipient'] == 'bob'][-5:],
+                      key=lambda message: message['timestamp'])
+    assert [m['message'] for m in recent._messages] == [m['message'] for m in expected]
+
+
+def test_recent_profile_cannot_be_saved(tmp_path):
+    path = tmp_path / 'me.dsu'
+    _save(path, 'plain')
+    recent = Profile()
+    recent.load_profile_recent(str(path))
+    with pytest.raises(DsuFileError):
+        recent.save_profile(str(path))
@@ -0,0 +1,79 @@
+# test_receiver.py
+#
+# Tests for ds_receiver against the ds_server stand-in. Run with: python -m pytest
+
+import threading
+import time
+import pytest
+import ds_server
+from ds_server import DspServer
+from ds_messenger import DirectMessenger, DirectMessengerError
+from ds_receiver import SelectorReceiver, PUSH, POLL
+
+
+class _NoSubscribeServer(DspServer):
+    # answers like the ICS 32 server, which doesn't know "subscribe"
+    def _handle(self, line, token_user, client=None, send_lock=None):
+        if b'"subscribe"' in line:
+            return ds_server._error("Unknown request"), token_user
+        return super()._handle(line, token_user, client, send_lock)
+
+
+class _SlowSubscribeServer(DspServer):
+    # takes delay seconds to answer the subscription
+    delay = 5.0
+
+    def _handle(self, line, token_user, client=None, send_lock=None):
+        if b'"subscribe"' in line:
+            time.sleep(self.delay)
+        return super()._handle(line, token_user, client, send_lock)
+
+
+def _receive(server, count: int, poll_interval: float = 0.2) -> tuple:
+    got, stop = [], threading.Event()
+    receiver = SelectorReceiver(DirectMessenger('127.0.0.1', 'bob', 'pw', port=server.port), got.extend,
+                                poll_interval)
+    thread = threading.Thread(target=receiver.run, kwargs={'stop': stop})
+    thread.start()
+    try:
+        time.sleep(0.3)
+        alice = DirectMessenger('127.0.0.1', 'alice', 'pw', port=server.port)
+        for i in range(count):
+            assert alice.send(f'hi {i}', 'bob')
+        deadline = time.monotonic() + 5
+        while len(got) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return [message['message'] for message in got], receiver.receiver.mode
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_pushed_messages_arrive():
+    with DspServer() as server:
+        assert _receive(server, 3) == (['hi 0', 'hi 1', 'hi 2'], PUSH)
+
+
+def test_falls_back_to_polling():
+    with _NoSubscribeServer() as server:
+        assert _receive(server, 3) == (['hi 0', 'hi 1', 'hi 2'], POLL)
+
+
+def test_run_waits_out_its_duration_while_the_answer_is_pending():
+    with _SlowSubscribeServer() as server:
+        receiver = SelectorReceiver(DirectMessenger('127.0.0.1', 'bob', 'pw', port=server.port), print)
+        start, cpu = time.monotonic(), time.process_time()
+        receiver.run(duration=0.5)
+        assert time.monotonic() - start >= 0.45
+        # it waited on the socket instead of spinning
+        assert time.process_time() - cpu < 0.2
+
+
+def test_overdue_answer_is_an_error():
+    with _SlowSubscribeServer() as server:
+        receiver = SelectorReceiver(DirectMessenger('127.0.0.1', 'bob', 'pw', port=server.port, timeout=0.3),
+                                    print)
+        start = time.monotonic()
+        with pytest.raises(DirectMessengerError):
+            receiver.run(duration=3)
+        assert time.monotonic() - start < 2
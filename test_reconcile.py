@@ -0,0 +1,88 @@
+# test_reconcile.py
+#
+# Tests for ds_reconcile and Profile.merge_messages. Run with: python -m pytest
+
+from Profile import Profile
+from ds_messenger import DirectMessage
+from ds_reconcile import reconcile
+
+
+def _msg(text: str, timestamp: float, frm: str = 'me', recipient: str = 'bob') -> DirectMessage:
+    return DirectMessage(text, timestamp, recipient, frm)
+
+
+def _texts(messages: list) -> list:
+    return [(message['message'], message['timestamp']) for message in messages]
+
+
+def test_matches_within_tolerance_only():
+    local = [_msg('a', 100.0), _msg('b', 200.0)]
+    remote = [_msg('a', 129.0), _msg('b', 231.0)]
+    result = reconcile(local, remote, tolerance=30.0)
+    assert [pair[0]['message'] for pair in result.matched] == ['a']
+    assert _texts(result.inserted) == [('b', 231.0)]
+    assert _texts(result.merged) == [('a', 129.0), ('b', 200.0), ('b', 231.0)]
+
+
+def test_tolerance_is_inclusive():
+    result = reconcile([_msg('a', 100.0)], [_msg('a', 130.0)], tolerance=30.0)
+    assert len(result.matched) == 1 and not result.inserted
+
+
+def test_duplicates_match_one_to_one():
+    local = [_msg('hi', 100.0), _msg('hi', 101.0)]
+    remote = [_msg('hi', 102.0), _msg('hi', 103.0), _msg('hi', 104.0)]
+    result = reconcile(local, remote)
+    assert len(result.matched) == 2
+    assert _texts(result.inserted) == [('hi', 104.0)]
+    assert len(result.merged) == 3
+    assert len({id(local) for local, _ in result.matched}) == 2
+
+
+def test_out_of_order_inputs():
+    local = [_msg('c', 300.0), _msg('a', 100.0), _msg('b', 200.0)]
+    remote = [_msg('b', 205.0), _msg('d', 400.0), _msg('a', 95.0)]
+    result = reconcile(local, remote)
+    assert _texts(result.merged) == [('a', 95.0), ('b', 205.0), ('c', 300.0), ('d', 400.0)]
+    assert _texts(result.inserted) == [('d', 400.0)]
+
+
+def test_sender_and_recipient_must_match():
+    result = reconcile([_msg('a', 100.0, frm='me', recipient='bob')],
+                       [_msg('a', 100.0, frm='bob', recipient='me')])
+    assert not result.matched and len(result.inserted) == 1
+
+
+def test_conflicts_are_reported_and_kept():
+    result = reconcile([_msg('a', 100.0)], [_msg('b', 100.0)])
+    assert len(result.conflicts) == 1
+    assert sorted(message['message'] for message in result.merged) == ['a', 'b']
+
+
+def test_inputs_are_not_changed():
+    local = [_msg('a', 100.0)]
+    remote = [_msg('a', 105.0)]
+    result = reconcile(local, remote)
+    assert local[0]['timestamp'] == 100.0 and local[0].get_time() == 100.0
+    assert result.merged[0]['timestamp'] == 105.0 and result.merged[0].get_time() == 105.0
+    assert result.merged[0] is not local[0]
+    assert result.matched[0][0] is local[0]
+
+
+def test_keeping_local_time():
+    result = reconcile([_msg('a', 100.0)], [_msg('a', 105.0)], adopt_server_time=False)
+    assert _texts(result.merged) == [('a', 100.0)]
+
+
+def test_merge_messages_leaves_shared_messages_alone():
+    profile = Profile('server', 'me', 'pw')
+    profile.add_msgs([_msg(f'm{i}', 1000.0 + i * 10) for i in range(50)])
+    before = profile.copy()
+    page = before.get_chat_page('bob', limit=10)
+
+    result = profile.merge_messages([_msg(f'm{i}', 1005.0 + i * 10) for i in range(50)])
+    assert len(result.matched) == 50 and not result.inserted
+    assert profile._messages[-1]['timestamp'] == 1495.0
+    assert before._messages[-1]['timestamp'] == 1490.0
+    assert page[-1]['timestamp'] == 1490.0
+    assert before.get_chat_page('bob', limit=1)[0]['timestamp'] == 1490.0
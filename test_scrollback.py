@@ -0,0 +1,93 @@
+# test_scrollback.py
+#
+# Tests for ds_scrollback and ds_render_cache. Run with: python -m pytest
+
+from Profile import Profile
+from ds_messenger import DirectMessage
+from ds_render_cache import RenderCache
+from ds_scrollback import ConversationWindow
+
+
+def _profile(count: int, start: float = 1000.0) -> Profile:
+    profile = Profile('server', 'me', 'pw')
+    for i in range(count):
+        profile.add_msg(DirectMessage(f'm{i}', start + i, 'bob' if i % 2 else 'me', 'me' if i % 2 else 'bob'))
+    return profile
+
+
+def _format(message) -> str:
+    return message['message']
+
+
+def test_reset_shows_latest_page():
+    window = ConversationWindow(_format, page_size=10)
+    text = window.reset(_profile(25), 'bob')
+    assert text.split('\n') == [f'm{i}' for i in range(15, 25)]
+    assert not window.at_start and window.at_end
+    assert window.line_count == 10
+
+
+def test_refresh_never_keeps_more_than_max_pages():
+    profile = _profile(5)
+    window = ConversationWindow(_format, page_size=10, max_pages=3)
+    lines = window.reset(profile, 'bob').split('\n')
+    for i in range(5, 100):
+        profile.add_msg(DirectMessage(f'm{i}', 1000.0 + i, 'bob', 'me'))
+        text, dropped = window.refresh(profile)
+        lines = lines[dropped:] + text[1:].split('\n')
+        assert lines == window.text().split('\n')
+        assert len(window.pages) <= 3 and window.line_count == len(lines)
+
+
+def test_paging_back_reaches_the_first_message():
+    profile = _profile(95)
+    window = ConversationWindow(_format, page_size=10, max_pages=3)
+    window.reset(profile, 'bob')
+    shown = [message for page in window.pages for message in page]
+    while window.load_older(profile) is not None:
+        shown = window.pages[0] + shown
+    assert window.at_start
+    assert [m['message'] for m in shown] == [m['message'] for m in profile.get_chat_messages('bob')]
+
+
+def test_cache_hits_when_a_conversation_is_shown_again():
+    cache = RenderCache()
+    profile = _profile(30)
+    window = ConversationWindow(_format, page_size=10, cache=cache)
+    first = window.reset(profile, 'bob')
+    misses = cache.stats()['misses']
+    window.clear()
+    assert window.reset(profile, 'bob') == first
+    assert cache.stats()['misses'] == misses and cache.stats()['hits'] >= 1
+
+
+def test_invalidated_pages_are_rendered_again():
+    cache = RenderCache()
+    calls = []
+    window = ConversationWindow(lambda message: calls.append(message) or message['message'], page_size=10,
+                                cache=cache)
+    profile = _profile(30)
+    window.reset(profile, 'bob')
+    count = len(calls)
+    cache.invalidate('bob')
+    window.reset(profile, 'bob')
+    assert len(calls) == 2 * count
+
+
+def test_render_cache_evicts_least_recently_used():
+    cache = RenderCache(max_chars=10)
+    cache.put('a', 1, 'xxxx')
+    cache.put('b', 1, 'yyyy')
+    assert cache.get('a', 1) == 'xxxx'
+    cache.put('c', 1, 'zzzz')
+    assert cache.get('b', 1) is None
+    assert cache.get('a', 1) == 'xxxx' and cache.get('c', 1) == 'zzzz'
+    assert cache.stats()['evictions'] == 1
+
+
+def test_render_cache_ignores_puts_from_before_an_invalidation():
+    cache = RenderCache()
+    version = cache.version('a')
+    cache.invalidate('a')
+    cache.put('a', 1, 'old', version)
+    assert cache.get('a', 1) is None
@@ -0,0 +1,103 @@
+# test_shards.py
+#
+# Tests for ds_shards. Run with: python -m pytest
+
+import pytest
+from Profile import Profile, Post
+from ds_messenger import DirectMessage
+from ds_shards import ShardedProfile, MANIFEST, POSTS, dsu_to_shards, shards_to_dsu, _shard_file
+
+
+def _profile() -> Profile:
+    profile = Profile('server', 'me', 'pw')
+    profile.bio = 'hi'
+    for i in range(60):
+        contact = ('alice', 'bob', 'carol')[i % 3]
+        if i % 2:
+            profile.add_msg(DirectMessage(f'm{i}', 1000.0 + i, 'me', contact))
+        else:
+            profile.add_msg(DirectMessage(f'm{i}', 1000.0 + i, contact, 'me'))
+    profile.add_post(Post('first', 10.0))
+    profile.enqueue_msg('queued', 'dave')
+    return profile
+
+
+def _messages(profile: Profile) -> list:
+    return [(m['timestamp'], m['from'], m['recipient'], m['message']) for m in profile._messages]
+
+
+def test_round_trip(tmp_path):
+    profile = _profile()
+    ShardedProfile(tmp_path / 'shards').save(profile)
+    loaded = ShardedProfile(tmp_path / 'shards', workers=1).load()
+    assert _messages(loaded) == _messages(profile)
+    assert loaded.bio == 'hi' and loaded._users == profile._users
+    assert [post['entry'] for post in loaded.get_posts()] == ['first']
+    assert [entry['message'] for entry in loaded.get_outbox()] == ['queued']
+
+
+def test_dsu_round_trip(tmp_path):
+    dsu = tmp_path / 'me.dsu'
+    dsu.touch()
+    profile = _profile()
+    profile.save_profile(str(dsu))
+    dsu_to_shards(str(dsu), tmp_path / 'shards')
+    back = tmp_path / 'back.dsu'
+    shards_to_dsu(tmp_path / 'shards', str(back))
+    loaded = Profile()
+    loaded.load_profile(str(back))
+    assert _messages(loaded) == _messages(profile)
+
+
+def test_save_only_writes_changed_shards(tmp_path):
+    shards = ShardedProfile(tmp_path / 'shards', workers=1)
+    shards.save(_profile())
+    profile = shards.load()
+    assert shards.save(profile) == [MANIFEST]
+
+    profile.add_msg(DirectMessage('new', 2000.0, 'bob', 'me'))
+    assert sorted(shards.save(profile)) == sorted([_shard_file('bob'), MANIFEST])
+
+    profile.add_post(Post('second', 20.0))
+    assert sorted(shards.save(profile)) == sorted([POSTS, MANIFEST])
+
+
+def test_replaced_messages_list_rewrites_only_what_changed(tmp_path):
+    shards = ShardedProfile(tmp_path / 'shards', workers=1)
+    shards.save(_profile())
+    profile = shards.load()
+
+    # the server has alice's messages a few seconds later, reconcile replaces them with copies
+    remote = [DirectMessage(m['message'], m['timestamp'] + 2, m['recipient'], m['from'])
+              for m in profile._messages if 'alice' in (m['from'], m['recipient'])]
+    profile.merge_messages(remote)
+    assert sorted(shards.save(profile)) == sorted([_shard_file('alice'), MANIFEST])
+    # alice's messages now share timestamps with the others', and messages of different conversations with the
+    # same timestamp have no set order
+    assert sorted(_messages(ShardedProfile(tmp_path / 'shards', workers=1).load())) == sorted(_messages(profile))
+
+
+def test_archived_conversation_shard_is_removed(tmp_path):
+    shards = ShardedProfile(tmp_path / 'shards', workers=1)
+    shards.save(_profile())
+    profile = shards.load()
+    profile._messages = [m for m in profile._messages if 'carol' not in (m['from'], m['recipient'])]
+    shards.save(profile)
+    assert not (tmp_path / 'shards' / _shard_file('carol')).exists()
+    assert _messages(ShardedProfile(tmp_path / 'shards', workers=1).load()) == _messages(profile)
+
+
+def test_out_of_order_message_is_sorted_into_its_shard(tmp_path):
+    shards = ShardedProfile(tmp_path / 'shards', workers=1)
+    shards.save(_profile())
+    profile = shards.load()
+    profile.add_msg(DirectMessage('late', 500.0, 'bob', 'me'))
+    shards.save(profile)
+    loaded = ShardedProfile(tmp_path / 'shards', workers=1).load()
+    assert loaded._messages[0]['message'] == 'late'
+
+
+def test_missing_folder_is_an_error(tmp_path):
+    from Profile import DsuFileError
+    with pytest.raises(DsuFileError):
+        ShardedProfile(tmp_path / 'nothing').load()